@@ -0,0 +1,25 @@
+"""
+Пересчёт дневной статистики центров (center_daily_stats)
+
+Сводка ведётся при записи посещений и активации абонементов; команда
+нужна после ручных правок visits / subscriptions или восстановления базы:
+
+    python backfill_stats.py
+"""
+import asyncio
+
+from database import Database
+
+
+async def main():
+    db = Database()
+    await db.init_db()
+    try:
+        rows = await db.rebuild_center_daily_stats()
+        print(f"center_daily_stats пересчитана: {rows} строк")
+    finally:
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
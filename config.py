@@ -5,6 +5,32 @@ load_dotenv()
 
 BOT_TOKEN = os.getenv("BOT_TOKEN")
 DATABASE_PATH = os.getenv("DATABASE_PATH", "database.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+
+# Профиль хранилища SQLite (применяется к каждому соединению пула)
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL")
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL")
+SQLITE_MMAP_SIZE = int(os.getenv("SQLITE_MMAP_SIZE", str(64 * 1024 * 1024)))
+SQLITE_CACHE_SIZE = int(os.getenv("SQLITE_CACHE_SIZE", "-16000"))  # отрицательное значение — в КиБ
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY")
+SQLITE_BUSY_TIMEOUT = int(os.getenv("SQLITE_BUSY_TIMEOUT", "5000"))  # мс
+
+# Кэш курсов и центров в памяти процесса
+CACHE_MAX_SIZE = int(os.getenv("CACHE_MAX_SIZE", "2048"))
+CACHE_TTL = float(os.getenv("CACHE_TTL", "300"))  # секунды
+CATALOG_CACHE_TTL = float(os.getenv("CATALOG_CACHE_TTL", "60"))  # секунды
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))  # секунды
+
+# Рендеринг QR-кодов вне цикла событий: "thread" или "process"
+QR_RENDER_EXECUTOR = os.getenv("QR_RENDER_EXECUTOR", "thread")
+QR_RENDER_WORKERS = int(os.getenv("QR_RENDER_WORKERS", "2"))
+
+# Дисковый кэш PNG QR-кодов, включается заданием QR_CACHE_DIR (например, qr_cache).
+# В файлах лежат QR-коды абонементов — каталог должен быть закрыт от посторонних
+QR_CACHE_DIR = os.getenv("QR_CACHE_DIR", "")
+QR_CACHE_MAX_BYTES = int(os.getenv("QR_CACHE_MAX_BYTES", str(64 * 1024 * 1024)))
+QR_CACHE_MMAP = os.getenv("QR_CACHE_MMAP", "false").lower() in ("1", "true", "yes")
+
 ADMIN_IDS = [int(admin_id) for admin_id in os.getenv("ADMIN_IDS", "").split(",") if admin_id]
 
 # Настройки AirbaPay
@@ -14,6 +40,58 @@ AIRBA_PAY_PASSWORD = os.getenv("AIRBA_PAY_PASSWORD", "")
 AIRBA_PAY_TERMINAL_ID = os.getenv("AIRBA_PAY_TERMINAL_ID", "")
 AIRBA_PAY_COMPANY_ID = os.getenv("AIRBA_PAY_COMPANY_ID", "230140022645")
 AIRBA_PAY_WEBHOOK_URL = os.getenv("AIRBA_PAY_WEBHOOK_URL", "")
+# Секрет в адресах уведомлений AirbaPay (?token=...): без него уведомление отклоняется
+AIRBA_PAY_WEBHOOK_SECRET = os.getenv("AIRBA_PAY_WEBHOOK_SECRET", "")
+AIRBA_PAY_POOL_SIZE = int(os.getenv("AIRBA_PAY_POOL_SIZE", "20"))  # соединений в пуле HTTP-клиента
+AIRBA_PAY_KEEPALIVE = float(os.getenv("AIRBA_PAY_KEEPALIVE", "30"))  # секунды
+AIRBA_PAY_TOKEN_TTL = float(os.getenv("AIRBA_PAY_TOKEN_TTL", "600"))  # если срок токена не известен из ответа
+AIRBA_PAY_TOKEN_MARGIN = float(os.getenv("AIRBA_PAY_TOKEN_MARGIN", "30"))  # обновлять за N секунд до истечения
+
+# HTTP-сервер для уведомлений AirbaPay (включается, если задан AIRBA_PAY_WEBHOOK_URL)
+PAYMENT_WEBHOOK_HOST = os.getenv("PAYMENT_WEBHOOK_HOST", "0.0.0.0")
+PAYMENT_WEBHOOK_PORT = int(os.getenv("PAYMENT_WEBHOOK_PORT", "8080"))
+
+# Фоновая сверка незавершённых платежей (секунды)
+PAYMENT_RECONCILE_INTERVAL = float(os.getenv("PAYMENT_RECONCILE_INTERVAL", "60"))
+PAYMENT_RECONCILE_STALE_AFTER = float(os.getenv("PAYMENT_RECONCILE_STALE_AFTER", "120"))  # не трогать более свежие
+PAYMENT_RECONCILE_BATCH = int(os.getenv("PAYMENT_RECONCILE_BATCH", "50"))  # платежей за итерацию
+PAYMENT_RECONCILE_CONCURRENCY = int(os.getenv("PAYMENT_RECONCILE_CONCURRENCY", "5"))  # параллельных запросов
+PAYMENT_EXPIRE_AFTER = float(os.getenv("PAYMENT_EXPIRE_AFTER", str(24 * 3600)))  # брошенный платеж
+IDEMPOTENCY_WINDOW = float(os.getenv("IDEMPOTENCY_WINDOW", "60"))  # повторная покупка в этом окне — дубликат
+
+# Хранилище состояний FSM: "memory", "sqlite" (в DATABASE_PATH) или "redis" (нужен пакет redis)
+FSM_STORAGE = os.getenv("FSM_STORAGE", "sqlite")
+FSM_REDIS_URL = os.getenv("FSM_REDIS_URL", "redis://localhost:6379/0")
+FSM_STATE_TTL = int(os.getenv("FSM_STATE_TTL", str(7 * 24 * 3600)))  # секунды без изменений до сброса
+
+# Получение обновлений: "polling" или "webhook"
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+BOT_WEBHOOK_URL = os.getenv("BOT_WEBHOOK_URL", "")  # публичный адрес; пусто — webhook не регистрируется
+BOT_WEBHOOK_PATH = os.getenv("BOT_WEBHOOK_PATH", "/telegram/webhook")
+BOT_WEBHOOK_SECRET = os.getenv("BOT_WEBHOOK_SECRET", "")
+BOT_WEBHOOK_HOST = os.getenv("BOT_WEBHOOK_HOST", "0.0.0.0")
+BOT_WEBHOOK_PORT = int(os.getenv("BOT_WEBHOOK_PORT", "8081"))
+BOT_WEBHOOK_WORKERS = int(os.getenv("BOT_WEBHOOK_WORKERS", "16"))  # параллельно обрабатываемых чатов
+BOT_WEBHOOK_QUEUE_SIZE = int(os.getenv("BOT_WEBHOOK_QUEUE_SIZE", "1000"))  # обновлений в очередях всего
+BOT_WEBHOOK_ENQUEUE_TIMEOUT = float(os.getenv("BOT_WEBHOOK_ENQUEUE_TIMEOUT", "5"))  # секунды
+
+# Лимиты исходящих сообщений (сообщений в секунду)
+OUTBOUND_GLOBAL_RATE = float(os.getenv("OUTBOUND_GLOBAL_RATE", "30"))  # на весь бот
+OUTBOUND_CHAT_RATE = float(os.getenv("OUTBOUND_CHAT_RATE", "1"))  # в личный чат
+OUTBOUND_GROUP_RATE = float(os.getenv("OUTBOUND_GROUP_RATE", str(20 / 60)))  # в группу или канал
+OUTBOUND_CHAT_BURST = float(os.getenv("OUTBOUND_CHAT_BURST", "3"))  # подряд в один чат без паузы
+OUTBOUND_MAX_RETRIES = int(os.getenv("OUTBOUND_MAX_RETRIES", "3"))  # повторов после 429
+
+# Аналитика партнёра
+ANALYTICS_CACHE_TTL = float(os.getenv("ANALYTICS_CACHE_TTL", "300"))  # секунды; новые посещения сбрасывают сразу
+ANALYTICS_NO_SHOW_DAYS = int(os.getenv("ANALYTICS_NO_SHOW_DAYS", "14"))  # без посещений дольше — «пропадающий» абонемент
+
+# Выгрузка CSV/XLSX: строк за одно чтение курсора, размер файла в памяти до сброса на диск (байты)
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", "5000"))
+EXPORT_SPOOL_SIZE = int(os.getenv("EXPORT_SPOOL_SIZE", str(8 * 1024 * 1024)))
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))  # одновременных выгрузок
+# Лимит Telegram на документ от бота; CSV крупнее упаковывается в ZIP
+EXPORT_MAX_FILE_SIZE = int(os.getenv("EXPORT_MAX_FILE_SIZE", str(50 * 1024 * 1024)))
 
 # Роли пользователей
 ROLE_USER = "user"
@@ -58,4 +136,29 @@ CITIES = [
     "Другое"
 ]
 
+# Фильтры каталога: диапазоны цены абонемента на 8 занятий (мин, макс), возраст, рейтинг
+PRICE_RANGES = [
+    (None, 20000),
+    (20000, 40000),
+    (40000, 60000),
+    (60000, None)
+]
+
+AGE_FILTERS = [3, 5, 7, 10, 12, 14, 16, 18]
+
+RATING_FILTERS = [3, 4, 4.5]
+
+# Периоды аналитики: ключ -> (название, дней, шаг ряда)
+ANALYTICS_PERIODS = {
+    "week": ("7 дней", 7, "day"),
+    "month": ("30 дней", 30, "week"),
+    "quarter": ("3 месяца", 91, "week"),
+    "year": ("12 месяцев", 365, "month")
+}
 
+# Данные выгрузки: ключ -> название
+EXPORT_KINDS = {
+    "visits": "Посещения",
+    "payments": "Оплаты",
+    "subscriptions": "Абонементы"
+}
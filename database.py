@@ -1,16 +1,547 @@
+import asyncio
 import aiosqlite
 import json
+import sqlite3
+from contextlib import asynccontextmanager
 from datetime import datetime
-from config import DATABASE_PATH, ROLE_USER, STATUS_PENDING
+from typing import Dict, List, Optional, Tuple
+from utils.cache import AsyncTTLCache
+from config import (
+    DATABASE_PATH, DB_READ_POOL_SIZE, ROLE_USER, STATUS_PENDING,
+    CACHE_MAX_SIZE, CACHE_TTL, CATALOG_CACHE_TTL, USER_CACHE_TTL,
+    SQLITE_JOURNAL_MODE, SQLITE_SYNCHRONOUS, SQLITE_MMAP_SIZE,
+    SQLITE_CACHE_SIZE, SQLITE_TEMP_STORE, SQLITE_BUSY_TIMEOUT, IDEMPOTENCY_WINDOW,
+    EXPORT_CHUNK_SIZE
+)
+
+
+# Профиль хранилища: journal_mode сохраняется в файле базы и задаётся в init_db,
+# остальные PRAGMA действуют на соединение и применяются к каждому соединению пула
+STORAGE_PROFILE = {
+    "journal_mode": SQLITE_JOURNAL_MODE,
+    "synchronous": SQLITE_SYNCHRONOUS,
+    "mmap_size": SQLITE_MMAP_SIZE,
+    "cache_size": SQLITE_CACHE_SIZE,
+    "temp_store": SQLITE_TEMP_STORE,
+    "busy_timeout": SQLITE_BUSY_TIMEOUT,
+}
+
+
+class ConnectionPool:
+    """
+    Долгоживущие соединения с SQLite: небольшой пул читателей
+    и одно соединение-писатель, доступ к которому сериализован
+    """
+
+    def __init__(self, db_path: str, readers: int = DB_READ_POOL_SIZE, profile: dict = None):
+        self.db_path = db_path
+        self.size = max(1, readers)
+        self.profile = STORAGE_PROFILE if profile is None else profile
+        self._readers: Optional[asyncio.Queue] = None
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._connections: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    @property
+    def is_open(self) -> bool:
+        return self._writer is not None
+
+    async def _connect(self) -> aiosqlite.Connection:
+        conn = await aiosqlite.connect(self.db_path)
+        conn.row_factory = aiosqlite.Row
+        for name, value in self.profile.items():
+            if name != "journal_mode":
+                await conn.execute(f"PRAGMA {name} = {value}")
+        self._connections.append(conn)
+        return conn
+
+    async def open(self):
+        """Открывает соединения (повторный вызов ничего не делает)"""
+        async with self._open_lock:
+            if self.is_open:
+                return
+            readers = asyncio.Queue()
+            for _ in range(self.size):
+                readers.put_nowait(await self._connect())
+            self._readers = readers
+            self._writer = await self._connect()
+
+    async def close(self):
+        """Закрывает все соединения пула"""
+        async with self._open_lock:
+            connections, self._connections = self._connections, []
+            writer, self._writer = self._writer, None
+            self._readers = None
+            try:
+                if writer is not None:
+                    # Обновляем статистику планировщика для выбора индексов каталога
+                    await writer.execute("PRAGMA optimize")
+            finally:
+                for conn in connections:
+                    await conn.close()
+
+    @asynccontextmanager
+    async def reader(self):
+        """Соединение для чтения из пула"""
+        if not self.is_open:
+            await self.open()
+        readers = self._readers
+        conn = await readers.get()
+        try:
+            yield conn
+        finally:
+            readers.put_nowait(conn)
+
+    @asynccontextmanager
+    async def writer(self):
+        """Единственное соединение для записи; коммит при успешном выходе"""
+        if not self.is_open:
+            await self.open()
+        async with self._write_lock:
+            conn = self._writer
+            try:
+                yield conn
+            except BaseException:
+                await conn.rollback()
+                raise
+            else:
+                await conn.commit()
+
+    @asynccontextmanager
+    async def transaction(self):
+        """
+        Соединение-писатель в явной транзакции BEGIN IMMEDIATE: блокировка записи
+        берётся сразу, поэтому другие процессы не вклинятся между чтением и записью
+        """
+        async with self.writer() as conn:
+            await conn.execute("BEGIN IMMEDIATE")
+            yield conn
+
+
+# Цена абонемента по тарифу (s — subscriptions, c — courses)
+TARIFF_PRICE_SQL = """CASE
+        WHEN s.tariff = '4' THEN c.price_4
+        WHEN s.tariff = '8' THEN c.price_8
+        WHEN s.tariff = 'unlimited' THEN c.price_unlimited
+        ELSE 0
+    END"""
+
+# Пересчёт center_daily_stats по visits и subscriptions (backfill_stats.py).
+# Продления и занятия относятся к дню покупки абонемента; продление — у клиента
+# (user_id, child_id) была более ранняя покупка в том же центре.
+CENTER_DAILY_STATS_REBUILD = [
+    "DELETE FROM center_daily_stats",
+    """INSERT INTO center_daily_stats (center_id, day, visits, sales, revenue,
+                                       renewals, limited_sales, lessons_bought, lessons_used)
+        SELECT center_id, day, SUM(visits), SUM(sales), SUM(revenue),
+               SUM(renewals), SUM(limited_sales), SUM(lessons_bought), SUM(lessons_used)
+        FROM (
+            SELECT center_id, date(visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue,
+                   0 as renewals, 0 as limited_sales, 0 as lessons_bought, 0 as lessons_used
+            FROM visits
+            WHERE center_id IS NOT NULL
+            GROUP BY center_id, date(visited_at)
+            UNION ALL
+            SELECT center_id, date(activated_at), 0, COUNT(*), COALESCE(SUM(price_paid), 0),
+                   SUM(previous_at IS NOT NULL),
+                   SUM(tariff != 'unlimited'),
+                   SUM(CASE WHEN tariff != 'unlimited' THEN lessons_total ELSE 0 END),
+                   SUM(CASE WHEN tariff != 'unlimited' THEN lessons_total - lessons_remaining ELSE 0 END)
+            FROM (
+                SELECT center_id, activated_at, price_paid, tariff, lessons_total, lessons_remaining,
+                       LAG(activated_at) OVER (
+                           PARTITION BY center_id, user_id, child_id ORDER BY activated_at
+                       ) as previous_at
+                FROM subscriptions
+                WHERE activated_at IS NOT NULL AND center_id IS NOT NULL
+            )
+            GROUP BY center_id, date(activated_at)
+        )
+        GROUP BY center_id, day""",
+]
+
+# То же по курсам: разбивка аналитики центра по курсам
+COURSE_DAILY_STATS_REBUILD = [
+    "DELETE FROM course_daily_stats",
+    """INSERT INTO course_daily_stats (center_id, course_id, day, visits, sales, revenue)
+        SELECT center_id, course_id, day, SUM(visits), SUM(sales), SUM(revenue) FROM (
+            SELECT v.center_id, s.course_id, date(v.visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue
+            FROM visits v
+            JOIN subscriptions s ON v.subscription_id = s.subscription_id
+            WHERE v.center_id IS NOT NULL AND s.course_id IS NOT NULL
+            GROUP BY v.center_id, s.course_id, date(v.visited_at)
+            UNION ALL
+            SELECT center_id, course_id, date(activated_at), 0, COUNT(*), COALESCE(SUM(price_paid), 0)
+            FROM subscriptions
+            WHERE activated_at IS NOT NULL AND center_id IS NOT NULL AND course_id IS NOT NULL
+            GROUP BY center_id, course_id, date(activated_at)
+        )
+        GROUP BY center_id, course_id, day""",
+]
+
+
+# Выгрузки CSV/XLSX: заголовки, запрос и порядок строк. Порядок выбран так, чтобы строки
+# шли по индексу (center_order — при фильтре по центру) без сортировки всей выборки.
+EXPORT_QUERIES = {
+    "visits": {
+        "columns": ["ID посещения", "Дата (UTC)", "ID центра", "Центр", "Курс", "ID абонемента", "Тариф",
+                    "ID пользователя", "Имя", "Username", "ID ребёнка", "Ребёнок"],
+        "sql": """
+            SELECT v.visit_id, v.visited_at, v.center_id, ce.name, co.name, v.subscription_id, s.tariff,
+                   v.user_id, u.full_name, u.username, v.child_id, ch.name
+            FROM visits v
+            LEFT JOIN subscriptions s ON s.subscription_id = v.subscription_id
+            LEFT JOIN courses co ON co.course_id = s.course_id
+            LEFT JOIN centers ce ON ce.center_id = v.center_id
+            LEFT JOIN users u ON u.user_id = v.user_id
+            LEFT JOIN children ch ON ch.child_id = v.child_id""",
+        "center": "v.center_id",
+        "order": "v.visit_id",
+        "center_order": "v.visited_at, v.visit_id",
+    },
+    "payments": {
+        "columns": ["ID платежа", "Создан (UTC)", "Проведён (UTC)", "Статус", "Сумма", "Валюта", "Способ",
+                    "ID абонемента", "Центр", "Курс", "Тариф", "ID пользователя", "Имя", "Счёт", "Ошибка"],
+        "sql": """
+            SELECT p.payment_id, p.created_at, p.processed_at, p.status, p.amount, p.currency, p.method,
+                   p.subscription_id, ce.name, co.name, s.tariff, p.user_id, u.full_name, p.invoice_id,
+                   p.error_message
+            FROM payments p
+            LEFT JOIN subscriptions s ON s.subscription_id = p.subscription_id
+            LEFT JOIN courses co ON co.course_id = s.course_id
+            LEFT JOIN centers ce ON ce.center_id = s.center_id
+            LEFT JOIN users u ON u.user_id = p.user_id""",
+        "center": "s.center_id",
+        "order": "p.payment_id",
+        "center_order": "s.purchased_at, p.payment_id",
+    },
+    "subscriptions": {
+        "columns": ["ID абонемента", "Куплен (UTC)", "Активирован (UTC)", "Истекает (UTC)", "Статус", "Центр",
+                    "Курс", "Тариф", "Занятий всего", "Занятий осталось", "Цена", "Валюта",
+                    "ID пользователя", "Имя", "ID ребёнка", "Ребёнок"],
+        "sql": """
+            SELECT s.subscription_id, s.purchased_at, s.activated_at, s.expires_at, s.status, ce.name,
+                   co.name, s.tariff, s.lessons_total, s.lessons_remaining, s.price_paid, s.currency,
+                   s.user_id, u.full_name, s.child_id, ch.name
+            FROM subscriptions s
+            LEFT JOIN courses co ON co.course_id = s.course_id
+            LEFT JOIN centers ce ON ce.center_id = s.center_id
+            LEFT JOIN users u ON u.user_id = s.user_id
+            LEFT JOIN children ch ON ch.child_id = s.child_id""",
+        "center": "s.center_id",
+        "order": "s.subscription_id",
+        "center_order": "s.purchased_at, s.subscription_id",
+    },
+}
+
+def add_missing_columns(table: str, columns: List[Tuple[str, str]]):
+    """
+    Шаг миграции: ALTER TABLE ADD COLUMN для колонок, которых нет в таблице
+
+    Нужен для баз, где таблица создана старой схемой: CREATE TABLE IF NOT EXISTS
+    её не обновляет, а ADD COLUMN существующей колонки — ошибка.
+    """
+    async def step(db: aiosqlite.Connection):
+        async with db.execute(f"PRAGMA table_info({table})") as cursor:
+            existing = {row[1] for row in await cursor.fetchall()}
+        for name, definition in columns:
+            if name not in existing:
+                await db.execute(f"ALTER TABLE {table} ADD COLUMN {name} {definition}")
+    return step
+
+
+# Миграции схемы: (версия, описание, шаги). Шаг — SQL-выражение или add_missing_columns.
+# Каждая применяется один раз в отдельной транзакции, номер сохраняется в schema_version.
+# Номер новой миграции — следующий после наибольшего; применяются в порядке списка,
+# номера применённых миграций не меняются.
+MIGRATIONS = [
+    (1, "Индексы для частых запросов", [
+        # Абонементы пользователя / ребёнка и статистика посещений
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user ON subscriptions(user_id, child_id)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_child ON subscriptions(child_id)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_user_active "
+        "ON subscriptions(user_id, child_id) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_child_active "
+        "ON subscriptions(child_id) WHERE status = 'active'",
+        # Ученики и продажи центра
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_center_active "
+        "ON subscriptions(center_id, user_id, child_id) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_center_purchased "
+        "ON subscriptions(center_id, purchased_at)",
+        # Посещения
+        "CREATE INDEX IF NOT EXISTS idx_visits_subscription ON visits(subscription_id)",
+        "CREATE INDEX IF NOT EXISTS idx_visits_center_visited ON visits(center_id, visited_at)",
+        # Центры
+        "CREATE INDEX IF NOT EXISTS idx_centers_partner ON centers(partner_id)",
+        "CREATE INDEX IF NOT EXISTS idx_centers_status_city ON centers(status, city)",
+        # Курсы
+        "CREATE INDEX IF NOT EXISTS idx_courses_center_category ON courses(center_id, category)",
+        "CREATE INDEX IF NOT EXISTS idx_courses_category ON courses(category)",
+        # Платежи
+        "CREATE INDEX IF NOT EXISTS idx_payments_user_created ON payments(user_id, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_subscription ON payments(subscription_id)",
+        # Дети
+        "CREATE INDEX IF NOT EXISTS idx_children_parent ON children(parent_id)",
+    ]),
+    (2, "Составной индекс фильтров каталога", [
+        # Поиск по центру и категории, остальные фильтры каталога проверяются по индексу
+        "CREATE INDEX IF NOT EXISTS idx_courses_catalog "
+        "ON courses(center_id, category, price_8, rating, age_min, age_max)",
+        "CREATE INDEX IF NOT EXISTS idx_courses_category_price "
+        "ON courses(category, price_8, rating, age_min, age_max)",
+        "DROP INDEX IF EXISTS idx_courses_center_category",
+        "DROP INDEX IF EXISTS idx_courses_category",
+    ]),
+    (3, "Telegram file_id изображения QR-кода", [
+        "ALTER TABLE subscriptions ADD COLUMN qr_file_id TEXT",
+    ]),
+    (12, "Колонки AirbaPay в таблице платежей старой схемы", [
+        # Базы, созданные до AirbaPay: payments без счёта, валюты и времени проведения.
+        # Нужны индексам миграции 4 и пересчёту цен миграции 9
+        add_missing_columns("payments", [
+            ("currency", "TEXT DEFAULT 'KZT'"),
+            ("invoice_id", "TEXT"),
+            ("airba_payment_id", "TEXT"),
+            ("redirect_url", "TEXT"),
+            ("error_message", "TEXT"),
+            ("processed_at", "TIMESTAMP"),
+        ]),
+    ]),
+    (4, "Поиск платежей из уведомлений AirbaPay", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_invoice ON payments(invoice_id)",
+        "CREATE INDEX IF NOT EXISTS idx_payments_airba ON payments(airba_payment_id)",
+    ]),
+    (5, "Частичный индекс незавершённых платежей", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_pending ON payments(created_at) WHERE status = 'pending'",
+    ]),
+    (6, "Ключи идемпотентности покупок", [
+        "ALTER TABLE subscriptions ADD COLUMN idempotency_key TEXT",
+        "ALTER TABLE payments ADD COLUMN idempotency_key TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_idempotency "
+        "ON subscriptions(idempotency_key, purchased_at) WHERE idempotency_key IS NOT NULL",
+        "CREATE INDEX IF NOT EXISTS idx_payments_idempotency "
+        "ON payments(idempotency_key, created_at) WHERE idempotency_key IS NOT NULL",
+    ]),
+    (7, "Хранилище состояний FSM", [
+        # Одна строка на ключ aiogram; пустые состояния удаляются, а не хранятся
+        """CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT,
+            expires_at INTEGER NOT NULL
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_fsm_storage_expires ON fsm_storage(expires_at)",
+    ]),
+    (8, "Дневная статистика центров", [
+        # Продажа — первая активация абонемента (оплата или выдача без оплаты)
+        "ALTER TABLE subscriptions ADD COLUMN activated_at TIMESTAMP",
+        # Прежние продажи: абонементы с успешной оплатой или выданные без платежа
+        """UPDATE subscriptions SET activated_at = purchased_at
+           WHERE status != 'cancelled'
+             AND (EXISTS (SELECT 1 FROM payments p
+                          WHERE p.subscription_id = subscriptions.subscription_id AND p.status = 'success')
+                  OR NOT EXISTS (SELECT 1 FROM payments p
+                                 WHERE p.subscription_id = subscriptions.subscription_id))""",
+        """CREATE TABLE IF NOT EXISTS center_daily_stats (
+            center_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            sales INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (center_id, day)
+        ) WITHOUT ROWID""",
+        "CREATE INDEX IF NOT EXISTS idx_center_daily_stats_day ON center_daily_stats(day)",
+        f"""INSERT INTO center_daily_stats (center_id, day, visits, sales, revenue)
+            SELECT center_id, day, SUM(visits), SUM(sales), SUM(revenue) FROM (
+                SELECT center_id, date(visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue
+                FROM visits
+                WHERE center_id IS NOT NULL
+                GROUP BY center_id, date(visited_at)
+                UNION ALL
+                SELECT s.center_id, date(s.activated_at), 0, COUNT(*), COALESCE(SUM({TARIFF_PRICE_SQL}), 0)
+                FROM subscriptions s
+                JOIN courses c ON s.course_id = c.course_id
+                WHERE s.activated_at IS NOT NULL AND s.center_id IS NOT NULL
+                GROUP BY s.center_id, date(s.activated_at)
+            )
+            GROUP BY center_id, day""",
+    ]),
+    (9, "Цена покупки абонемента", [
+        "ALTER TABLE subscriptions ADD COLUMN price_paid INTEGER",
+        "ALTER TABLE subscriptions ADD COLUMN currency TEXT DEFAULT 'KZT'",
+        # Оплаченные абонементы — по сумме успешного платежа
+        # (payments.currency в старых базах добавляет миграция 12, она стоит раньше)
+        """UPDATE subscriptions SET
+               price_paid = (SELECT CAST(ROUND(MAX(p.amount)) AS INTEGER) FROM payments p
+                             WHERE p.subscription_id = subscriptions.subscription_id AND p.status = 'success'),
+               currency = COALESCE((SELECT p.currency FROM payments p
+                                    WHERE p.subscription_id = subscriptions.subscription_id AND p.status = 'success'
+                                    ORDER BY p.amount DESC LIMIT 1), 'KZT')
+           WHERE EXISTS (SELECT 1 FROM payments p
+                         WHERE p.subscription_id = subscriptions.subscription_id AND p.status = 'success')""",
+        # Остальные — по цене тарифа курса (лучшее, что известно)
+        f"""UPDATE subscriptions SET price_paid = (
+               SELECT {TARIFF_PRICE_SQL} FROM courses c, subscriptions s
+               WHERE s.subscription_id = subscriptions.subscription_id AND c.course_id = s.course_id
+           )
+           WHERE price_paid IS NULL""",
+        # Выручка центра за период читается только из индекса
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_center_revenue "
+        "ON subscriptions(center_id, activated_at, price_paid) WHERE activated_at IS NOT NULL",
+        # Сводка, посчитанная по текущим ценам курсов, пересчитывается по ценам покупки
+        "DELETE FROM center_daily_stats",
+        """INSERT INTO center_daily_stats (center_id, day, visits, sales, revenue)
+            SELECT center_id, day, SUM(visits), SUM(sales), SUM(revenue) FROM (
+                SELECT center_id, date(visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue
+                FROM visits
+                WHERE center_id IS NOT NULL
+                GROUP BY center_id, date(visited_at)
+                UNION ALL
+                SELECT center_id, date(activated_at), 0, COUNT(*), COALESCE(SUM(price_paid), 0)
+                FROM subscriptions
+                WHERE activated_at IS NOT NULL AND center_id IS NOT NULL
+                GROUP BY center_id, date(activated_at)
+            )
+            GROUP BY center_id, day""",
+    ]),
+    (10, "Аналитика по курсам и удержанию", [
+        """CREATE TABLE IF NOT EXISTS course_daily_stats (
+            center_id INTEGER NOT NULL,
+            course_id INTEGER NOT NULL,
+            day TEXT NOT NULL,
+            visits INTEGER NOT NULL DEFAULT 0,
+            sales INTEGER NOT NULL DEFAULT 0,
+            revenue INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (center_id, day, course_id)
+        ) WITHOUT ROWID""",
+        # Продления и использование занятий по дню покупки
+        "ALTER TABLE center_daily_stats ADD COLUMN renewals INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE center_daily_stats ADD COLUMN limited_sales INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE center_daily_stats ADD COLUMN lessons_bought INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE center_daily_stats ADD COLUMN lessons_used INTEGER NOT NULL DEFAULT 0",
+        # Проверка продления при активации: покупки клиента в центре
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_center_customer "
+        "ON subscriptions(center_id, user_id, child_id) WHERE activated_at IS NOT NULL",
+        # Оценка пропусков: активные абонементы и недавние посещения читаются только из индексов
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_center_active_lessons "
+        "ON subscriptions(center_id, activated_at, tariff, lessons_remaining) WHERE status = 'active'",
+        "CREATE INDEX IF NOT EXISTS idx_visits_center_visited_subscription "
+        "ON visits(center_id, visited_at, subscription_id)",
+        "DROP INDEX IF EXISTS idx_visits_center_visited",
+        # Пересчёт дневной статистики с новыми колонками (копия CENTER_DAILY_STATS_REBUILD
+        # и COURSE_DAILY_STATS_REBUILD на момент миграции: применённые миграции не меняются)
+        "DELETE FROM center_daily_stats",
+        """INSERT INTO center_daily_stats (center_id, day, visits, sales, revenue,
+                                           renewals, limited_sales, lessons_bought, lessons_used)
+            SELECT center_id, day, SUM(visits), SUM(sales), SUM(revenue),
+                   SUM(renewals), SUM(limited_sales), SUM(lessons_bought), SUM(lessons_used)
+            FROM (
+                SELECT center_id, date(visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue,
+                       0 as renewals, 0 as limited_sales, 0 as lessons_bought, 0 as lessons_used
+                FROM visits
+                WHERE center_id IS NOT NULL
+                GROUP BY center_id, date(visited_at)
+                UNION ALL
+                SELECT center_id, date(activated_at), 0, COUNT(*), COALESCE(SUM(price_paid), 0),
+                       SUM(previous_at IS NOT NULL),
+                       SUM(tariff != 'unlimited'),
+                       SUM(CASE WHEN tariff != 'unlimited' THEN lessons_total ELSE 0 END),
+                       SUM(CASE WHEN tariff != 'unlimited' THEN lessons_total - lessons_remaining ELSE 0 END)
+                FROM (
+                    SELECT center_id, activated_at, price_paid, tariff, lessons_total, lessons_remaining,
+                           LAG(activated_at) OVER (
+                               PARTITION BY center_id, user_id, child_id ORDER BY activated_at
+                           ) as previous_at
+                    FROM subscriptions
+                    WHERE activated_at IS NOT NULL AND center_id IS NOT NULL
+                )
+                GROUP BY center_id, date(activated_at)
+            )
+            GROUP BY center_id, day""",
+        "DELETE FROM course_daily_stats",
+        """INSERT INTO course_daily_stats (center_id, course_id, day, visits, sales, revenue)
+            SELECT center_id, course_id, day, SUM(visits), SUM(sales), SUM(revenue) FROM (
+                SELECT v.center_id, s.course_id, date(v.visited_at) as day, COUNT(*) as visits, 0 as sales, 0 as revenue
+                FROM visits v
+                JOIN subscriptions s ON v.subscription_id = s.subscription_id
+                WHERE v.center_id IS NOT NULL AND s.course_id IS NOT NULL
+                GROUP BY v.center_id, s.course_id, date(v.visited_at)
+                UNION ALL
+                SELECT center_id, course_id, date(activated_at), 0, COUNT(*), COALESCE(SUM(price_paid), 0)
+                FROM subscriptions
+                WHERE activated_at IS NOT NULL AND center_id IS NOT NULL AND course_id IS NOT NULL
+                GROUP BY center_id, course_id, date(activated_at)
+            )
+            GROUP BY center_id, course_id, day""",
+    ]),
+    (11, "Индекс неактивированных абонементов для досверки оплат", [
+        # Оплаченные, но не активированные абонементы (активация упала после коммита платежа)
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_unactivated "
+        "ON subscriptions(subscription_id) WHERE activated_at IS NULL",
+    ]),
+]
+
+
+# Один пул и один набор кэшей на файл базы: модули handlers создают собственные экземпляры Database
+_pools: Dict[str, ConnectionPool] = {}
+_caches: Dict[str, Dict[str, AsyncTTLCache]] = {}
+
+
+def _filters_key(filters: dict = None) -> tuple:
+    return tuple(sorted((k, v) for k, v in (filters or {}).items() if v is not None))
 
 
 class Database:
     def __init__(self, db_path: str = DATABASE_PATH):
         self.db_path = db_path
+        if db_path not in _pools:
+            _pools[db_path] = ConnectionPool(db_path)
+        self.pool = _pools[db_path]
+        
+        if db_path not in _caches:
+            _caches[db_path] = {
+                "courses": AsyncTTLCache(CACHE_MAX_SIZE, CACHE_TTL),
+                "centers": AsyncTTLCache(CACHE_MAX_SIZE, CACHE_TTL),
+                "catalog": AsyncTTLCache(CACHE_MAX_SIZE, CATALOG_CACHE_TTL),
+                "users": AsyncTTLCache(CACHE_MAX_SIZE, USER_CACHE_TTL),
+            }
+        self.course_cache = _caches[db_path]["courses"]
+        self.center_cache = _caches[db_path]["centers"]
+        self.catalog_cache = _caches[db_path]["catalog"]
+        self.user_cache = _caches[db_path]["users"]
+
+    def cache_stats(self) -> Dict[str, dict]:
+        """Счётчики попаданий и промахов кэшей"""
+        return {name: cache.stats() for name, cache in _caches[self.db_path].items()}
+
+    def invalidate_courses(self, course_id: int = None):
+        """Сбрасывает кэш курсов (одного или всех) и страницы каталога"""
+        if course_id is None:
+            self.course_cache.clear()
+        else:
+            self.course_cache.invalidate(course_id)
+        self.catalog_cache.clear()
+
+    async def close(self):
+        """Закрытие соединений с базой данных"""
+        await self.pool.close()
 
     async def init_db(self):
         """Инициализация базы данных"""
-        async with aiosqlite.connect(self.db_path) as db:
+        try:
+            await self.pool.open()
+            await self.apply_storage_profile()
+            await self._create_tables()
+            await self.migrate()
+        except BaseException:
+            # Потоки aiosqlite не демонические: с открытым пулом процесс не завершится после ошибки
+            await self.close()
+            raise
+
+    async def _create_tables(self):
+        """Таблицы исходной схемы (существующие не меняются, их дополняют миграции)"""
+        async with self.pool.writer() as db:
             # Пользователи
             await db.execute(f"""
                 CREATE TABLE IF NOT EXISTS users (
@@ -176,61 +707,107 @@ class Database:
                 )
             """)
 
-            await db.commit()
+            # Версия схемы
+            await db.execute("""
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+                )
+            """)
+
+    async def migrate(self):
+        """
+        Применяет недостающие миграции схемы (повторный запуск безопасен)
+        
+        Выражения миграции и запись её номера выполняются в одной транзакции:
+        sqlite3 сам не открывает транзакцию перед DDL, и без BEGIN упавшая
+        миграция оставила бы часть изменений без записи в schema_version.
+        """
+        for version, description, statements in MIGRATIONS:
+            async with self.pool.transaction() as db:
+                async with db.execute(
+                    "SELECT 1 FROM schema_version WHERE version = ?", (version,)
+                ) as cursor:
+                    if await cursor.fetchone():
+                        continue
+                
+                for statement in statements:
+                    if callable(statement):
+                        await statement(db)
+                    else:
+                        await db.execute(statement)
+                await db.execute(
+                    "INSERT INTO schema_version (version, description) VALUES (?, ?)",
+                    (version, description)
+                )
+
+    async def get_schema_version(self) -> int:
+        async with self.pool.reader() as db:
+            async with db.execute("SELECT MAX(version) FROM schema_version") as cursor:
+                row = await cursor.fetchone()
+                return row[0] or 0
+
+    async def apply_storage_profile(self):
+        """Переключает режим журнала базы согласно профилю хранилища"""
+        journal_mode = self.pool.profile.get("journal_mode")
+        if not journal_mode:
+            return
+        async with self.pool.writer() as db:
+            await db.execute(f"PRAGMA journal_mode = {journal_mode}")
 
     # Методы для работы с пользователями
     async def get_user(self, user_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        return await self.user_cache.get_or_load(user_id, lambda: self._fetch_user(user_id))
+
+    async def _fetch_user(self, user_id: int):
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM users WHERE user_id = ?", (user_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def create_user(self, user_id: int, username: str = None, full_name: str = None, role: str = ROLE_USER):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("""
                 INSERT OR IGNORE INTO users (user_id, username, full_name, role)
                 VALUES (?, ?, ?, ?)
             """, (user_id, username, full_name, role))
-            await db.commit()
+        self.user_cache.invalidate(user_id)
 
     async def update_user_role(self, user_id: int, role: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("UPDATE users SET role = ? WHERE user_id = ?", (role, user_id))
-            await db.commit()
+        self.user_cache.invalidate(user_id)
 
     async def update_user_city(self, user_id: int, city: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("UPDATE users SET city = ? WHERE user_id = ?", (city, user_id))
-            await db.commit()
+        self.user_cache.invalidate(user_id)
 
     # Методы для работы с детьми
     async def add_child(self, parent_id: int, name: str, age: int):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO children (parent_id, name, age)
                 VALUES (?, ?, ?)
             """, (parent_id, name, age))
-            await db.commit()
             return cursor.lastrowid
 
     async def get_children(self, parent_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM children WHERE parent_id = ?", (parent_id,)) as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def get_child(self, child_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM children WHERE child_id = ?", (child_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     # Методы для работы с центрами
     async def create_center(self, partner_id: int, data: dict):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO centers (partner_id, name, city, address, phone, category, description, logo, status)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
@@ -245,12 +822,10 @@ class Database:
                 data.get("logo"),
                 data.get("status", STATUS_PENDING)
             ))
-            await db.commit()
             return cursor.lastrowid
 
     async def get_centers(self, city: str = None, category: str = None, status: str = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             query = "SELECT * FROM centers WHERE 1=1"
             params = []
             
@@ -269,20 +844,25 @@ class Database:
                 return [dict(row) for row in rows]
 
     async def get_center(self, center_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        return await self.center_cache.get_or_load(("id", center_id), lambda: self._fetch_center(center_id))
+
+    async def _fetch_center(self, center_id: int):
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM centers WHERE center_id = ?", (center_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def update_center_status(self, center_id: int, status: str):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             await db.execute("UPDATE centers SET status = ? WHERE center_id = ?", (status, center_id))
-            await db.commit()
+        
+        # Центр кэшируется по id и по партнёру, а его поля входят в строки курсов
+        self.center_cache.clear()
+        self.invalidate_courses()
 
     # Методы для работы с курсами
     async def create_course(self, center_id: int, data: dict):
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO courses (center_id, name, description, category, age_min, age_max, requirements, 
                                    schedule, price_4, price_8, price_unlimited, photo)
@@ -301,40 +881,126 @@ class Database:
                 data.get("price_unlimited"),
                 data.get("photo")
             ))
-            await db.commit()
-            return cursor.lastrowid
+        
+        self.invalidate_courses(cursor.lastrowid)
+        return cursor.lastrowid
+
+    @staticmethod
+    def _course_filters(city: str = None, category: str = None, age: int = None,
+                        price_min: int = None, price_max: int = None, min_rating: float = None):
+        """Условия каталога для запросов к courses c JOIN centers ce"""
+        conditions = ["ce.status = 'approved'"]
+        params = []
+        
+        if city:
+            conditions.append("ce.city = ?")
+            params.append(city)
+        if category:
+            conditions.append("c.category = ?")
+            params.append(category)
+        if age:
+            # Пустое или нулевое ограничение возраста означает «без ограничения»
+            conditions.append("(c.age_min IS NULL OR c.age_min <= ?)")
+            conditions.append("(c.age_max IS NULL OR c.age_max = 0 OR c.age_max >= ?)")
+            params.extend([age, age])
+        if price_min is not None:
+            conditions.append("c.price_8 >= ?")
+            params.append(price_min)
+        if price_max is not None:
+            conditions.append("c.price_8 <= ?")
+            params.append(price_max)
+        if min_rating:
+            conditions.append("c.rating >= ?")
+            params.append(min_rating)
+        
+        return " AND ".join(conditions), params
 
-    async def get_courses(self, city: str = None, category: str = None, age: int = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            query = """
+    async def get_courses(self, city: str = None, category: str = None, age: int = None,
+                          price_min: int = None, price_max: int = None, min_rating: float = None):
+        where, params = self._course_filters(city, category, age, price_min, price_max, min_rating)
+        async with self.pool.reader() as db:
+            query = f"""
                 SELECT c.*, ce.name as center_name, ce.address, ce.city, ce.phone
                 FROM courses c
                 JOIN centers ce ON c.center_id = ce.center_id
-                WHERE ce.status = 'approved' AND 1=1
+                WHERE {where}
             """
-            params = []
-            
-            if city:
-                query += " AND ce.city = ?"
-                params.append(city)
-            if category:
-                query += " AND c.category = ?"
-                params.append(category)
             
             async with db.execute(query, params) as cursor:
                 rows = await cursor.fetchall()
-                courses = [dict(row) for row in rows]
-                # Фильтрация по возрасту на уровне Python
-                if age:
-                    courses = [c for c in courses if 
-                              (not c.get("age_min") or c["age_min"] <= age) and
-                              (not c.get("age_max") or c["age_max"] >= age)]
-                return courses
+                return [dict(row) for row in rows]
+
+    async def count_courses(self, filters: dict = None) -> int:
+        return await self.catalog_cache.get_or_load(
+            ("count", _filters_key(filters)),
+            lambda: self._fetch_courses_count(filters)
+        )
+
+    async def _fetch_courses_count(self, filters: dict = None) -> int:
+        where, params = self._course_filters(**(filters or {}))
+        async with self.pool.reader() as db:
+            async with db.execute(f"""
+                SELECT COUNT(*)
+                FROM courses c
+                JOIN centers ce ON c.center_id = ce.center_id
+                WHERE {where}
+            """, params) as cursor:
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+
+    async def get_courses_page(self, filters: dict = None, cursor: tuple = None, limit: int = 5):
+        """
+        Страница каталога с keyset-пагинацией по (rating, course_id) в порядке убывания
+        
+        Args:
+            filters: Фильтры каталога (city, category, age, price_min, price_max, min_rating)
+            cursor: (direction, rating, course_id) граничного курса; direction "next" —
+                курсы после него, "prev" — курсы перед ним. None — первая страница
+            limit: Количество курсов на странице
+        
+        Returns:
+            Tuple (courses, has_more) — has_more показывает, есть ли ещё курсы
+            дальше в направлении движения
+        """
+        return await self.catalog_cache.get_or_load(
+            ("page", _filters_key(filters), cursor, limit),
+            lambda: self._fetch_courses_page(filters, cursor, limit)
+        )
+
+    async def _fetch_courses_page(self, filters: dict = None, cursor: tuple = None, limit: int = 5):
+        where, params = self._course_filters(**(filters or {}))
+        order = "DESC"
+        
+        if cursor:
+            direction, rating, course_id = cursor
+            if direction == "prev":
+                where += " AND (c.rating, c.course_id) > (?, ?)"
+                order = "ASC"
+            else:
+                where += " AND (c.rating, c.course_id) < (?, ?)"
+            params = params + [rating, course_id]
+        
+        async with self.pool.reader() as db:
+            async with db.execute(f"""
+                SELECT c.*, ce.name as center_name, ce.address, ce.city, ce.phone
+                FROM courses c
+                JOIN centers ce ON c.center_id = ce.center_id
+                WHERE {where}
+                ORDER BY c.rating {order}, c.course_id {order}
+                LIMIT ?
+            """, params + [limit + 1]) as db_cursor:
+                rows = await db_cursor.fetchall()
+        
+        courses = [dict(row) for row in rows[:limit]]
+        if order == "ASC":
+            courses.reverse()
+        return courses, len(rows) > limit
 
     async def get_course(self, course_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        return await self.course_cache.get_or_load(course_id, lambda: self._fetch_course(course_id))
+
+    async def _fetch_course(self, course_id: int):
+        async with self.pool.reader() as db:
             async with db.execute("""
                 SELECT c.*, ce.name as center_name, ce.address, ce.city, ce.phone
                 FROM courses c
@@ -344,26 +1010,63 @@ class Database:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
+    async def update_course_rating(self, course_id: int, rating: float):
+        async with self.pool.writer() as db:
+            await db.execute("UPDATE courses SET rating = ? WHERE course_id = ?", (rating, course_id))
+        
+        self.invalidate_courses(course_id)
+
     # Методы для работы с абонементами
-    async def create_subscription(self, user_id: int, course_id: int, tariff: str, qr_code: str, child_id: int = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем данные курса
-            course = await self.get_course(course_id)
-            if not course:
-                return None
-            
-            # Определяем количество занятий и цену
-            tariff_map = {
-                "4": (4, course.get("price_4", 0)),
-                "8": (8, course.get("price_8", 0)),
-                "unlimited": (999, course.get("price_unlimited", 0))
-            }
-            lessons_total, price = tariff_map.get(tariff, (4, 0))
+    @staticmethod
+    def purchase_key(user_id: int, course_id: int, tariff: str, child_id: int = None) -> str:
+        """Ключ идемпотентности покупки: один абонемент на пользователя, ребёнка, курс и тариф"""
+        return f"{user_id}:{child_id or ''}:{course_id}:{tariff}"
+
+    async def create_subscription(self, user_id: int, course_id: int, tariff: str, qr_code: str, child_id: int = None,
+                                  idempotency_key: Optional[str] = None, currency: str = "KZT"):
+        """
+        Создаёт абонемент
+        
+        Повторный вызов с тем же ключом (по умолчанию purchase_key) в течение
+        IDEMPOTENCY_WINDOW секунд возвращает ещё не активированный и не оплаченный абонемент,
+        созданный первым вызовом, — двойное нажатие на тариф не создаёт дубликат.
+        """
+        # Получаем данные курса
+        course = await self.get_course(course_id)
+        if not course:
+            return None
+        
+        # Определяем количество занятий и цену
+        tariff_map = {
+            "4": (4, course.get("price_4", 0)),
+            "8": (8, course.get("price_8", 0)),
+            "unlimited": (999, course.get("price_unlimited", 0))
+        }
+        lessons_total, price = tariff_map.get(tariff, (4, 0))
+        
+        key = idempotency_key or self.purchase_key(user_id, course_id, tariff, child_id)
+        
+        # Проверка и вставка в одной транзакции BEGIN IMMEDIATE: параллельные вызовы не разойдутся
+        async with self.pool.transaction() as db:
+            async with db.execute("""
+                SELECT s.subscription_id FROM subscriptions s
+                WHERE s.idempotency_key = ? AND s.purchased_at >= datetime('now', ?)
+                  AND s.status = 'active' AND s.activated_at IS NULL
+                  AND NOT EXISTS (
+                      SELECT 1 FROM payments p WHERE p.subscription_id = s.subscription_id AND p.status = 'success'
+                  )
+                ORDER BY s.purchased_at DESC
+                LIMIT 1
+            """, (key, f"-{int(IDEMPOTENCY_WINDOW)} seconds")) as cursor:
+                row = await cursor.fetchone()
+            if row:
+                return row["subscription_id"]
             
             cursor = await db.execute("""
                 INSERT INTO subscriptions (user_id, child_id, course_id, center_id, tariff, 
-                                         lessons_total, lessons_remaining, qr_code, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active')
+                                         lessons_total, lessons_remaining, qr_code, status, idempotency_key,
+                                         price_paid, currency)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'active', ?, ?, ?)
             """, (
                 user_id,
                 child_id,
@@ -372,14 +1075,15 @@ class Database:
                 tariff,
                 lessons_total,
                 lessons_total,
-                qr_code
+                qr_code,
+                key,
+                price,
+                currency
             ))
-            await db.commit()
             return cursor.lastrowid
 
     async def get_user_subscriptions(self, user_id: int, child_id: int = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             if child_id:
                 query = """
                     SELECT s.*, c.name as course_name, ce.name as center_name
@@ -403,9 +1107,94 @@ class Database:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
+    async def get_subscription(self, subscription_id: int, user_id: int = None):
+        async with self.pool.reader() as db:
+            if user_id:
+                query = "SELECT * FROM subscriptions WHERE subscription_id = ? AND user_id = ?"
+                params = (subscription_id, user_id)
+            else:
+                query = "SELECT * FROM subscriptions WHERE subscription_id = ?"
+                params = (subscription_id,)
+            
+            async with db.execute(query, params) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def update_subscription_qr(self, subscription_id: int, qr_code: str):
+        # При смене QR-кода сохранённое в Telegram изображение больше не подходит
+        async with self.pool.writer() as db:
+            await db.execute(
+                "UPDATE subscriptions SET qr_code = ?, qr_file_id = NULL WHERE subscription_id = ?",
+                (qr_code, subscription_id)
+            )
+
+    async def activate_subscription(self, subscription_id: int, qr_code: str):
+        """
+        Выдаёт постоянный QR-код оплаченному абонементу (в том числе отменённому из-за долгой оплаты)
+        
+        Первая активация учитывается как продажа в center_daily_stats и course_daily_stats
+        той же транзакцией.
+        """
+        async with self.pool.transaction() as db:
+            async with db.execute("""
+                SELECT s.center_id, s.course_id, s.activated_at, s.price_paid,
+                       s.tariff != 'unlimited' as limited,
+                       CASE WHEN s.tariff != 'unlimited' THEN s.lessons_total ELSE 0 END as lessons_bought,
+                       CASE WHEN s.tariff != 'unlimited' THEN s.lessons_total - s.lessons_remaining ELSE 0 END
+                           as lessons_used,
+                       EXISTS (
+                           SELECT 1 FROM subscriptions p
+                           WHERE p.center_id = s.center_id AND p.user_id = s.user_id AND p.child_id IS s.child_id
+                             AND p.activated_at IS NOT NULL AND p.subscription_id != s.subscription_id
+                       ) as renewal
+                FROM subscriptions s
+                WHERE s.subscription_id = ?
+            """, (subscription_id,)) as cursor:
+                sub = await cursor.fetchone()
+            
+            await db.execute("""
+                UPDATE subscriptions
+                SET qr_code = ?, qr_file_id = NULL, status = 'active',
+                    activated_at = COALESCE(activated_at, CURRENT_TIMESTAMP)
+                WHERE subscription_id = ?
+            """, (qr_code, subscription_id))
+            
+            if sub and sub["activated_at"] is None:
+                price = sub["price_paid"] or 0
+                await db.execute("""
+                    INSERT INTO center_daily_stats (center_id, day, sales, revenue, renewals,
+                                                    limited_sales, lessons_bought, lessons_used)
+                    VALUES (?, date('now'), 1, ?, ?, ?, ?, ?)
+                    ON CONFLICT(center_id, day) DO UPDATE SET
+                        sales = sales + 1,
+                        revenue = revenue + excluded.revenue,
+                        renewals = renewals + excluded.renewals,
+                        limited_sales = limited_sales + excluded.limited_sales,
+                        lessons_bought = lessons_bought + excluded.lessons_bought,
+                        lessons_used = lessons_used + excluded.lessons_used
+                """, (sub["center_id"], price, sub["renewal"], sub["limited"],
+                      sub["lessons_bought"], sub["lessons_used"]))
+                await db.execute("""
+                    INSERT INTO course_daily_stats (center_id, course_id, day, sales, revenue)
+                    VALUES (?, ?, date('now'), 1, ?)
+                    ON CONFLICT(center_id, day, course_id) DO UPDATE SET
+                        sales = sales + 1, revenue = revenue + excluded.revenue
+                """, (sub["center_id"], sub["course_id"], price))
+
+    async def set_subscription_qr_file_id(self, subscription_id: int, qr_code: str, file_id: Optional[str]):
+        """Сохраняет file_id отправленного QR, если QR-код абонемента не сменился за это время"""
+        async with self.pool.writer() as db:
+            await db.execute(
+                "UPDATE subscriptions SET qr_file_id = ? WHERE subscription_id = ? AND qr_code = ?",
+                (file_id, subscription_id, qr_code)
+            )
+
+    async def delete_subscription(self, subscription_id: int):
+        async with self.pool.writer() as db:
+            await db.execute("DELETE FROM subscriptions WHERE subscription_id = ?", (subscription_id,))
+
     async def get_subscription_by_qr(self, qr_code: str):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("""
                 SELECT s.*, c.name as course_name, ce.name as center_name, 
                        u.user_id as owner_id, ch.name as child_name, ch.age as child_age
@@ -420,43 +1209,64 @@ class Database:
                 return dict(row) if row else None
 
     async def record_visit(self, subscription_id: int, center_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            # Получаем данные абонемента
-            db.row_factory = aiosqlite.Row
-            async with db.execute("SELECT * FROM subscriptions WHERE subscription_id = ?", (subscription_id,)) as cursor:
+        """
+        Атомарно списывает занятие и записывает посещение
+        
+        Returns:
+            dict (user_id, child_id, tariff, lessons_remaining) с новым остатком
+            или None, если абонемент неактивен или занятия закончились
+        """
+        async with self.pool.transaction() as db:
+            # Списываем занятие только при положительном остатке (безлимит не списывается);
+            # в SET справа — значения до обновления
+            async with db.execute("""
+                UPDATE subscriptions
+                SET lessons_remaining = CASE
+                        WHEN tariff = 'unlimited' THEN lessons_remaining
+                        ELSE lessons_remaining - 1
+                    END,
+                    status = CASE
+                        WHEN tariff != 'unlimited' AND lessons_remaining <= 1 THEN 'expired'
+                        ELSE status
+                    END
+                WHERE subscription_id = ? AND status = 'active'
+                  AND (tariff = 'unlimited' OR lessons_remaining > 0)
+                RETURNING user_id, child_id, course_id, center_id as subscription_center_id, activated_at,
+                          tariff, lessons_remaining
+            """, (subscription_id,)) as cursor:
                 sub = await cursor.fetchone()
-                if not sub:
-                    return False
+            
+            if not sub:
+                return None
             
             sub = dict(sub)
+            sub_center_id = sub.pop("subscription_center_id")
+            activated_at = sub.pop("activated_at")
             
             # Записываем посещение
             await db.execute("""
                 INSERT INTO visits (subscription_id, user_id, child_id, center_id)
                 VALUES (?, ?, ?, ?)
-            """, (subscription_id, sub.get("user_id"), sub.get("child_id"), center_id))
-            
-            # Уменьшаем количество оставшихся занятий (если не безлимит)
-            if sub["tariff"] != "unlimited":
-                await db.execute("""
-                    UPDATE subscriptions 
-                    SET lessons_remaining = lessons_remaining - 1
-                    WHERE subscription_id = ?
-                """, (subscription_id,))
-                
-                # Если занятия закончились, деактивируем абонемент
+            """, (subscription_id, sub["user_id"], sub["child_id"], center_id))
+            await db.execute("""
+                INSERT INTO center_daily_stats (center_id, day, visits) VALUES (?, date('now'), 1)
+                ON CONFLICT(center_id, day) DO UPDATE SET visits = visits + 1
+            """, (center_id,))
+            await db.execute("""
+                INSERT INTO course_daily_stats (center_id, course_id, day, visits) VALUES (?, ?, date('now'), 1)
+                ON CONFLICT(center_id, day, course_id) DO UPDATE SET visits = visits + 1
+            """, (center_id, sub["course_id"]))
+            # Использованное занятие относится ко дню покупки абонемента
+            if sub["tariff"] != "unlimited" and activated_at:
                 await db.execute("""
-                    UPDATE subscriptions 
-                    SET status = 'expired'
-                    WHERE subscription_id = ? AND lessons_remaining <= 0
-                """, (subscription_id,))
+                    INSERT INTO center_daily_stats (center_id, day, lessons_used) VALUES (?, date(?), 1)
+                    ON CONFLICT(center_id, day) DO UPDATE SET lessons_used = lessons_used + 1
+                """, (sub_center_id, activated_at))
             
-            await db.commit()
-            return True
+            return sub
 
     async def get_visit_stats(self, user_id: int, child_id: int = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             
             if child_id:
                 # Статистика для ребёнка
@@ -487,15 +1297,19 @@ class Database:
 
     # Методы для партнёров
     async def get_partner_center(self, partner_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        return await self.center_cache.get_or_load(
+            ("partner", partner_id),
+            lambda: self._fetch_partner_center(partner_id)
+        )
+
+    async def _fetch_partner_center(self, partner_id: int):
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM centers WHERE partner_id = ?", (partner_id,)) as cursor:
                 row = await cursor.fetchone()
                 return dict(row) if row else None
 
     async def get_center_students(self, center_id: int):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("""
                 SELECT DISTINCT 
                     s.user_id, s.child_id, u.full_name, ch.name as child_name,
@@ -509,68 +1323,217 @@ class Database:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
-    async def get_center_analytics(self, center_id: int, month: int = None, year: int = None):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
-            
-            # Посещения
-            visits_query = """
-                SELECT COUNT(*) as visits_count
-                FROM visits
-                WHERE center_id = ?
-            """
-            visits_params = (center_id,)
-            
-            if month and year:
-                visits_query += " AND strftime('%m', visited_at) = ? AND strftime('%Y', visited_at) = ?"
-                visits_params = (center_id, f"{month:02d}", str(year))
-            
-            async with db.execute(visits_query, visits_params) as cursor:
-                visits_row = await cursor.fetchone()
-                visits_count = visits_row["visits_count"] if visits_row else 0
-            
-            # Продажи абонементов
-            sales_query = """
-                SELECT COUNT(*) as sales_count, SUM(
-                    CASE 
-                        WHEN tariff = '4' THEN price_4
-                        WHEN tariff = '8' THEN price_8
-                        WHEN tariff = 'unlimited' THEN price_unlimited
-                        ELSE 0
-                    END
-                ) as total_revenue
-                FROM subscriptions s
-                JOIN courses c ON s.course_id = c.course_id
-                WHERE s.center_id = ?
-            """
-            sales_params = (center_id,)
-            
-            if month and year:
-                sales_query += " AND strftime('%m', purchased_at) = ? AND strftime('%Y', purchased_at) = ?"
-                sales_params = (center_id, f"{month:02d}", str(year))
-            
-            async with db.execute(sales_query, sales_params) as cursor:
-                sales_row = await cursor.fetchone()
-                sales_count = sales_row["sales_count"] if sales_row else 0
-                total_revenue = sales_row["total_revenue"] if sales_row else 0
+    @staticmethod
+    def month_range(year: int, month: int) -> tuple:
+        """Полуоткрытый интервал [начало месяца, начало следующего) для аналитики"""
+        start = datetime(year, month, 1)
+        end = datetime(year + month // 12, month % 12 + 1, 1)
+        return start, end
+
+    @staticmethod
+    def _timestamp(value) -> str:
+        # Метки времени в базе — TEXT 'YYYY-MM-DD HH:MM:SS' (CURRENT_TIMESTAMP, UTC):
+        # сравниваем их со строками того же формата, чтобы работали индексы
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d %H:%M:%S")
+        return value
+
+    @staticmethod
+    def _day(value) -> str:
+        # День 'YYYY-MM-DD' (UTC, как CURRENT_TIMESTAMP в базе)
+        if isinstance(value, datetime):
+            return value.strftime("%Y-%m-%d")
+        return value[:10]
+
+    async def get_center_analytics(self, center_id: Optional[int], start=None, end=None):
+        """
+        Посещения, продажи и доход центра за период [start, end) (datetime или строка в UTC)
+        
+        Читает дневную сводку center_daily_stats, поэтому границы берутся
+        с точностью до дня. Без границ — за всё время, center_id=None —
+        по всем центрам.
+        """
+        conditions, params = [], []
+        if center_id is not None:
+            conditions.append("center_id = ?")
+            params.append(center_id)
+        if start is not None:
+            conditions.append("day >= ?")
+            params.append(self._day(start))
+        if end is not None:
+            conditions.append("day < ?")
+            params.append(self._day(end))
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+        
+        async with self.pool.reader() as db:
+            async with db.execute(f"""
+                SELECT COALESCE(SUM(visits), 0) as visits_count,
+                       COALESCE(SUM(sales), 0) as sales_count,
+                       COALESCE(SUM(revenue), 0) as total_revenue
+                FROM center_daily_stats
+                {where}
+            """, params) as cursor:
+                row = await cursor.fetchone()
             
             return {
-                "visits_count": visits_count,
-                "sales_count": sales_count,
-                "total_revenue": total_revenue or 0
+                "visits_count": row["visits_count"],
+                "sales_count": row["sales_count"],
+                "total_revenue": row["total_revenue"]
             }
 
+    async def get_center_sales(self, center_id: int, start=None, end=None):
+        """
+        Продажи и выручка центра за [start, end) с точностью до секунды
+        
+        Считается по цене покупки из индекса (center_id, activated_at, price_paid),
+        без обращения к таблицам абонементов и курсов.
+        """
+        start = self._timestamp(start) if start is not None else "0000-01-01 00:00:00"
+        end = self._timestamp(end) if end is not None else "9999-12-31 23:59:59"
+        async with self.pool.reader() as db:
+            async with db.execute("""
+                SELECT COUNT(*) as sales_count, COALESCE(SUM(price_paid), 0) as total_revenue
+                FROM subscriptions
+                WHERE center_id = ? AND activated_at >= ? AND activated_at < ?
+            """, (center_id, start, end)) as cursor:
+                row = await cursor.fetchone()
+                return dict(row)
+
+    # Группировка дней сводки: неделя начинается с понедельника
+    SERIES_BUCKETS = {
+        "day": "day",
+        "week": "date(day, '-6 days', 'weekday 1')",
+        "month": "substr(day, 1, 7)",
+    }
+
+    async def get_center_series(self, center_id: int, start, end, bucket: str = "day") -> List[dict]:
+        """Посещения, продажи и выручка центра по дням / неделям / месяцам за [start, end)"""
+        expression = self.SERIES_BUCKETS[bucket]
+        async with self.pool.reader() as db:
+            async with db.execute(f"""
+                SELECT {expression} as bucket, SUM(visits) as visits, SUM(sales) as sales, SUM(revenue) as revenue
+                FROM center_daily_stats
+                WHERE center_id = ? AND day >= ? AND day < ?
+                GROUP BY bucket
+                ORDER BY bucket
+            """, (center_id, self._day(start), self._day(end))) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_course_breakdown(self, center_id: int, start, end) -> List[dict]:
+        """Посещения, продажи и выручка по курсам центра за [start, end)"""
+        async with self.pool.reader() as db:
+            async with db.execute("""
+                SELECT st.course_id, c.name as course_name,
+                       SUM(st.visits) as visits, SUM(st.sales) as sales, SUM(st.revenue) as revenue
+                FROM course_daily_stats st
+                LEFT JOIN courses c ON st.course_id = c.course_id
+                WHERE st.center_id = ? AND st.day >= ? AND st.day < ?
+                GROUP BY st.course_id
+                ORDER BY revenue DESC, visits DESC
+            """, (center_id, self._day(start), self._day(end))) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_retention_metrics(self, center_id: int, start, end, dormant_since) -> dict:
+        """
+        Удержание клиентов центра
+        
+        По абонементам, активированным в [start, end) (с точностью до дня): сколько из них продления
+        (у того же клиента была более ранняя покупка в центре) и сколько
+        занятий в среднем использовано (тарифы с лимитом).
+        По активным абонементам — сколько не посещались с dormant_since
+        и сколько занятий на них осталось (оценка пропусков).
+        """
+        dormant_since = self._timestamp(dormant_since)
+        async with self.pool.reader() as db:
+            # Продления и использованные занятия ведутся в center_daily_stats по дню покупки
+            async with db.execute("""
+                SELECT COALESCE(SUM(sales), 0) as purchases,
+                       COALESCE(SUM(renewals), 0) as renewals,
+                       SUM(lessons_used) * 1.0 / NULLIF(SUM(limited_sales), 0) as avg_lessons_used,
+                       SUM(lessons_used) * 1.0 / NULLIF(SUM(lessons_bought), 0) as usage_share
+                FROM center_daily_stats
+                WHERE center_id = ? AND day >= ? AND day < ?
+            """, (center_id, self._day(start), self._day(end))) as cursor:
+                purchases = dict(await cursor.fetchone())
+            
+            # Пропадающие = активные, купленные до dormant_since, минус посещавшие с тех пор
+            async with db.execute("""
+                SELECT COUNT(*) as active,
+                       COALESCE(SUM(activated_at < ?), 0) as dormant,
+                       COALESCE(SUM(CASE WHEN activated_at < ? AND tariff != 'unlimited'
+                                         THEN lessons_remaining ELSE 0 END), 0) as dormant_lessons
+                FROM subscriptions
+                WHERE center_id = ? AND status = 'active' AND activated_at IS NOT NULL
+            """, (dormant_since, dormant_since, center_id)) as cursor:
+                active = dict(await cursor.fetchone())
+            
+            async with db.execute("""
+                SELECT COUNT(*) as seen,
+                       COALESCE(SUM(CASE WHEN tariff != 'unlimited' THEN lessons_remaining ELSE 0 END), 0) as seen_lessons
+                FROM subscriptions
+                WHERE center_id = ? AND status = 'active' AND activated_at < ?
+                  AND subscription_id IN (
+                      SELECT subscription_id FROM visits WHERE center_id = ? AND visited_at >= ?
+                  )
+            """, (center_id, dormant_since, center_id, dormant_since)) as cursor:
+                seen = await cursor.fetchone()
+            active["dormant"] -= seen["seen"]
+            active["dormant_lessons"] -= seen["seen_lessons"]
+        
+        return {**purchases, **active}
+
+    async def rebuild_center_daily_stats(self) -> int:
+        """
+        Пересчитывает center_daily_stats и course_daily_stats по истории посещений и продаж
+        
+        Returns:
+            число строк в center_daily_stats
+        """
+        async with self.pool.transaction() as db:
+            for statement in CENTER_DAILY_STATS_REBUILD + COURSE_DAILY_STATS_REBUILD:
+                await db.execute(statement)
+            async with db.execute("SELECT COUNT(*) FROM center_daily_stats") as cursor:
+                row = await cursor.fetchone()
+                return row[0]
+
+    def iter_export(self, kind: str, center_id: Optional[int] = None, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """
+        Строки выгрузки EXPORT_QUERIES[kind] порциями по chunk_size (все центры, если center_id не задан)
+        
+        Синхронный генератор для потока выгрузки: открывает своё соединение
+        только для чтения и читает курсор fetchmany, не загружая выборку целиком.
+        """
+        query = EXPORT_QUERIES[kind]
+        sql, params = query["sql"], ()
+        if center_id is None:
+            sql += f" ORDER BY {query['order']}"
+        else:
+            sql += f" WHERE {query['center']} = ? ORDER BY {query['center_order']}"
+            params = (center_id,)
+        
+        conn = sqlite3.connect(self.db_path)
+        try:
+            for name, value in STORAGE_PROFILE.items():
+                if name != "journal_mode":
+                    conn.execute(f"PRAGMA {name} = {value}")
+            conn.execute("PRAGMA query_only = 1")
+            cursor = conn.execute(sql, params)
+            while rows := cursor.fetchmany(chunk_size):
+                yield rows
+        finally:
+            conn.close()
+
     # Методы для админа
     async def get_pending_centers(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM centers WHERE status = 'pending'") as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
 
     async def get_all_users(self):
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute("SELECT * FROM users") as cursor:
                 rows = await cursor.fetchall()
                 return [dict(row) for row in rows]
@@ -579,22 +1542,32 @@ class Database:
     async def create_payment(self, user_id: int, subscription_id: int, amount: float, 
                            currency: str = "KZT", invoice_id: str = None, 
                            airba_payment_id: str = None, redirect_url: str = None, 
-                           status: str = "pending"):
+                           status: str = "pending", idempotency_key: str = None):
         """Создать платеж"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO payments (user_id, subscription_id, amount, currency, 
-                                    invoice_id, airba_payment_id, redirect_url, status)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                                    invoice_id, airba_payment_id, redirect_url, status, idempotency_key)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
             """, (user_id, subscription_id, amount, currency, invoice_id, 
-                  airba_payment_id, redirect_url, status))
-            await db.commit()
+                  airba_payment_id, redirect_url, status, idempotency_key))
             return cursor.lastrowid
 
+    async def get_pending_payment_by_key(self, idempotency_key: str, window: float = IDEMPOTENCY_WINDOW):
+        """Незавершённый платеж с тем же ключом идемпотентности, созданный не раньше window секунд назад"""
+        async with self.pool.reader() as db:
+            async with db.execute("""
+                SELECT * FROM payments
+                WHERE idempotency_key = ? AND created_at >= datetime('now', ?) AND status = 'pending'
+                ORDER BY created_at DESC
+                LIMIT 1
+            """, (idempotency_key, f"-{int(window)} seconds")) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
     async def get_payment(self, payment_id: int, user_id: int = None):
         """Получить платеж"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             if user_id:
                 async with db.execute(
                     "SELECT * FROM payments WHERE payment_id = ? AND user_id = ?",
@@ -613,7 +1586,7 @@ class Database:
     async def update_payment_status(self, payment_id: int, status: str, 
                                   transaction_id: str = None, error_message: str = None):
         """Обновить статус платежа"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             if status == "success":
                 await db.execute("""
                     UPDATE payments 
@@ -627,12 +1600,115 @@ class Database:
                     SET status = ?, transaction_id = ?, error_message = ?
                     WHERE payment_id = ?
                 """, (status, transaction_id, error_message, payment_id))
-            await db.commit()
+
+    async def get_payment_by_invoice(self, invoice_id: str = None, airba_payment_id: str = None):
+        """Платеж по invoice_id бота или по id платежа в AirbaPay"""
+        if invoice_id:
+            query, params = "SELECT * FROM payments WHERE invoice_id = ?", (invoice_id,)
+        elif airba_payment_id:
+            query, params = "SELECT * FROM payments WHERE airba_payment_id = ?", (airba_payment_id,)
+        else:
+            return None
+        
+        async with self.pool.reader() as db:
+            async with db.execute(query, params) as cursor:
+                row = await cursor.fetchone()
+                return dict(row) if row else None
+
+    async def finalize_payment(self, payment_id: int, status: str,
+                               transaction_id: str = None, error_message: str = None) -> bool:
+        """
+        Переводит платеж в итоговый статус, если он ещё не завершён
+        
+        Returns:
+            True только для вызова, который выполнил переход — повторные
+            уведомления и проверки статуса получают False
+        """
+        async with self.pool.writer() as db:
+            cursor = await db.execute("""
+                UPDATE payments
+                SET status = ?, transaction_id = ?, error_message = ?, processed_at = CURRENT_TIMESTAMP
+                WHERE payment_id = ? AND status NOT IN ('success', 'failed', 'refunded')
+            """, (status, transaction_id, error_message, payment_id))
+            return cursor.rowcount == 1
+
+    async def get_stale_pending_payments(self, older_than: float, limit: int = 50) -> List[Dict]:
+        """Самые старые pending-платежи старше older_than секунд (по idx_payments_pending); age — возраст в секундах"""
+        async with self.pool.reader() as db:
+            async with db.execute("""
+                SELECT *, CAST((julianday('now') - julianday(created_at)) * 86400 AS INTEGER) AS age
+                FROM payments
+                WHERE status = 'pending' AND created_at < datetime('now', ?)
+                ORDER BY created_at
+                LIMIT ?
+            """, (f"-{int(older_than)} seconds", limit)) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def get_unactivated_paid_payments(self, older_than: float, limit: int = 50) -> List[Dict]:
+        """
+        Успешные платежи старше older_than секунд, абонемент которых так и не активирован
+        
+        Платеж фиксируется как success до активации; если активация не удалась,
+        сверка повторяет её по этой выборке (по idx_subscriptions_unactivated).
+        """
+        async with self.pool.reader() as db:
+            async with db.execute("""
+                SELECT p.*
+                FROM subscriptions s
+                CROSS JOIN payments p  -- CROSS JOIN закрепляет порядок: от малого частичного индекса к платежам
+                WHERE s.activated_at IS NULL AND p.subscription_id = s.subscription_id
+                  AND p.status = 'success' AND p.processed_at < datetime('now', ?)
+                ORDER BY s.subscription_id
+                LIMIT ?
+            """, (f"-{int(older_than)} seconds", limit)) as cursor:
+                rows = await cursor.fetchall()
+                return [dict(row) for row in rows]
+
+    async def apply_payment_results(self, finalized: List[tuple], expired: List[int]) -> tuple[List[int], List[int]]:
+        """
+        Применяет результаты сверки платежей одной транзакцией
+        
+        Args:
+            finalized: (payment_id, status, transaction_id, error_message) с итоговыми статусами
+            expired: payment_id брошенных платежей — они получают статус expired,
+                     их временные абонементы отменяются
+        
+        Returns:
+            (payment_id, переведённые в итоговый статус; payment_id, помеченные expired) —
+            платежи, уже завершённые другим путём (уведомлением, проверкой), не входят
+        """
+        done, expired_done = [], []
+        async with self.pool.transaction() as db:
+            for payment_id, status, transaction_id, error_message in finalized:
+                cursor = await db.execute("""
+                    UPDATE payments
+                    SET status = ?, transaction_id = ?, error_message = ?, processed_at = CURRENT_TIMESTAMP
+                    WHERE payment_id = ? AND status NOT IN ('success', 'failed', 'refunded')
+                """, (status, transaction_id, error_message, payment_id))
+                if cursor.rowcount == 1:
+                    done.append(payment_id)
+            
+            for payment_id in expired:
+                async with db.execute("""
+                    UPDATE payments SET status = 'expired', processed_at = CURRENT_TIMESTAMP
+                    WHERE payment_id = ? AND status = 'pending'
+                    RETURNING subscription_id
+                """, (payment_id,)) as cursor:
+                    row = await cursor.fetchone()
+                if not row:
+                    continue
+                expired_done.append(payment_id)
+                # Временный абонемент так и не был оплачен
+                await db.execute(
+                    "UPDATE subscriptions SET status = 'cancelled' WHERE subscription_id = ? AND status = 'active'",
+                    (row["subscription_id"],)
+                )
+        return done, expired_done
 
     async def get_user_payments(self, user_id: int):
         """Получить все платежи пользователя"""
-        async with aiosqlite.connect(self.db_path) as db:
-            db.row_factory = aiosqlite.Row
+        async with self.pool.reader() as db:
             async with db.execute(
                 "SELECT * FROM payments WHERE user_id = ? ORDER BY created_at DESC",
                 (user_id,)
@@ -643,11 +1719,10 @@ class Database:
     async def create_payment_refund(self, payment_id: int, airba_refund_id: str, 
                                    ext_id: str, amount: float, reason: str, status: str):
         """Создать возврат платежа"""
-        async with aiosqlite.connect(self.db_path) as db:
+        async with self.pool.writer() as db:
             cursor = await db.execute("""
                 INSERT INTO payment_refunds (payment_id, airba_refund_id, ext_id, amount, reason, status)
                 VALUES (?, ?, ?, ?, ?, ?)
             """, (payment_id, airba_refund_id, ext_id, amount, reason, status))
-            await db.commit()
             return cursor.lastrowid
 
@@ -3,8 +3,9 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command
 
 from database import Database
-from utils.keyboards import get_admin_menu, get_moderation_keyboard
-from config import ROLE_ADMIN, STATUS_APPROVED, STATUS_REJECTED, ADMIN_IDS
+from utils.keyboards import get_admin_menu, get_moderation_keyboard, get_export_keyboard
+from services.export import EXPORT_FORMATS, start_export
+from config import ROLE_ADMIN, STATUS_APPROVED, STATUS_REJECTED, ADMIN_IDS, EXPORT_KINDS
 
 router = Router()
 db = Database()
@@ -149,8 +150,9 @@ async def admin_payments(message: Message):
         return
     
     await message.answer(
-        "💳 Управление платежами\n\n"
-        "Функция в разработке."
+        "💳 Выгрузка платежей по всем центрам\n\n"
+        "Выберите формат файла:",
+        reply_markup=get_export_keyboard("admin_export", ["payments"])
     )
 
 
@@ -161,11 +163,30 @@ async def admin_visits(message: Message):
         return
     
     await message.answer(
-        "📝 Логи посещений\n\n"
-        "Функция в разработке."
+        "📝 Выгрузка посещений по всем центрам\n\n"
+        "Выберите формат файла:",
+        reply_markup=get_export_keyboard("admin_export", ["visits"])
     )
 
 
+@router.callback_query(F.data.startswith("admin_export_"))
+async def admin_export(callback: CallbackQuery):
+    """Выгрузка посещений или платежей"""
+    if not is_admin(callback.from_user.id):
+        await callback.answer("Нет доступа", show_alert=True)
+        return
+    
+    kind, _, fmt = callback.data.replace("admin_export_", "").rpartition("_")
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        await callback.answer()
+        return
+    
+    if start_export(callback.bot, callback.message.chat.id, db, kind, fmt):
+        await callback.answer()
+    else:
+        await callback.answer("⏳ Предыдущая выгрузка ещё готовится.", show_alert=True)
+
+
 @router.message(F.text == "📢 Рассылки")
 async def admin_broadcast(message: Message):
     """Рассылки"""
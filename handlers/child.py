@@ -1,9 +1,11 @@
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, BufferedInputFile
 
 from database import Database
 from utils.keyboards import get_child_menu
-from utils.qr_generator import generate_qr_code
+from utils.qr_generator import render_qr_code
 from config import ROLE_CHILD
 
 router = Router()
@@ -11,7 +13,7 @@ db = Database()
 
 
 @router.message(F.text == "📷 Показать QR")
-async def show_qr(message: Message):
+async def show_qr(message: Message, db_user: Optional[dict] = None):
     """Показ QR-кода ребёнку"""
     # Для ребёнка нужно найти его абонементы
     # В реальном приложении здесь бы была связь между Telegram ID ребёнка и child_id в БД
@@ -19,8 +21,7 @@ async def show_qr(message: Message):
     
     # Получаем все активные абонементы ребёнка (через parent_id или другой механизм)
     # Для демо покажем сообщение об ошибке
-    user_id = message.from_user.id
-    user = await db.get_user(user_id)
+    user = db_user
     
     if not user or user.get("role") != ROLE_CHILD:
         await message.answer("Ошибка: ваш профиль не настроен как профиль ребёнка.")
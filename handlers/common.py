@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message
 from aiogram.filters import Command
@@ -33,7 +35,7 @@ async def cmd_cancel(message: Message, state: FSMContext):
 
 
 @router.message(Command("start"))
-async def cmd_start(message: Message, state: FSMContext):
+async def cmd_start(message: Message, state: FSMContext, db_user: Optional[dict] = None):
     """Обработчик команды /start"""
     import logging
     logger = logging.getLogger(__name__)
@@ -45,8 +47,8 @@ async def cmd_start(message: Message, state: FSMContext):
         username = message.from_user.username
         full_name = message.from_user.full_name or message.from_user.first_name
         
-        # Создаём или получаем пользователя
-        user = await db.get_user(user_id)
+        # Создаём пользователя, если middleware не нашёл его в БД
+        user = db_user
         if not user:
             await db.create_user(user_id, username, full_name)
             user = await db.get_user(user_id)
@@ -1,3 +1,5 @@
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, BufferedInputFile
 from aiogram.fsm.context import FSMContext
@@ -6,10 +8,13 @@ from aiogram.fsm.state import State, StatesGroup
 from database import Database
 from utils.keyboards import (
     get_parent_menu, get_children_keyboard, get_search_params_keyboard,
-    get_cities_keyboard, get_categories_keyboard, get_course_keyboard,
+    get_cities_keyboard, get_categories_keyboard,
     get_tariff_keyboard, get_course_detail_keyboard
 )
-from utils.qr_generator import generate_subscription_qr
+from utils.catalog import show_catalog_page
+from utils.qr_generator import render_subscription_qr
+from utils.qr_assets import remember_qr_file_id
+from middleware.outbound import Priority, send_priority
 from config import ROLE_PARENT
 
 router = Router()
@@ -157,37 +162,22 @@ async def parent_category_selected(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     city = data.get("city")
     
-    # Получаем курсы
-    courses = await db.get_courses(city=city, category=category)
+    filters = {
+        "city": city,
+        "category": category,
+        "age": data.get("age"),
+        "price_min": data.get("price_min"),
+        "price_max": data.get("price_max"),
+        "min_rating": data.get("min_rating")
+    }
+    
+    await state.update_data(catalog_filters=filters, catalog_cursor=None)
     
-    if not courses:
+    if not await show_catalog_page(callback, db, filters):
         await callback.message.edit_text(
             "😔 Курсов не найдено. Попробуй другие параметры.",
             reply_markup=get_search_params_keyboard()
         )
-        await callback.answer()
-        return
-    
-    # Показываем первые 5 курсов
-    text = f"Найдено курсов: {len(courses)}\n\n"
-    for course in courses[:5]:
-        center_name = course.get("center_name", "Не указано")
-        price_8 = course.get("price_8", 0)
-        rating = course.get("rating", 0)
-        address = course.get("address", "")
-        city_name = course.get("city", "")
-        
-        text += f"📘 Курс: {course['name']}\n"
-        text += f"🏫 {center_name}\n"
-        text += f"💰 Абонемент: 8 занятий — {price_8:,}₸\n"
-        text += f"⭐️ Рейтинг: {rating}\n"
-        text += f"📍 {city_name}, {address}\n\n"
-        
-        await callback.message.answer(
-            text,
-            reply_markup=get_course_keyboard(course["course_id"])
-        )
-        text = ""
     
     await callback.answer()
 
@@ -263,7 +253,7 @@ async def parent_buy_course(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("tariff_"), ParentStates.buying_for_child)
-async def parent_tariff_selected(callback: CallbackQuery, state: FSMContext):
+async def parent_tariff_selected(callback: CallbackQuery, state: FSMContext, db_user: Optional[dict] = None):
     """Обработка покупки абонемента для ребёнка"""
     parts = callback.data.split("_")
     course_id = int(parts[1])
@@ -302,26 +292,19 @@ async def parent_tariff_selected(callback: CallbackQuery, state: FSMContext):
     
     # Пытаемся создать платеж
     try:
-        from services.payment import AirbaPayClient, PaymentService
+        from services.payment import get_airba_client, PaymentService
         from config import (
-            AIRBA_PAY_BASE_URL, AIRBA_PAY_USER, AIRBA_PAY_PASSWORD,
-            AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_COMPANY_ID, AIRBA_PAY_WEBHOOK_URL
+            AIRBA_PAY_USER, AIRBA_PAY_PASSWORD, AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_WEBHOOK_URL
         )
         
         # Проверяем наличие настроек платежной системы
         if AIRBA_PAY_USER and AIRBA_PAY_PASSWORD and AIRBA_PAY_TERMINAL_ID and price > 0:
-            client = AirbaPayClient(
-                base_url=AIRBA_PAY_BASE_URL,
-                user=AIRBA_PAY_USER,
-                password=AIRBA_PAY_PASSWORD,
-                terminal_id=AIRBA_PAY_TERMINAL_ID,
-                company_id=AIRBA_PAY_COMPANY_ID
-            )
+            # Общий клиент: токен и соединения переиспользуются между запросами
+            client = get_airba_client()
             
             payment_service = PaymentService(client, db, AIRBA_PAY_WEBHOOK_URL)
             
-            user = await db.get_user(user_id)
-            phone = user.get("phone", "") if user else ""
+            phone = db_user.get("phone", "") if db_user else ""
             
             payment_result = await payment_service.create_payment(
                 user_id=user_id,
@@ -360,16 +343,10 @@ async def parent_tariff_selected(callback: CallbackQuery, state: FSMContext):
         pass
     
     # Если платежная система не настроена или цена = 0, создаём абонемент сразу
-    qr_id, qr_image = generate_subscription_qr(user_id, subscription_id, child_id)
-    
-    # Обновляем QR-код в базе данных
-    import aiosqlite
-    async with aiosqlite.connect(db.db_path) as db_conn:
-        await db_conn.execute(
-            "UPDATE subscriptions SET qr_code = ? WHERE subscription_id = ?",
-            (qr_id, subscription_id)
-        )
-        await db_conn.commit()
+    qr_id, qr_image = await render_subscription_qr(user_id, subscription_id, child_id)
+    
+    # Выдаём постоянный QR-код; абонемент учитывается как продажа
+    await db.activate_subscription(subscription_id, qr_id)
     
     # Отправляем родителю уведомление
     await callback.message.answer(
@@ -379,10 +356,11 @@ async def parent_tariff_selected(callback: CallbackQuery, state: FSMContext):
     
     try:
         qr_bytes = qr_image.getvalue()
-        await callback.message.answer_photo(
+        sent = await callback.message.answer_photo(
             photo=BufferedInputFile(qr_bytes, filename="qr_code.png"),
             caption=f"QR-код для {child['name']}"
         )
+        await remember_qr_file_id(db, subscription_id, qr_id, sent)
     except Exception:
         await callback.message.answer(
             f"QR-код создан!\nКод: {qr_id}\n\n"
@@ -403,18 +381,20 @@ async def children_attendance(message: Message):
         await message.answer("У вас пока нет добавленных детей.")
         return
     
-    for child in children:
-        stats = await db.get_visit_stats(user_id, child["child_id"])
-        visits = stats.get("visits_count", 0)
-        total = stats.get("total_lessons", 0)
-        remaining = stats.get("remaining_lessons", 0)
-        missed = total - visits - remaining if total > 0 else 0
-        
-        text = f"📊 Статистика {child['name']}:\n\n"
-        text += f"Посещено: {visits} / {total}\n"
-        text += f"Пропусков: {missed}\n"
-        if remaining > 0:
-            text += f"Осталось: {remaining} занятий"
-        
-        await message.answer(text)
+    # По сообщению на ребёнка — массовая отправка, не обгоняет QR-коды и платежи
+    with send_priority(Priority.BULK):
+        for child in children:
+            stats = await db.get_visit_stats(user_id, child["child_id"])
+            visits = stats.get("visits_count", 0)
+            total = stats.get("total_lessons", 0)
+            remaining = stats.get("remaining_lessons", 0)
+            missed = total - visits - remaining if total > 0 else 0
+            
+            text = f"📊 Статистика {child['name']}:\n\n"
+            text += f"Посещено: {visits} / {total}\n"
+            text += f"Пропусков: {missed}\n"
+            if remaining > 0:
+                text += f"Осталось: {remaining} занятий"
+            
+            await message.answer(text)
 
@@ -1,12 +1,18 @@
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, BufferedInputFile
 from aiogram.filters import Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
+from aiogram.exceptions import TelegramBadRequest
 
 from database import Database
-from utils.keyboards import get_partner_menu
-from config import ROLE_PARTNER, STATUS_PENDING, STATUS_APPROVED, CITIES, CATEGORIES
+from utils.keyboards import get_partner_menu, get_analytics_period_keyboard, get_export_keyboard
+from services.analytics import DEFAULT_PERIOD, get_center_report, format_center_report, invalidate_center_analytics
+from services.export import EXPORT_FORMATS, start_export
+from utils.qr_generator import forget_subscription_qr
+from config import ROLE_PARTNER, STATUS_PENDING, STATUS_APPROVED, CITIES, CATEGORIES, EXPORT_KINDS
 
 router = Router()
 db = Database()
@@ -25,10 +31,10 @@ class PartnerRegistrationStates(StatesGroup):
 
 
 @router.message(Command("partner"))
-async def cmd_partner(message: Message, state: FSMContext):
+async def cmd_partner(message: Message, state: FSMContext, db_user: Optional[dict] = None):
     """Вход для партнёра"""
     user_id = message.from_user.id
-    user = await db.get_user(user_id)
+    user = db_user
     
     if not user:
         await db.create_user(user_id, message.from_user.username, message.from_user.full_name, ROLE_PARTNER)
@@ -239,17 +245,27 @@ async def qr_scanned(message: Message):
         await message.answer("❌ Этот QR-код не принадлежит вашему центру.")
         return
     
-    # Записываем посещение
-    success = await db.record_visit(
+    # Записываем посещение (занятие списывается атомарно)
+    visit = await db.record_visit(
         subscription["subscription_id"],
         center["center_id"]
     )
     
-    if not success:
-        await message.answer("❌ Ошибка при записи посещения.")
+    if not visit:
+        await message.answer("❌ Занятия по абонементу закончились или он уже неактивен.")
         return
+    invalidate_center_analytics(db, center["center_id"])
     
-    remaining = subscription.get("lessons_remaining", 0) - 1
+    if visit["tariff"] == "unlimited":
+        remaining = "безлимит"
+    else:
+        remaining = visit["lessons_remaining"]
+        if remaining <= 0:
+            # Абонемент закончился — его QR-код больше не пропуск
+            forget_subscription_qr(
+                subscription["qr_code"], subscription["user_id"], subscription["subscription_id"],
+                subscription.get("child_id")
+            )
     student_name = subscription.get("child_name") or subscription.get("full_name", "Ученик")
     
     await message.answer(
@@ -274,12 +290,66 @@ async def partner_analytics(message: Message):
         await message.answer("Центр не найден.")
         return
     
-    analytics = await db.get_center_analytics(center["center_id"])
+    report = await get_center_report(db, center["center_id"], DEFAULT_PERIOD)
+    await message.answer(
+        format_center_report(report),
+        reply_markup=get_analytics_period_keyboard(DEFAULT_PERIOD)
+    )
+
+
+@router.callback_query(F.data.startswith("analytics_"))
+async def partner_analytics_period(callback: CallbackQuery):
+    """Смена периода аналитики"""
+    period = callback.data.replace("analytics_", "")
+    center = await db.get_partner_center(callback.from_user.id)
     
-    text = "📈 Статистика за месяц:\n\n"
-    text += f"Посещений: {analytics.get('visits_count', 0)}\n"
-    text += f"Продано абонементов: {analytics.get('sales_count', 0)}\n"
-    text += f"Доход: {analytics.get('total_revenue', 0):,} ₸"
+    if not center:
+        await callback.answer("Центр не найден.", show_alert=True)
+        return
     
-    await message.answer(text)
+    report = await get_center_report(db, center["center_id"], period)
+    try:
+        await callback.message.edit_text(
+            format_center_report(report),
+            reply_markup=get_analytics_period_keyboard(report["period"])
+        )
+    except TelegramBadRequest as e:
+        # Тот же период выбран повторно — сообщение не изменилось
+        if "message is not modified" not in str(e):
+            raise
+    await callback.answer()
+
+
+@router.message(F.text == "📤 Выгрузка")
+async def partner_export(message: Message):
+    """Выгрузка данных центра"""
+    center = await db.get_partner_center(message.from_user.id)
+    
+    if not center:
+        await message.answer("Центр не найден.")
+        return
+    
+    await message.answer(
+        "📤 Выгрузка данных центра\n\n"
+        "Выберите данные и формат файла:",
+        reply_markup=get_export_keyboard("partner_export")
+    )
 
+
+@router.callback_query(F.data.startswith("partner_export_"))
+async def partner_export_selected(callback: CallbackQuery):
+    """Выгрузка выбранных данных центра"""
+    kind, _, fmt = callback.data.replace("partner_export_", "").rpartition("_")
+    if kind not in EXPORT_KINDS or fmt not in EXPORT_FORMATS:
+        await callback.answer()
+        return
+    
+    center = await db.get_partner_center(callback.from_user.id)
+    if not center:
+        await callback.answer("Центр не найден.", show_alert=True)
+        return
+    
+    if start_export(callback.bot, callback.message.chat.id, db, kind, fmt, center["center_id"]):
+        await callback.answer()
+    else:
+        await callback.answer("⏳ Предыдущая выгрузка ещё готовится.", show_alert=True)
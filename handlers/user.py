@@ -1,4 +1,6 @@
 import logging
+from typing import Optional
+
 from aiogram import Router, F
 from aiogram.types import Message, CallbackQuery, BufferedInputFile, InlineKeyboardButton, InlineKeyboardMarkup
 from aiogram.fsm.context import FSMContext
@@ -7,10 +9,15 @@ from aiogram.fsm.state import State, StatesGroup
 from database import Database
 from utils.keyboards import (
     get_main_menu, get_search_params_keyboard, get_cities_keyboard,
-    get_categories_keyboard, get_course_keyboard, get_course_detail_keyboard,
-    get_tariff_keyboard, get_payment_keyboard, get_subscription_keyboard
+    get_categories_keyboard, get_course_detail_keyboard,
+    get_tariff_keyboard, get_payment_keyboard, get_subscription_keyboard,
+    get_price_ranges_keyboard, get_age_filter_keyboard, get_rating_filter_keyboard
 )
-from utils.qr_generator import generate_subscription_qr
+from utils.catalog import show_catalog_page
+from utils.qr_generator import render_subscription_qr
+from utils.qr_assets import send_subscription_qr, remember_qr_file_id
+from services.subscriptions import activate_paid_subscription
+from middleware.outbound import Priority, send_priority
 from config import ROLE_USER
 
 logger = logging.getLogger(__name__)
@@ -56,6 +63,78 @@ async def city_selected(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 
+@router.callback_query(F.data == "search_price")
+async def select_price(callback: CallbackQuery):
+    """Выбор диапазона цен"""
+    await callback.message.edit_text(
+        "💰 Выбери цену абонемента (8 занятий):",
+        reply_markup=get_price_ranges_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("filter_price_"))
+async def price_selected(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора диапазона цен"""
+    price_min, price_max = callback.data.replace("filter_price_", "").split("_")
+    await state.update_data(
+        price_min=int(price_min) if price_min else None,
+        price_max=int(price_max) if price_max else None
+    )
+    
+    await callback.message.edit_text(
+        "✅ Цена учтена.\n\nВыбери параметры поиска:",
+        reply_markup=get_search_params_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data == "search_age")
+async def select_age(callback: CallbackQuery):
+    """Выбор возраста"""
+    await callback.message.edit_text(
+        "🎂 Выбери возраст ученика:",
+        reply_markup=get_age_filter_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("filter_age_"))
+async def age_selected(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора возраста"""
+    age = int(callback.data.replace("filter_age_", ""))
+    await state.update_data(age=age)
+    
+    await callback.message.edit_text(
+        f"✅ Возраст: {age} лет.\n\nВыбери параметры поиска:",
+        reply_markup=get_search_params_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data == "search_rating")
+async def select_rating(callback: CallbackQuery):
+    """Выбор минимального рейтинга"""
+    await callback.message.edit_text(
+        "⭐ Выбери минимальный рейтинг:",
+        reply_markup=get_rating_filter_keyboard()
+    )
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("filter_rating_"))
+async def rating_selected(callback: CallbackQuery, state: FSMContext):
+    """Обработка выбора минимального рейтинга"""
+    min_rating = float(callback.data.replace("filter_rating_", ""))
+    await state.update_data(min_rating=min_rating)
+    
+    await callback.message.edit_text(
+        f"✅ Рейтинг от {min_rating}.\n\nВыбери параметры поиска:",
+        reply_markup=get_search_params_keyboard()
+    )
+    await callback.answer()
+
+
 @router.callback_query(F.data.startswith("category_"))
 async def category_selected(callback: CallbackQuery, state: FSMContext):
     """Обработка выбора категории и показ курсов"""
@@ -63,40 +142,59 @@ async def category_selected(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     city = data.get("city")
     
-    # Получаем курсы
-    courses = await db.get_courses(city=city, category=category)
+    filters = {
+        "city": city,
+        "category": category,
+        "age": data.get("age"),
+        "price_min": data.get("price_min"),
+        "price_max": data.get("price_max"),
+        "min_rating": data.get("min_rating")
+    }
     
-    if not courses:
+    # Фильтры нужны для перехода по страницам; остальные данные сохраняем
+    await state.update_data(catalog_filters=filters, catalog_cursor=None)
+    
+    if not await show_catalog_page(callback, db, filters):
         await callback.message.edit_text(
             "😔 Курсов не найдено. Попробуй другие параметры.",
             reply_markup=get_search_params_keyboard()
         )
-        await callback.answer()
+    
+    await callback.answer()
+
+
+@router.callback_query(F.data.startswith("courses_page_"))
+async def courses_page(callback: CallbackQuery, state: FSMContext):
+    """Переход по страницам каталога"""
+    cursor = callback.data.replace("courses_page_", "")
+    data = await state.get_data()
+    filters = data.get("catalog_filters")
+    
+    if not filters:
+        await callback.answer("Поиск устарел, начни заново", show_alert=True)
         return
     
-    # Показываем первые 5 курсов
-    text = f"Найдено курсов: {len(courses)}\n\n"
-    for course in courses[:5]:
-        center_name = course.get("center_name", "Не указано")
-        price_8 = course.get("price_8", 0)
-        rating = course.get("rating", 0)
-        address = course.get("address", "")
-        city_name = course.get("city", "")
-        
-        text += f"📘 Курс: {course['name']}\n"
-        text += f"🏫 {center_name}\n"
-        text += f"💰 Абонемент: 8 занятий — {price_8:,}₸\n"
-        text += f"⭐️ Рейтинг: {rating}\n"
-        text += f"📍 {city_name}, {address}\n\n"
-        
-        await callback.message.answer(
-            text,
-            reply_markup=get_course_keyboard(course["course_id"])
+    if not await show_catalog_page(callback, db, filters, cursor):
+        await callback.answer("Курсов больше нет", show_alert=True)
+        return
+    
+    await state.update_data(catalog_cursor=cursor)
+    await callback.answer()
+
+
+@router.callback_query(F.data == "back_to_catalog")
+async def back_to_catalog(callback: CallbackQuery, state: FSMContext):
+    """Возврат из карточки курса к странице каталога"""
+    data = await state.get_data()
+    filters = data.get("catalog_filters")
+    
+    if not filters or not await show_catalog_page(callback, db, filters, data.get("catalog_cursor")):
+        await callback.message.edit_text(
+            "Выбери параметры поиска:",
+            reply_markup=get_search_params_keyboard()
         )
-        text = ""
     
     await callback.answer()
-    await state.clear()
 
 
 @router.callback_query(F.data.startswith("course_detail_"))
@@ -170,7 +268,7 @@ async def buy_course(callback: CallbackQuery):
 
 
 @router.callback_query(F.data.startswith("tariff_"))
-async def tariff_selected(callback: CallbackQuery, state: FSMContext):
+async def tariff_selected(callback: CallbackQuery, state: FSMContext, db_user: Optional[dict] = None):
     """Обработка выбора тарифа"""
     parts = callback.data.split("_")
     course_id = int(parts[1])
@@ -212,23 +310,16 @@ async def tariff_selected(callback: CallbackQuery, state: FSMContext):
     
     # Инициализируем платежный сервис
     try:
-        from services.payment import AirbaPayClient, PaymentService
+        from services.payment import get_airba_client, PaymentService
         from config import (
-            AIRBA_PAY_BASE_URL, AIRBA_PAY_USER, AIRBA_PAY_PASSWORD,
-            AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_COMPANY_ID, AIRBA_PAY_WEBHOOK_URL
+            AIRBA_PAY_USER, AIRBA_PAY_PASSWORD, AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_WEBHOOK_URL
         )
         
         # Проверяем наличие настроек
         if not AIRBA_PAY_USER or not AIRBA_PAY_PASSWORD or not AIRBA_PAY_TERMINAL_ID:
             # Если платежная система не настроена, создаём абонемент без оплаты
-            qr_id, qr_image = generate_subscription_qr(user_id, subscription_id)
-            import aiosqlite
-            async with aiosqlite.connect(db.db_path) as db_conn:
-                await db_conn.execute(
-                    "UPDATE subscriptions SET qr_code = ? WHERE subscription_id = ?",
-                    (qr_id, subscription_id)
-                )
-                await db_conn.commit()
+            qr_id, qr_image = await render_subscription_qr(user_id, subscription_id)
+            await db.activate_subscription(subscription_id, qr_id)
             
             await callback.message.answer(
                 "🎉 Абонемент активирован!\n\n"
@@ -237,10 +328,11 @@ async def tariff_selected(callback: CallbackQuery, state: FSMContext):
             
             try:
                 qr_bytes = qr_image.getvalue()
-                await callback.message.answer_photo(
+                sent = await callback.message.answer_photo(
                     photo=BufferedInputFile(qr_bytes, filename="qr_code.png"),
                     caption="Твой QR-код для посещений"
                 )
+                await remember_qr_file_id(db, subscription_id, qr_id, sent)
             except Exception:
                 await callback.message.answer(
                     f"QR-код создан!\nКод: {qr_id}\n\n"
@@ -251,19 +343,13 @@ async def tariff_selected(callback: CallbackQuery, state: FSMContext):
             return
         
         # Создаём платеж
-        client = AirbaPayClient(
-            base_url=AIRBA_PAY_BASE_URL,
-            user=AIRBA_PAY_USER,
-            password=AIRBA_PAY_PASSWORD,
-            terminal_id=AIRBA_PAY_TERMINAL_ID,
-            company_id=AIRBA_PAY_COMPANY_ID
-        )
+        # Общий клиент: токен и соединения переиспользуются между запросами
+        client = get_airba_client()
         
         payment_service = PaymentService(client, db, AIRBA_PAY_WEBHOOK_URL)
         
-        # Получаем данные пользователя
-        user = await db.get_user(user_id)
-        phone = user.get("phone", "") if user else ""
+        # Данные пользователя загружены middleware
+        phone = db_user.get("phone", "") if db_user else ""
         email = ""  # У пользователя может не быть email
         
         payment_result = await payment_service.create_payment(
@@ -315,14 +401,8 @@ async def tariff_selected(callback: CallbackQuery, state: FSMContext):
         
     except ImportError:
         # Если платежный сервис не настроен, создаём абонемент без оплаты
-        qr_id, qr_image = generate_subscription_qr(user_id, subscription_id)
-        import aiosqlite
-        async with aiosqlite.connect(db.db_path) as db_conn:
-            await db_conn.execute(
-                "UPDATE subscriptions SET qr_code = ? WHERE subscription_id = ?",
-                (qr_id, subscription_id)
-            )
-            await db_conn.commit()
+        qr_id, qr_image = await render_subscription_qr(user_id, subscription_id)
+        await db.activate_subscription(subscription_id, qr_id)
         
         await callback.message.answer(
             "🎉 Абонемент активирован!\n\n"
@@ -331,10 +411,11 @@ async def tariff_selected(callback: CallbackQuery, state: FSMContext):
         
         try:
             qr_bytes = qr_image.getvalue()
-            await callback.message.answer_photo(
+            sent = await callback.message.answer_photo(
                 photo=BufferedInputFile(qr_bytes, filename="qr_code.png"),
                 caption="Твой QR-код для посещений"
             )
+            await remember_qr_file_id(db, subscription_id, qr_id, sent)
         except Exception:
             await callback.message.answer(
                 f"QR-код создан!\nКод: {qr_id}\n\n"
@@ -355,12 +436,14 @@ async def my_subscriptions(message: Message):
         await message.answer("У тебя пока нет абонементов.")
         return
     
-    for sub in subscriptions:
-        remaining = sub.get("lessons_remaining", 0)
-        course_name = sub.get("course_name", "Неизвестный курс")
-        
-        text = f"🔹 {course_name} — осталось {remaining} занятий"
-        await message.answer(text, reply_markup=get_subscription_keyboard(sub["subscription_id"]))
+    # По сообщению на абонемент — массовая отправка, не обгоняет QR-коды и платежи
+    with send_priority(Priority.BULK):
+        for sub in subscriptions:
+            remaining = sub.get("lessons_remaining", 0)
+            course_name = sub.get("course_name", "Неизвестный курс")
+            
+            text = f"🔹 {course_name} — осталось {remaining} занятий"
+            await message.answer(text, reply_markup=get_subscription_keyboard(sub["subscription_id"]))
 
 
 @router.callback_query(F.data.startswith("show_qr_"))
@@ -369,22 +452,14 @@ async def show_qr(callback: CallbackQuery):
     subscription_id = int(callback.data.replace("show_qr_", ""))
     
     # Получаем данные абонемента
-    subscriptions = await db.get_user_subscriptions(callback.from_user.id)
-    subscription = next((s for s in subscriptions if s["subscription_id"] == subscription_id), None)
+    subscription = await db.get_subscription(subscription_id, callback.from_user.id)
     
-    if not subscription:
+    if not subscription or subscription.get("status") != "active" or not subscription.get("qr_code"):
         await callback.answer("Абонемент не найден", show_alert=True)
         return
     
-    # Генерируем QR из сохранённого кода
-    from utils.qr_generator import generate_qr_code
-    qr_image = generate_qr_code(subscription["qr_code"])
-    
-    qr_bytes = qr_image.getvalue()
-    await callback.message.answer_photo(
-        photo=BufferedInputFile(qr_bytes, filename="qr_code.png"),
-        caption="Твой QR-код для посещений"
-    )
+    # Повторные показы отправляются по сохранённому file_id, без рендеринга
+    await send_subscription_qr(callback.bot, callback.message.chat.id, db, subscription, "Твой QR-код для посещений")
     await callback.answer()
 
 
@@ -430,17 +505,10 @@ async def cancel_payment(callback: CallbackQuery, state: FSMContext):
         subscription = await db.get_user_subscriptions(user_id)
         if not any(s.get("subscription_id") == subscription_id for s in subscription):
             # Проверяем через прямой запрос
-            import aiosqlite
-            async with aiosqlite.connect(db.db_path) as db_conn:
-                db_conn.row_factory = aiosqlite.Row
-                async with db_conn.execute(
-                    "SELECT * FROM subscriptions WHERE subscription_id = ? AND user_id = ?",
-                    (subscription_id, user_id)
-                ) as cursor:
-                    sub = await cursor.fetchone()
-                    if not sub:
-                        await callback.answer("Абонемент не найден или доступ запрещен", show_alert=True)
-                        return
+            sub = await db.get_subscription(subscription_id, user_id)
+            if not sub:
+                await callback.answer("Абонемент не найден или доступ запрещен", show_alert=True)
+                return
         
         # Удаляем связанные платежи
         payments = await db.get_user_payments(user_id)
@@ -454,10 +522,7 @@ async def cancel_payment(callback: CallbackQuery, state: FSMContext):
                 )
         
         # Удаляем временный абонемент
-        import aiosqlite
-        async with aiosqlite.connect(db.db_path) as db_conn:
-            await db_conn.execute("DELETE FROM subscriptions WHERE subscription_id = ?", (subscription_id,))
-            await db_conn.commit()
+        await db.delete_subscription(subscription_id)
         
         await callback.message.answer("❌ Платеж отменен. Абонемент не создан.")
         await callback.answer("Платеж отменен")
@@ -476,19 +541,11 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
     user_id = callback.from_user.id
     
     try:
-        from services.payment import AirbaPayClient, PaymentService
-        from config import (
-            AIRBA_PAY_BASE_URL, AIRBA_PAY_USER, AIRBA_PAY_PASSWORD,
-            AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_COMPANY_ID, AIRBA_PAY_WEBHOOK_URL
-        )
+        from services.payment import get_airba_client, PaymentService
+        from config import AIRBA_PAY_WEBHOOK_URL
         
-        client = AirbaPayClient(
-            base_url=AIRBA_PAY_BASE_URL,
-            user=AIRBA_PAY_USER,
-            password=AIRBA_PAY_PASSWORD,
-            terminal_id=AIRBA_PAY_TERMINAL_ID,
-            company_id=AIRBA_PAY_COMPANY_ID
-        )
+        # Общий клиент: токен и соединения переиспользуются между запросами
+        client = get_airba_client()
         
         payment_service = PaymentService(client, db, AIRBA_PAY_WEBHOOK_URL)
         result = await payment_service.get_payment_status(payment_id, user_id)
@@ -499,39 +556,23 @@ async def check_payment_status(callback: CallbackQuery, state: FSMContext):
             subscription_id = payment.get("subscription_id")
             
             if status == "success":
-                # Платеж успешен, активируем абонемент
-                if subscription_id:
-                    # Генерируем QR-код
-                    qr_id, qr_image = generate_subscription_qr(user_id, subscription_id)
-                    
-                    # Обновляем QR-код в базе данных
-                    import aiosqlite
-                    async with aiosqlite.connect(db.db_path) as db_conn:
-                        await db_conn.execute(
-                            "UPDATE subscriptions SET qr_code = ? WHERE subscription_id = ?",
-                            (qr_id, subscription_id)
-                        )
-                        await db_conn.commit()
-                    
-                    await callback.message.answer(
-                        "✅ Платеж успешно выполнен!\n\n"
-                        "🎉 Абонемент активирован!\n\n"
-                        "Вот твой QR-код для посещений 👇"
-                    )
-                    
-                    try:
-                        qr_bytes = qr_image.getvalue()
-                        await callback.message.answer_photo(
-                            photo=BufferedInputFile(qr_bytes, filename="qr_code.png"),
-                            caption="Твой QR-код для посещений"
+                if result.get("finalized"):
+                    # Платеж завершён этой проверкой — активируем абонемент
+                    await activate_paid_subscription(callback.bot, db, payment)
+                else:
+                    # Абонемент уже активирован (уведомлением AirbaPay или прошлой проверкой)
+                    subscription = await db.get_subscription(subscription_id, user_id) if subscription_id else None
+                    # qr_code есть и у неоплаченного абонемента (временный), признак активации — activated_at
+                    if subscription and subscription.get("activated_at"):
+                        await callback.message.answer("✅ Платеж уже подтверждён, абонемент активен.")
+                        await send_subscription_qr(
+                            callback.bot, callback.message.chat.id, db, subscription, "Твой QR-код для посещений"
                         )
-                    except Exception:
+                    else:
                         await callback.message.answer(
-                            f"QR-код создан!\nКод: {qr_id}\n\n"
-                            f"Установите Pillow для отображения QR-кода как изображения."
+                            "✅ Платеж успешно выполнен!\n\n"
+                            "Абонемент активируется в течение нескольких минут, QR-код придёт сообщением."
                         )
-                else:
-                    await callback.message.answer("✅ Платеж успешно выполнен!")
                 
                 await state.clear()
             elif status == "failed":
@@ -575,7 +616,8 @@ async def my_payments(message: Message):
             "success": "✅",
             "pending": "⏳",
             "failed": "❌",
-            "refunded": "↩️"
+            "refunded": "↩️",
+            "expired": "⌛"
         }.get(payment.get("status", "pending"), "❓")
         
         amount = payment.get("amount", 0)
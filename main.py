@@ -1,4 +1,15 @@
 # ...existing code...
+# Состояния FSM в постоянном хранилище (по умолчанию — таблица в базе бота)
+from utils.fsm_storage import create_fsm_storage
+
+dp.fsm.storage = create_fsm_storage(db)
+
+# Загрузка пользователя из БД один раз на обновление (data["db_user"])
+from middleware.role_check import UserRoleMiddleware
+
+dp.message.outer_middleware(UserRoleMiddleware(db))
+dp.callback_query.outer_middleware(UserRoleMiddleware(db))
+
 # Регистрация роутеров
 dp.include_router(common.router)
 dp.include_router(user.router)
@@ -7,6 +18,77 @@ dp.include_router(child.router)
 dp.include_router(partner.router)
 dp.include_router(admin.router)
 
+
+# Приём уведомлений AirbaPay в том же процессе, что и бот
+from aiogram import Bot
+from config import (
+    AIRBA_PAY_WEBHOOK_URL, PAYMENT_WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT,
+    AIRBA_PAY_USER, AIRBA_PAY_PASSWORD, AIRBA_PAY_TERMINAL_ID
+)
+from services.payment import get_airba_client, PaymentService
+from services.payment_webhook import create_payment_webhook_app, webhook_path_prefix, PaymentWebhookServer
+from services.reconciler import PaymentReconciler
+from middleware.outbound import OutboundScheduler
+
+payment_webhook_server = None
+payment_reconciler = None
+# Все исходящие сообщения проходят через планировщик с лимитами Telegram
+outbound_scheduler = OutboundScheduler()
+
+
+@dp.startup()
+async def on_startup(bot: Bot):
+    global payment_webhook_server, payment_reconciler
+    if outbound_scheduler not in bot.session.middleware:
+        bot.session.middleware(outbound_scheduler)
+    
+    if AIRBA_PAY_WEBHOOK_URL:
+        app = create_payment_webhook_app(
+            bot, db,
+            PaymentService(get_airba_client(), db, AIRBA_PAY_WEBHOOK_URL),
+            prefix=webhook_path_prefix(AIRBA_PAY_WEBHOOK_URL)
+        )
+        payment_webhook_server = PaymentWebhookServer(app, PAYMENT_WEBHOOK_HOST, PAYMENT_WEBHOOK_PORT)
+        await payment_webhook_server.start()
+    
+    # Сверка зависших платежей: запасной путь, если уведомление не пришло
+    if AIRBA_PAY_USER and AIRBA_PAY_PASSWORD and AIRBA_PAY_TERMINAL_ID:
+        payment_reconciler = PaymentReconciler(bot, db, get_airba_client())
+        payment_reconciler.start()
+
+
+# Закрытие соединений с базой данных, AirbaPay, пулов рендеринга QR и выгрузок при остановке
+from utils.qr_generator import shutdown_qr_executor
+from services.export import cancel_exports, shutdown_export_executor
+from services.payment import close_http_session
+
+@dp.shutdown()
+async def on_shutdown():
+    if payment_reconciler:
+        await payment_reconciler.stop()
+    if payment_webhook_server:
+        await payment_webhook_server.stop()
+    # Выгрузки читают базу — отменяем их до закрытия соединений
+    await cancel_exports()
+    await db.close()
+    await close_http_session()
+    shutdown_qr_executor()
+    shutdown_export_executor()
+    await outbound_scheduler.close()
+
+
+# Получение обновлений: long polling или webhook (BOT_MODE); вызывается из main()
+from config import BOT_MODE
+from services.bot_webhook import run_webhook
+
+async def start_bot(bot: Bot):
+    if BOT_MODE == "webhook":
+        await run_webhook(dp, bot)
+    else:
+        # Снимаем webhook, оставшийся от запуска в режиме webhook, иначе polling не получит обновлений
+        await bot.delete_webhook(drop_pending_updates=False)
+        await dp.start_polling(bot)
+
 # Собираем тексты кнопок ReplyKeyboard, чтобы игнорировать их нажатия
 menu_texts = set()
 try:
@@ -39,18 +121,18 @@ except Exception:
     menu_texts = set()
 
 # Обработчик неизвестных сообщений (должен быть последним)
+from typing import Optional
 from aiogram import F
 from aiogram.types import Message
 
 @dp.message(F.text & ~F.text.startswith('/'))
-async def unknown_message_handler(message: Message):
+async def unknown_message_handler(message: Message, db_user: Optional[dict] = None):
     # Если текст совпадает с кнопкой ReplyKeyboard — считаем, что это нажатие кнопки и игнорируем
     text = (message.text or "").strip()
     if text and text in menu_texts:
         return
 
-    user_id = message.from_user.id
-    user = await db.get_user(user_id)
+    user = db_user
 
     if user:
         role = user.get("role", "user")
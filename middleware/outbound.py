@@ -0,0 +1,220 @@
+"""
+Планировщик исходящих сообщений с учётом лимитов Telegram
+
+Подключается к сессии бота (bot.session.middleware), поэтому через него
+проходят все отправки: ответы хендлеров, QR-коды, уведомления об оплате.
+Сообщения ограничиваются общим лимитом бота и лимитом каждого чата;
+при ответе 429 чат ставится на паузу retry_after и отправка повторяется.
+Свободные места общего лимита выдаются по приоритету: транзакционные
+сообщения (QR-коды, платежи) идут раньше массовых рассылок.
+"""
+import asyncio
+import contextvars
+import heapq
+import itertools
+import logging
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from enum import IntEnum
+from typing import Dict, List, Optional, Tuple
+
+from aiogram import Bot
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware, NextRequestMiddlewareType
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import TelegramMethod
+from aiogram.methods.base import Response, TelegramType
+
+from config import (
+    OUTBOUND_GLOBAL_RATE, OUTBOUND_CHAT_RATE, OUTBOUND_GROUP_RATE, OUTBOUND_CHAT_BURST,
+    OUTBOUND_MAX_RETRIES
+)
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Очереди отправки: меньше значение — раньше"""
+    TRANSACTIONAL = 0
+    INTERACTIVE = 1
+    BULK = 2
+
+
+_priority: contextvars.ContextVar[Priority] = contextvars.ContextVar("outbound_priority", default=Priority.INTERACTIVE)
+
+
+@contextmanager
+def send_priority(priority: Priority):
+    """Приоритет отправок внутри блока with (в пределах текущей задачи)"""
+    token = _priority.set(priority)
+    try:
+        yield
+    finally:
+        _priority.reset(token)
+
+
+class TokenBucket:
+    """Ведро токенов: rate токенов в секунду, не больше capacity подряд"""
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self) -> float:
+        """Сколько секунд ждать до следующего токена"""
+        now = time.monotonic()
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def consume(self):
+        self.tokens -= 1
+
+    def pause(self, seconds: float):
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    @property
+    def idle(self) -> bool:
+        return self.delay() == 0 and self.tokens >= self.capacity
+
+
+class _PriorityLimiter:
+    """Общий лимит бота: токены выдаются ожидающим в порядке приоритета"""
+
+    def __init__(self, rate: float):
+        # Без запаса: лимит Telegram считается по скользящей секунде, пачка сверх темпа даёт 429
+        self.bucket = TokenBucket(rate, 1)
+        self._waiters: List[Tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._wakeup = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def acquire(self, priority: Priority):
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), future))
+        self._wakeup.set()
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        await future
+
+    async def _run(self):
+        while True:
+            if not self._waiters:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+            wait = self.bucket.delay()
+            if wait > 0:
+                # После паузы берём самый приоритетный из ожидающих на тот момент
+                await asyncio.sleep(wait)
+                continue
+            _, _, future = heapq.heappop(self._waiters)
+            if future.done():
+                continue
+            self.bucket.consume()
+            future.set_result(None)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+
+class _ChatState:
+    def __init__(self, rate: float, capacity: float):
+        self.bucket = TokenBucket(rate, capacity)
+        # Сообщения одного чата уходят по одному и в порядке вызова
+        self.lock = asyncio.Lock()
+
+
+class OutboundScheduler(BaseRequestMiddleware):
+    """
+    Middleware сессии бота, ограничивающий отправку сообщений
+
+    Ограничиваются только методы send*/copy*/forward* с chat_id,
+    остальные запросы (getUpdates, answerCallbackQuery, edit*) идут сразу.
+    """
+
+    MAX_CHATS = 10000
+
+    def __init__(self, global_rate: float = OUTBOUND_GLOBAL_RATE, chat_rate: float = OUTBOUND_CHAT_RATE,
+                 group_rate: float = OUTBOUND_GROUP_RATE, chat_burst: float = OUTBOUND_CHAT_BURST,
+                 max_retries: int = OUTBOUND_MAX_RETRIES):
+        self.limiter = _PriorityLimiter(global_rate)
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chats: "OrderedDict[int, _ChatState]" = OrderedDict()
+        self.metrics: Dict[str, int] = {"sent": 0, "retried": 0, "failed": 0}
+
+    @staticmethod
+    def _chat_id(method: TelegramMethod) -> Optional[int]:
+        name = getattr(method, "__api_method__", "")
+        if name == "sendChatAction" or not name.startswith(("send", "copy", "forward")):
+            return None
+        chat_id = getattr(method, "chat_id", None)
+        # @username каналов встречается редко, считаем его отдельным чатом
+        return hash(chat_id) if isinstance(chat_id, str) else chat_id
+
+    def _chat(self, chat_id: int) -> _ChatState:
+        state = self._chats.get(chat_id)
+        if state is None:
+            # Отрицательные id — группы и каналы, у них лимит ниже
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            state = self._chats[chat_id] = _ChatState(rate, self.chat_burst)
+            self._prune()
+        else:
+            self._chats.move_to_end(chat_id)
+        return state
+
+    def _prune(self):
+        # Забываем давно неактивные чаты, ведро которых уже полностью восстановилось
+        while len(self._chats) > self.MAX_CHATS:
+            chat_id, state = next(iter(self._chats.items()))
+            if state.lock.locked() or not state.bucket.idle:
+                break
+            del self._chats[chat_id]
+
+    async def __call__(self, make_request: NextRequestMiddlewareType[TelegramType], bot: Bot,
+                       method: TelegramMethod[TelegramType]) -> Response[TelegramType]:
+        chat_id = self._chat_id(method)
+        if chat_id is None:
+            return await make_request(bot, method)
+
+        priority = _priority.get()
+        chat = self._chat(chat_id)
+        async with chat.lock:
+            for attempt in range(self.max_retries + 1):
+                while (wait := chat.bucket.delay()) > 0:
+                    await asyncio.sleep(wait)
+                chat.bucket.consume()
+                await self.limiter.acquire(priority)
+                try:
+                    response = await make_request(bot, method)
+                except TelegramRetryAfter as e:
+                    if attempt >= self.max_retries:
+                        self.metrics["failed"] += 1
+                        raise
+                    self.metrics["retried"] += 1
+                    logger.warning(f"Telegram ограничил отправку в чат {chat_id}, пауза {e.retry_after} с")
+                    chat.bucket.pause(e.retry_after)
+                    continue
+                self.metrics["sent"] += 1
+                return response
+
+    async def close(self):
+        await self.limiter.close()
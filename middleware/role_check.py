@@ -1,7 +1,41 @@
 """
 Middleware для проверки ролей пользователей
 
-Примечание: Полная проверка ролей выполняется в handlers напрямую.
-Этот файл зарезервирован для будущей реализации.
+Загружает запись пользователя из БД один раз на обновление (через кэш
+Database) и передаёт её в handlers как аргумент db_user.
+Сама проверка ролей выполняется в handlers по db_user["role"].
 """
+import logging
+from typing import Callable, Dict, Any, Awaitable
 
+from aiogram import BaseMiddleware
+from aiogram.types import TelegramObject, User
+
+from database import Database
+
+logger = logging.getLogger(__name__)
+
+
+class UserRoleMiddleware(BaseMiddleware):
+    """Middleware, добавляющий запись пользователя из БД в data["db_user"]"""
+
+    def __init__(self, db: Database = None):
+        self.db = db or Database()
+
+    async def __call__(
+        self,
+        handler: Callable[[TelegramObject, Dict[str, Any]], Awaitable[Any]],
+        event: TelegramObject,
+        data: Dict[str, Any]
+    ) -> Any:
+        from_user: User = data.get("event_from_user")
+
+        db_user = None
+        if from_user:
+            try:
+                db_user = await self.db.get_user(from_user.id)
+            except Exception as e:
+                logger.error(f"Не удалось загрузить пользователя {from_user.id}: {e}", exc_info=True)
+
+        data["db_user"] = db_user
+        return await handler(event, data)
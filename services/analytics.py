@@ -0,0 +1,163 @@
+"""
+Аналитика центра для партнёра
+
+Ряды посещений, продаж и выручки по дням, неделям или месяцам, разбивка
+по курсам, продления, использование занятий и оценка пропусков.
+Агрегация выполняется в SQLite по дневным сводкам и индексам, готовый
+отчёт кэшируется по (центр, период) и сбрасывается при новом посещении
+или активации абонемента.
+"""
+import asyncio
+from datetime import date, datetime, time, timedelta, timezone
+from typing import Any, Dict, List, Optional
+
+from config import ANALYTICS_CACHE_TTL, ANALYTICS_NO_SHOW_DAYS, ANALYTICS_PERIODS
+from database import Database
+from utils.cache import AsyncTTLCache
+
+DEFAULT_PERIOD = "month"
+
+_reports = AsyncTTLCache(maxsize=1024, ttl=ANALYTICS_CACHE_TTL)
+
+
+def _bucket_start(day: date, bucket: str) -> date:
+    if bucket == "week":
+        return day - timedelta(days=day.weekday())
+    if bucket == "month":
+        return day.replace(day=1)
+    return day
+
+
+def _next_bucket(day: date, bucket: str) -> date:
+    if bucket == "week":
+        return day + timedelta(days=7)
+    if bucket == "month":
+        return date(day.year + day.month // 12, day.month % 12 + 1, 1)
+    return day + timedelta(days=1)
+
+
+def _bucket_key(day: date, bucket: str) -> str:
+    # Совпадает с Database.SERIES_BUCKETS
+    return day.strftime("%Y-%m") if bucket == "month" else day.isoformat()
+
+
+def period_range(period: str, today: Optional[date] = None) -> tuple:
+    """
+    Полуоткрытый интервал периода [start, end) в UTC
+
+    Период заканчивается сегодняшним днём включительно, начало выравнивается
+    на границу шага ряда (понедельник, первое число), чтобы первая точка
+    ряда была полной.
+    """
+    _, days, bucket = ANALYTICS_PERIODS[period]
+    today = today or datetime.now(timezone.utc).date()
+    end = today + timedelta(days=1)
+    start = _bucket_start(end - timedelta(days=days), bucket)
+    return datetime.combine(start, time()), datetime.combine(end, time())
+
+
+def _fill_series(rows: List[dict], start: datetime, end: datetime, bucket: str) -> List[dict]:
+    """Ряд со всеми точками периода, в том числе нулевыми"""
+    by_key = {row["bucket"]: row for row in rows}
+    series = []
+    day = start.date()
+    while day < end.date():
+        row = by_key.get(_bucket_key(day, bucket), {})
+        series.append({
+            "start": day,
+            "visits": row.get("visits") or 0,
+            "sales": row.get("sales") or 0,
+            "revenue": row.get("revenue") or 0,
+        })
+        day = _next_bucket(day, bucket)
+    return series
+
+
+async def _build_report(db: Database, center_id: int, period: str) -> Dict[str, Any]:
+    title, _, bucket = ANALYTICS_PERIODS[period]
+    start, end = period_range(period)
+    dormant_since = datetime.now(timezone.utc).replace(tzinfo=None) - timedelta(days=ANALYTICS_NO_SHOW_DAYS)
+
+    rows, courses, retention = await asyncio.gather(
+        db.get_center_series(center_id, start, end, bucket),
+        db.get_course_breakdown(center_id, start, end),
+        db.get_retention_metrics(center_id, start, end, dormant_since)
+    )
+    series = _fill_series(rows, start, end, bucket)
+
+    purchases = retention["purchases"]
+    return {
+        "period": period,
+        "title": title,
+        "bucket": bucket,
+        "start": start,
+        "end": end,
+        "series": series,
+        "visits": sum(point["visits"] for point in series),
+        "sales": sum(point["sales"] for point in series),
+        "revenue": sum(point["revenue"] for point in series),
+        "courses": courses,
+        "purchases": purchases,
+        "renewals": retention["renewals"],
+        "renewal_rate": retention["renewals"] / purchases if purchases else None,
+        "avg_lessons_used": retention["avg_lessons_used"],
+        "usage_share": retention["usage_share"],
+        "active": retention["active"],
+        "dormant": retention["dormant"],
+        "dormant_lessons": retention["dormant_lessons"],
+    }
+
+
+async def get_center_report(db: Database, center_id: int, period: str = DEFAULT_PERIOD) -> Dict[str, Any]:
+    """Отчёт по центру за период из ANALYTICS_PERIODS (кэшируется)"""
+    if period not in ANALYTICS_PERIODS:
+        period = DEFAULT_PERIOD
+    return await _reports.get_or_load(
+        (db.db_path, center_id, period), lambda: _build_report(db, center_id, period)
+    )
+
+
+def invalidate_center_analytics(db: Database, center_id: int):
+    """Сбрасывает отчёты центра за все периоды"""
+    for period in ANALYTICS_PERIODS:
+        _reports.invalidate((db.db_path, center_id, period))
+
+
+def _format_point(point: dict, bucket: str) -> str:
+    if bucket == "month":
+        label = point["start"].strftime("%m.%Y")
+    elif bucket == "week":
+        label = "с " + point["start"].strftime("%d.%m")
+    else:
+        label = point["start"].strftime("%d.%m")
+    return f"{label}: {point['visits']} пос., {point['sales']} прод., {point['revenue']:,} ₸"
+
+
+def format_center_report(report: Dict[str, Any]) -> str:
+    """Текст отчёта для сообщения партнёру"""
+    text = f"📈 Статистика за {report['title']}:\n\n"
+    text += f"Посещений: {report['visits']}\n"
+    text += f"Продано абонементов: {report['sales']}\n"
+    text += f"Доход: {report['revenue']:,} ₸\n"
+
+    text += "\n📅 Динамика:\n"
+    for point in report["series"]:
+        text += _format_point(point, report["bucket"]) + "\n"
+
+    if report["courses"]:
+        text += "\n🎓 По курсам:\n"
+        # Сообщение Telegram ограничено по длине — только крупнейшие курсы
+        for course in report["courses"][:10]:
+            name = course.get("course_name") or f"Курс #{course['course_id']}"
+            text += f"• {name}: {course['visits']} пос., {course['sales']} прод., {course['revenue']:,} ₸\n"
+
+    text += "\n🔁 Удержание:\n"
+    if report["renewal_rate"] is not None:
+        text += f"Продления: {report['renewals']} из {report['purchases']} ({report['renewal_rate']:.0%})\n"
+    if report["avg_lessons_used"] is not None:
+        text += f"Использовано занятий в среднем: {report['avg_lessons_used']:.1f} ({report['usage_share']:.0%})\n"
+    text += (
+        f"Не приходят {ANALYTICS_NO_SHOW_DAYS}+ дней: {report['dormant']} из {report['active']} "
+        f"активных абонементов ({report['dormant_lessons']} неиспользованных занятий)"
+    )
+    return text
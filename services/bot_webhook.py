@@ -0,0 +1,151 @@
+"""
+Приём обновлений Telegram через webhook
+
+aiohttp-сервер принимает обновления и раскладывает их по N очередям
+ограниченного размера по chat_id. Каждую очередь обрабатывает свой
+обработчик, поэтому обновления одного чата идут строго по порядку,
+а разные чаты обрабатываются параллельно.
+"""
+import asyncio
+import hmac
+import logging
+from typing import Any, Dict, List, Optional
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+
+from config import (
+    BOT_WEBHOOK_URL, BOT_WEBHOOK_PATH, BOT_WEBHOOK_SECRET, BOT_WEBHOOK_HOST, BOT_WEBHOOK_PORT,
+    BOT_WEBHOOK_WORKERS, BOT_WEBHOOK_QUEUE_SIZE, BOT_WEBHOOK_ENQUEUE_TIMEOUT
+)
+
+logger = logging.getLogger(__name__)
+
+
+def update_chat_id(update: Update) -> int:
+    """Идентификатор чата (или пользователя), определяющий очередь обновления"""
+    event = update.event
+    chat = getattr(event, "chat", None)
+    if chat is None:
+        message = getattr(event, "message", None)
+        chat = getattr(message, "chat", None)
+    if chat is not None:
+        return chat.id
+    from_user = getattr(event, "from_user", None) or getattr(event, "user", None)
+    if from_user is not None:
+        return from_user.id
+    return update.update_id
+
+
+class UpdateWorkerPool:
+    """Очереди обновлений по чатам и обработчики, передающие их в Dispatcher"""
+
+    def __init__(self, dp: Dispatcher, bot: Bot, workers: int = BOT_WEBHOOK_WORKERS,
+                 queue_size: int = BOT_WEBHOOK_QUEUE_SIZE,
+                 enqueue_timeout: float = BOT_WEBHOOK_ENQUEUE_TIMEOUT, **workflow_data: Any):
+        self.dp = dp
+        self.bot = bot
+        self.enqueue_timeout = enqueue_timeout
+        self.workflow_data = workflow_data
+        workers = max(1, workers)
+        per_queue = max(1, queue_size // workers)
+        self.queues: List[asyncio.Queue] = [asyncio.Queue(maxsize=per_queue) for _ in range(workers)]
+        self._tasks: List[asyncio.Task] = []
+        self.metrics = {"received": 0, "processed": 0, "errors": 0, "rejected": 0}
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._worker(queue)) for queue in self.queues]
+
+    async def stop(self):
+        """Дожидается обработки принятых обновлений и останавливает обработчики"""
+        for queue in self.queues:
+            await queue.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def put(self, update: Update) -> bool:
+        """Ставит обновление в очередь его чата; False, если очередь не освободилась за enqueue_timeout"""
+        queue = self.queues[update_chat_id(update) % len(self.queues)]
+        try:
+            await asyncio.wait_for(queue.put(update), self.enqueue_timeout)
+        except asyncio.TimeoutError:
+            self.metrics["rejected"] += 1
+            return False
+        self.metrics["received"] += 1
+        return True
+
+    async def _worker(self, queue: asyncio.Queue):
+        while True:
+            update = await queue.get()
+            try:
+                await self.dp.feed_update(self.bot, update, **self.workflow_data)
+                self.metrics["processed"] += 1
+            except Exception as e:
+                self.metrics["errors"] += 1
+                logger.error(f"Ошибка обработки обновления {update.update_id}: {e}", exc_info=True)
+            finally:
+                queue.task_done()
+
+
+def create_bot_webhook_app(pool: UpdateWorkerPool, path: str = BOT_WEBHOOK_PATH,
+                           secret: str = BOT_WEBHOOK_SECRET) -> web.Application:
+    """aiohttp-приложение, принимающее обновления Telegram"""
+
+    async def handle(request: web.Request) -> web.Response:
+        if secret:
+            token = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+            if not hmac.compare_digest(token, secret):
+                return web.Response(status=401)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": pool.bot})
+        except ValueError:
+            return web.Response(status=400)
+
+        # Очередь переполнена — Telegram повторит доставку позже
+        if not await pool.put(update):
+            return web.Response(status=503)
+        return web.Response()
+
+    app = web.Application()
+    app.router.add_post(path, handle)
+    return app
+
+
+async def run_webhook(dp: Dispatcher, bot: Bot, stop_event: Optional[asyncio.Event] = None,
+                      host: str = BOT_WEBHOOK_HOST, port: int = BOT_WEBHOOK_PORT, **kwargs: Any):
+    """
+    Запускает бота в режиме webhook (аналог dp.start_polling)
+
+    Выполняет startup/shutdown-обработчики диспетчера и, если задан
+    BOT_WEBHOOK_URL, регистрирует webhook в Telegram. Работает до stop_event
+    или отмены задачи.
+    """
+    workflow_data: Dict[str, Any] = {"dispatcher": dp, "bots": [bot], **dp.workflow_data, **kwargs}
+    workflow_data.pop("bot", None)
+
+    await dp.emit_startup(bot=bot, **workflow_data)
+    pool = UpdateWorkerPool(dp, bot, **workflow_data)
+    pool.start()
+    runner = web.AppRunner(create_bot_webhook_app(pool), access_log=None)
+    await runner.setup()
+    try:
+        await web.TCPSite(runner, host, port).start()
+        if BOT_WEBHOOK_URL:
+            await bot.set_webhook(
+                url=BOT_WEBHOOK_URL.rstrip("/") + BOT_WEBHOOK_PATH,
+                secret_token=BOT_WEBHOOK_SECRET or None,
+                allowed_updates=dp.resolve_used_update_types(),
+                # Telegram принимает от 1 до 100 соединений
+                max_connections=min(100, max(40, BOT_WEBHOOK_WORKERS))
+            )
+        logger.info(f"Приём обновлений через webhook на {host}:{port}{BOT_WEBHOOK_PATH}, обработчиков: {len(pool.queues)}")
+        await (stop_event or asyncio.Event()).wait()
+    finally:
+        # Сначала перестаём принимать обновления, затем дорабатываем очереди
+        await runner.cleanup()
+        await pool.stop()
+        logger.info(f"Webhook остановлен: {pool.metrics}")
+        await dp.emit_shutdown(bot=bot, **workflow_data)
@@ -0,0 +1,348 @@
+"""
+Выгрузка посещений, платежей и абонементов в CSV/XLSX
+
+Строки читаются курсором SQLite порциями по EXPORT_CHUNK_SIZE и сразу
+пишутся во временный файл (в памяти до EXPORT_SPOOL_SIZE, дальше на диске),
+поэтому расход памяти не зависит от размера выгрузки. Чтение и запись
+выполняются в отдельном пуле потоков, цикл событий занят только отправкой
+готового файла.
+"""
+import asyncio
+import codecs
+import csv
+import io
+import logging
+import re
+import shutil
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from tempfile import SpooledTemporaryFile
+from typing import AsyncGenerator, List, Optional, Set
+from xml.sax.saxutils import escape
+
+from aiogram import Bot
+from aiogram.types import InputFile
+
+from config import EXPORT_SPOOL_SIZE, EXPORT_WORKERS, EXPORT_MAX_FILE_SIZE, EXPORT_KINDS
+from database import Database, EXPORT_QUERIES
+from middleware.outbound import Priority, send_priority
+
+logger = logging.getLogger(__name__)
+
+EXPORT_FORMATS = ("csv", "xlsx")
+
+_FORMULA_PREFIXES = ("=", "+", "-", "@", "\t", "\r")
+
+_executor: Optional[ThreadPoolExecutor] = None
+# Чаты, для которых выгрузка уже готовится
+_running: Set[int] = set()
+# Фоновые задачи выгрузок (ссылки держим, чтобы задачи не собрал GC)
+_tasks: Set[asyncio.Task] = set()
+
+
+class ExportTooLarge(Exception):
+    """Файл выгрузки больше лимита Telegram на документ"""
+
+    def __init__(self, size: int):
+        super().__init__(f"Файл выгрузки {size} байт больше {EXPORT_MAX_FILE_SIZE}")
+        self.size = size
+
+
+class XlsxStreamWriter:
+    """
+    Потоковая запись XLSX без сторонних библиотек
+
+    Лист пишется в архив по мере поступления строк; строки хранятся
+    прямо в ячейках (inlineStr), без общей таблицы строк в памяти.
+    При превышении лимита строк Excel начинается новый лист.
+    """
+
+    MAX_ROWS = 1048576
+    MAX_CELL_LENGTH = 32767
+    _ILLEGAL_XML = re.compile(r"[\x00-\x08\x0b\x0c\x0e-\x1f]")
+
+    def __init__(self, fileobj, columns: List[str], title: str = "Лист"):
+        self._zip = zipfile.ZipFile(fileobj, "w", zipfile.ZIP_DEFLATED)
+        self._columns = columns
+        self._title = title
+        self._refs = [self._column_letter(i) for i in range(len(columns))]
+        self._sheet = None
+        self._sheets = 0
+        self._row = 0
+
+    @staticmethod
+    def _column_letter(index: int) -> str:
+        letters = ""
+        index += 1
+        while index:
+            index, rest = divmod(index - 1, 26)
+            letters = chr(65 + rest) + letters
+        return letters
+
+    def _text(self, value) -> str:
+        text = str(value)
+        if not text.isprintable():
+            text = self._ILLEGAL_XML.sub("", text)
+        return escape(text[:self.MAX_CELL_LENGTH])
+
+    def _row_xml(self, values) -> str:
+        self._row += 1
+        row = self._row
+        cells = []
+        for ref, value in zip(self._refs, values):
+            if value is None:
+                continue
+            if type(value) is int or type(value) is float:
+                cells.append(f'<c r="{ref}{row}"><v>{value}</v></c>')
+            else:
+                cells.append(f'<c r="{ref}{row}" t="inlineStr"><is><t xml:space="preserve">{self._text(value)}</t></is></c>')
+        return f'<row r="{row}">{"".join(cells)}</row>'
+
+    def _new_sheet(self):
+        self._close_sheet()
+        self._sheets += 1
+        self._row = 0
+        self._sheet = self._zip.open(f"xl/worksheets/sheet{self._sheets}.xml", "w")
+        self._sheet.write((
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            + self._row_xml(self._columns)
+        ).encode("utf-8"))
+
+    def _close_sheet(self):
+        if self._sheet is not None:
+            self._sheet.write(b"</sheetData></worksheet>")
+            self._sheet.close()
+            self._sheet = None
+
+    def writerows(self, rows):
+        if self._sheet is None:
+            self._new_sheet()
+        parts = []
+        for row in rows:
+            if self._row >= self.MAX_ROWS:
+                self._sheet.write("".join(parts).encode("utf-8"))
+                parts = []
+                self._new_sheet()
+            parts.append(self._row_xml(row))
+        self._sheet.write("".join(parts).encode("utf-8"))
+
+    def close(self):
+        if self._sheet is None:
+            self._new_sheet()
+        self._close_sheet()
+        sheets = range(1, self._sheets + 1)
+        names = [self._title if self._sheets == 1 else f"{self._title} {i}" for i in sheets]
+        self._zip.writestr("[Content_Types].xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+            '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+            '<Default Extension="xml" ContentType="application/xml"/>'
+            '<Override PartName="/xl/workbook.xml" '
+            'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+            + "".join(
+                f'<Override PartName="/xl/worksheets/sheet{i}.xml" '
+                'ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+                for i in sheets
+            )
+            + '</Types>'
+        ))
+        self._zip.writestr("_rels/.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            '<Relationship Id="rId1" '
+            'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" '
+            'Target="xl/workbook.xml"/></Relationships>'
+        ))
+        self._zip.writestr("xl/workbook.xml", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+            'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><sheets>'
+            + "".join(
+                f'<sheet name="{escape(name)}" sheetId="{i}" r:id="rId{i}"/>' for i, name in zip(sheets, names)
+            )
+            + '</sheets></workbook>'
+        ))
+        self._zip.writestr("xl/_rels/workbook.xml.rels", (
+            '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+            '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+            + "".join(
+                f'<Relationship Id="rId{i}" '
+                'Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" '
+                f'Target="worksheets/sheet{i}.xml"/>'
+                for i in sheets
+            )
+            + '</Relationships>'
+        ))
+        self._zip.close()
+
+
+class SpooledInputFile(InputFile):
+    """Документ для отправки из временного файла выгрузки, читается порциями"""
+
+    def __init__(self, fileobj: SpooledTemporaryFile, filename: str, size: int, rows: int):
+        super().__init__(filename=filename)
+        self.fileobj = fileobj
+        self.size = size
+        self.rows = rows
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        self.fileobj.seek(0)
+        while chunk := await asyncio.to_thread(self.fileobj.read, self.chunk_size):
+            yield chunk
+
+    def close(self):
+        self.fileobj.close()
+
+
+def get_export_executor() -> ThreadPoolExecutor:
+    """Ограниченный пул потоков для выгрузок"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=max(1, EXPORT_WORKERS), thread_name_prefix="export")
+    return _executor
+
+
+def shutdown_export_executor():
+    """Останавливает пул выгрузок (при завершении работы бота)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+def _csv_safe(row) -> list:
+    # Текст вида "=..." Excel выполнил бы как формулу: имена вводят сами пользователи
+    return [
+        "'" + value if type(value) is str and value.startswith(_FORMULA_PREFIXES) else value
+        for value in row
+    ]
+
+
+def _write_csv(chunks, fileobj, columns: List[str]) -> int:
+    # BOM и разделитель ";" — чтобы Excel с русской локалью открыл файл сразу
+    fileobj.write(codecs.BOM_UTF8)
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, delimiter=";")
+    writer.writerow(columns)
+    rows = 0
+    for chunk in chunks:
+        writer.writerows([_csv_safe(row) for row in chunk])
+        rows += len(chunk)
+        # Порция кодируется и пишется целиком, буфер переиспользуется
+        fileobj.write(buffer.getvalue().encode("utf-8"))
+        buffer.seek(0)
+        buffer.truncate()
+    fileobj.write(buffer.getvalue().encode("utf-8"))
+    return rows
+
+
+def _write_xlsx(chunks, fileobj, columns: List[str], title: str) -> int:
+    writer = XlsxStreamWriter(fileobj, columns, title)
+    rows = 0
+    for chunk in chunks:
+        writer.writerows(chunk)
+        rows += len(chunk)
+    writer.close()
+    return rows
+
+
+def _zip_file(fileobj, name: str) -> SpooledTemporaryFile:
+    packed = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    fileobj.seek(0)
+    with zipfile.ZipFile(packed, "w", zipfile.ZIP_DEFLATED) as archive:
+        with archive.open(name, "w") as entry:
+            shutil.copyfileobj(fileobj, entry)
+    return packed
+
+
+def _build_export(db: Database, kind: str, fmt: str, center_id: Optional[int]) -> SpooledInputFile:
+    columns = EXPORT_QUERIES[kind]["columns"]
+    scope = center_id if center_id is not None else "all"
+    name = f"{kind}_{scope}_{datetime.now(timezone.utc):%Y%m%d}.{fmt}"
+    chunks = db.iter_export(kind, center_id)
+
+    fileobj = SpooledTemporaryFile(max_size=EXPORT_SPOOL_SIZE)
+    try:
+        if fmt == "xlsx":
+            rows = _write_xlsx(chunks, fileobj, columns, EXPORT_KINDS[kind])
+        else:
+            rows = _write_csv(chunks, fileobj, columns)
+        size = fileobj.tell()
+
+        # CSV хорошо сжимается: большой файл отправляем архивом
+        if fmt == "csv" and size > EXPORT_MAX_FILE_SIZE:
+            packed = _zip_file(fileobj, name)
+            fileobj.close()
+            fileobj, name = packed, name[:-len(".csv")] + ".zip"
+            size = fileobj.tell()
+        if size > EXPORT_MAX_FILE_SIZE:
+            raise ExportTooLarge(size)
+    except BaseException:
+        fileobj.close()
+        raise
+    return SpooledInputFile(fileobj, name, size, rows)
+
+
+async def build_export(db: Database, kind: str, fmt: str, center_id: Optional[int] = None) -> SpooledInputFile:
+    """
+    Готовит файл выгрузки в пуле потоков
+
+    Файл нужно закрыть (close) после отправки.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_export_executor(), _build_export, db, kind, fmt, center_id)
+
+
+def start_export(bot: Bot, chat_id: int, db: Database, kind: str, fmt: str, center_id: Optional[int] = None) -> bool:
+    """
+    Запускает выгрузку фоновой задачей (по одной выгрузке на чат)
+
+    Обработчик апдейта не ждёт сборки файла и не держит воркер вебхука.
+    Возвращает False, если выгрузка для чата уже готовится.
+    """
+    if chat_id in _running:
+        return False
+
+    _running.add(chat_id)
+    task = asyncio.create_task(_send_export(bot, chat_id, db, kind, fmt, center_id))
+    _tasks.add(task)
+    task.add_done_callback(_tasks.discard)
+    return True
+
+
+async def cancel_exports():
+    """Отменяет незавершённые выгрузки (при завершении работы бота)"""
+    for task in _tasks:
+        task.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+
+
+async def _send_export(bot: Bot, chat_id: int, db: Database, kind: str, fmt: str, center_id: Optional[int]):
+    """Готовит выгрузку и отправляет её документом в чат"""
+    try:
+        await bot.send_message(chat_id, f"⏳ Готовлю выгрузку «{EXPORT_KINDS[kind]}» ({fmt.upper()})...")
+        try:
+            document = await build_export(db, kind, fmt, center_id)
+        except ExportTooLarge as e:
+            await bot.send_message(
+                chat_id,
+                f"❌ Файл выгрузки слишком большой для Telegram ({e.size / 1024 / 1024:.1f} МБ)."
+            )
+            return
+
+        try:
+            # Большой файл не должен задерживать QR-коды и ответы другим чатам
+            with send_priority(Priority.BULK):
+                await bot.send_document(
+                    chat_id, document,
+                    caption=f"📤 {EXPORT_KINDS[kind]}: {document.rows} строк"
+                )
+        finally:
+            document.close()
+    except Exception as e:
+        logger.error(f"Ошибка выгрузки {kind} ({fmt}) для чата {chat_id}: {e}", exc_info=True)
+        await bot.send_message(chat_id, "❌ Не удалось подготовить выгрузку. Попробуйте позже.")
+    finally:
+        _running.discard(chat_id)
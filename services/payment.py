@@ -1,17 +1,38 @@
 """
 Платежный сервис AirbaPay для Telegram бота
 """
-import requests
+import aiohttp
+import base64
+import json
+import time
 import uuid
 import logging
 import asyncio
-from typing import Dict, Any, Optional, Callable
+from collections import OrderedDict
+from typing import Dict, Any, Optional, Callable, Awaitable, Hashable, Tuple
 from functools import wraps
+from urllib.parse import quote
 from decimal import Decimal
 from datetime import date, datetime
 
+from config import (
+    AIRBA_PAY_POOL_SIZE, AIRBA_PAY_KEEPALIVE, AIRBA_PAY_TOKEN_TTL, AIRBA_PAY_TOKEN_MARGIN,
+    AIRBA_PAY_BASE_URL, AIRBA_PAY_USER, AIRBA_PAY_PASSWORD, AIRBA_PAY_TERMINAL_ID, AIRBA_PAY_COMPANY_ID,
+    AIRBA_PAY_WEBHOOK_SECRET
+)
+
 logger = logging.getLogger(__name__)
 
+# Общая HTTP-сессия: соединения с AirbaPay переиспользуются между запросами
+_session: Optional[aiohttp.ClientSession] = None
+
+# Один менеджер токенов на учётную запись терминала и один клиент из настроек
+_token_managers: Dict[Tuple[str, str, str], "TokenManager"] = {}
+_client: Optional["AirbaPayClient"] = None
+
+# Создаваемые сейчас платежи по ключу идемпотентности: дубликаты ждут первый запрос
+_inflight_payments: Dict[str, asyncio.Future] = {}
+
 
 def convert_for_json_serialization(data):
     """
@@ -29,19 +50,189 @@ def convert_for_json_serialization(data):
         return data
 
 
+def get_http_session() -> aiohttp.ClientSession:
+    """Общая сессия с пулом keep-alive соединений (создаётся при первом запросе)"""
+    global _session
+    if _session is None or _session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=AIRBA_PAY_POOL_SIZE,
+            keepalive_timeout=AIRBA_PAY_KEEPALIVE,
+            ttl_dns_cache=300,
+        )
+        _session = aiohttp.ClientSession(connector=connector)
+    return _session
+
+
+async def close_http_session():
+    """Закрывает общую сессию (при остановке бота)"""
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+    _session = None
+
+
+def _token_expires_at(token: str, data: Dict[str, Any]) -> float:
+    """Время истечения токена: expires_in из ответа, exp из JWT или AIRBA_PAY_TOKEN_TTL"""
+    now = time.time()
+    expires_in = data.get('expires_in')
+    if expires_in:
+        try:
+            return now + float(expires_in)
+        except (TypeError, ValueError):
+            pass
+    
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        exp = json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+        if exp:
+            return float(exp)
+    except (IndexError, ValueError, TypeError, AttributeError):
+        pass
+    
+    return now + AIRBA_PAY_TOKEN_TTL
+
+
+class TokenManager:
+    """
+    Общие для процесса токены доступа AirbaPay
+    
+    Токен хранится по области (None — общий, иначе payment_id) до
+    AIRBA_PAY_TOKEN_MARGIN секунд перед истечением. Одновременные запросы
+    токена одной области выполняют один sign-in.
+    """
+    
+    def __init__(self, margin: float = AIRBA_PAY_TOKEN_MARGIN, max_scopes: int = 1024):
+        self.margin = margin
+        self.max_scopes = max_scopes
+        self._tokens: "OrderedDict[Hashable, Tuple[str, float]]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        self.metrics = {
+            'hits': 0,
+            'refreshes': 0,
+            'coalesced': 0,
+            'failures': 0,
+            'unauthorized_retries': 0,
+        }
+    
+    def peek(self, scope: Hashable = None) -> Optional[str]:
+        """Действующий токен области без обновления"""
+        item = self._tokens.get(scope)
+        if item is None:
+            return None
+        token, expires_at = item
+        if expires_at - self.margin <= time.time():
+            del self._tokens[scope]
+            return None
+        return token
+    
+    async def get_token(self, scope: Hashable,
+                        sign_in: Callable[[], Awaitable[Optional[Tuple[str, float]]]]) -> Optional[str]:
+        """Токен из кэша или результат sign_in() -> (token, expires_at) | None"""
+        token = self.peek(scope)
+        if token:
+            self.metrics['hits'] += 1
+            return token
+        
+        future = self._inflight.get(scope)
+        if future is not None:
+            self.metrics['coalesced'] += 1
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[scope] = future
+        try:
+            self.metrics['refreshes'] += 1
+            result = await sign_in()
+            token = None
+            if result:
+                token, expires_at = result
+                self._tokens[scope] = (token, expires_at)
+                self._tokens.move_to_end(scope)
+                while len(self._tokens) > self.max_scopes:
+                    self._tokens.popitem(last=False)
+            else:
+                self.metrics['failures'] += 1
+            future.set_result(token)
+            return token
+        except BaseException as e:
+            self.metrics['failures'] += 1
+            future.set_exception(e)
+            # Исключение получат ожидающие; для future без ожидающих подавляем предупреждение
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(scope, None)
+    
+    def invalidate(self, scope: Hashable = None, token: Optional[str] = None):
+        """Сбрасывает токен области (только если он совпадает с token, когда тот указан)"""
+        item = self._tokens.get(scope)
+        if item and (token is None or item[0] == token):
+            del self._tokens[scope]
+    
+    def stats(self) -> Dict[str, int]:
+        return dict(self.metrics, cached=len(self._tokens), inflight=len(self._inflight))
+
+
+def get_token_manager(base_url: str, user: str, terminal_id: str) -> TokenManager:
+    """Общий менеджер токенов для учётной записи терминала"""
+    key = (base_url, user, terminal_id)
+    manager = _token_managers.get(key)
+    if manager is None:
+        manager = _token_managers[key] = TokenManager()
+    return manager
+
+
+def get_airba_client() -> "AirbaPayClient":
+    """Общий клиент AirbaPay с настройками из config"""
+    global _client
+    if _client is None:
+        _client = AirbaPayClient(
+            base_url=AIRBA_PAY_BASE_URL,
+            user=AIRBA_PAY_USER,
+            password=AIRBA_PAY_PASSWORD,
+            terminal_id=AIRBA_PAY_TERMINAL_ID,
+            company_id=AIRBA_PAY_COMPANY_ID
+        )
+    return _client
+
+
 class AirbaPayClient:
-    """Клиент для работы с AirbaPay API"""
+    """Асинхронный клиент для работы с AirbaPay API"""
+    
+    # Таймауты по типу запроса (секунды): полный таймаут, подключение
+    TIMEOUTS = {
+        'auth': (10, 5),
+        'create': (20, 5),
+        'status': (10, 5),
+        'cards': (15, 5),
+        'charge': (30, 5),
+        'refund': (30, 5),
+    }
+    DEFAULT_TIMEOUT = (30, 5)
     
-    def __init__(self, base_url: str, user: str, password: str, terminal_id: str, company_id: str = "230140022645"):
+    def __init__(self, base_url: str, user: str, password: str, terminal_id: str, company_id: str = "230140022645",
+                 session: Optional[aiohttp.ClientSession] = None, tokens: Optional[TokenManager] = None):
         self.base_url = base_url
         self.user = user
         self.password = password
         self.terminal_id = terminal_id
         self.company_id = company_id
         self.access_token = None
+        self._session = session
+        self.tokens = tokens or get_token_manager(base_url, user, terminal_id)
+    
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        return self._session or get_http_session()
+    
+    def _timeout(self, kind: Optional[str]) -> aiohttp.ClientTimeout:
+        total, connect = self.TIMEOUTS.get(kind, self.DEFAULT_TIMEOUT)
+        return aiohttp.ClientTimeout(total=total, connect=connect)
         
-    def _make_request(self, method: str, endpoint: str, data: Dict[str, Any] = None, 
-                     headers: Dict[str, str] = None) -> Dict[str, Any]:
+    async def _make_request(self, method: str, endpoint: str, data: Dict[str, Any] = None, 
+                            headers: Dict[str, str] = None, kind: str = None,
+                            token: Optional[str] = None) -> Dict[str, Any]:
         """Выполняет HTTP запрос к API"""
         url = f"{self.base_url}{endpoint}"
         
@@ -52,33 +243,34 @@ class AirbaPayClient:
         if headers:
             default_headers.update(headers)
             
-        if self.access_token:
-            default_headers['Authorization'] = f'Bearer {self.access_token}'
+        if token:
+            default_headers['Authorization'] = f'Bearer {token}'
         
         if data:
             data = convert_for_json_serialization(data)
         
         try:
-            response = requests.request(
+            async with self.session.request(
                 method=method,
                 url=url,
                 json=data,
                 headers=default_headers,
-                timeout=30
-            )
-            
-            logger.info(f"Airba Pay API request: {method} {url} - Status: {response.status_code}")
-            
-            if response.status_code >= 400:
-                logger.error(f"Airba Pay API error: {response.text}")
+                timeout=self._timeout(kind)
+            ) as response:
+                content = await response.read()
                 
-            return {
-                'status_code': response.status_code,
-                'data': response.json() if response.content else {},
-                'success': 200 <= response.status_code < 300
-            }
+                logger.info(f"Airba Pay API request: {method} {url} - Status: {response.status}")
+                
+                if response.status >= 400:
+                    logger.error(f"Airba Pay API error: {content.decode('utf-8', 'replace')}")
+                    
+                return {
+                    'status_code': response.status,
+                    'data': json.loads(content) if content else {},
+                    'success': 200 <= response.status < 300
+                }
             
-        except requests.exceptions.RequestException as e:
+        except (aiohttp.ClientError, asyncio.TimeoutError, ValueError) as e:
             logger.error(f"Airba Pay API request failed: {str(e)}")
             return {
                 'status_code': 500,
@@ -86,12 +278,21 @@ class AirbaPayClient:
                 'success': False
             }
     
-    def authenticate(self, payment_id: Optional[str] = None, subscription_id: Optional[str] = None) -> bool:
-        """Аутентификация в AirbaPay API (синхронная)"""
+    async def authenticate(self, payment_id: Optional[str] = None, subscription_id: Optional[str] = None) -> bool:
+        """Аутентификация в AirbaPay API (токен берётся из общего кэша)"""
+        token = await self._get_token(payment_id)
+        if not payment_id:
+            self.access_token = token
+        return token is not None
+    
+    async def _get_token(self, payment_id: Optional[str] = None) -> Optional[str]:
         if not self.user or not self.password or not self.terminal_id:
             logger.error(f"Missing Airbapay credentials - user: {bool(self.user)}, password: {bool(self.password)}, terminal_id: {bool(self.terminal_id)}")
-            return False
-            
+            return None
+        return await self.tokens.get_token(payment_id, lambda: self._sign_in(payment_id))
+    
+    async def _sign_in(self, payment_id: Optional[str] = None) -> Optional[Tuple[str, float]]:
+        """Запрос нового токена: (token, expires_at) или None"""
         auth_data = {
             'user': self.user,
             'password': self.password,
@@ -103,80 +304,139 @@ class AirbaPayClient:
         
         logger.info(f"Attempting authentication with user: {self.user}, terminal_id: {self.terminal_id}")
             
-        response = self._make_request('POST', '/api/v1/auth/sign-in', auth_data)
+        response = await self._make_request('POST', '/api/v1/auth/sign-in', auth_data, kind='auth')
         
         if response['success'] and 'access_token' in response['data']:
-            self.access_token = response['data']['access_token']
+            token = response['data']['access_token']
             logger.info("Authentication successful")
-            return True
+            return token, _token_expires_at(token, response['data'])
         
         logger.error(f"Authentication failed: {response.get('data', {})}")
-        return False
+        return None
+    
+    @staticmethod
+    def _auth_failed() -> Dict[str, Any]:
+        """Ответ в формате _make_request, когда токен получить не удалось"""
+        return {
+            'status_code': 401,
+            'data': {'error': 'Authentication failed'},
+            'success': False,
+            'error': 'Authentication failed'
+        }
     
-    def add_card(self, card_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def _authorized_request(self, method: str, endpoint: str, data: Dict[str, Any] = None,
+                                  kind: str = None, payment_id: Optional[str] = None) -> Dict[str, Any]:
+        """Запрос с токеном из кэша; при 401 токен обновляется и запрос повторяется один раз"""
+        token = await self._get_token(payment_id)
+        if not token:
+            return self._auth_failed()
+        
+        response = await self._make_request(method, endpoint, data, kind=kind, token=token)
+        if response['status_code'] != 401:
+            return response
+        
+        self.tokens.invalidate(payment_id, token)
+        self.tokens.metrics['unauthorized_retries'] += 1
+        token = await self._get_token(payment_id)
+        if not token:
+            return self._auth_failed()
+        return await self._make_request(method, endpoint, data, kind=kind, token=token)
+    
+    async def add_card(self, card_data: Dict[str, Any]) -> Dict[str, Any]:
         """Добавить новую карту"""
-        if not self.access_token:
-            if not self.authenticate():
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('POST', '/api/v1/cards', card_data)
+        return await self._authorized_request('POST', '/api/v1/cards', card_data, kind='cards')
     
-    def get_saved_cards(self, account_id: str) -> Dict[str, Any]:
+    async def get_saved_cards(self, account_id: str) -> Dict[str, Any]:
         """Получить сохраненные карты"""
-        if not self.access_token:
-            if not self.authenticate():
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('GET', f'/api/v1/cards/{account_id}')
+        return await self._authorized_request('GET', f'/api/v1/cards/{account_id}', kind='cards')
     
-    def delete_saved_card(self, card_id: str) -> Dict[str, Any]:
+    async def delete_saved_card(self, card_id: str) -> Dict[str, Any]:
         """Удалить сохраненную карту"""
-        if not self.access_token:
-            if not self.authenticate():
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('DELETE', f'/api/v1/cards/{card_id}')
+        return await self._authorized_request('DELETE', f'/api/v1/cards/{card_id}', kind='cards')
     
-    def create_payment(self, payment_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def create_payment(self, payment_data: Dict[str, Any]) -> Dict[str, Any]:
         """Создать новый платеж"""
-        if not self.access_token:
-            if not self.authenticate():
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('POST', '/api/v2/payments/', payment_data)
+        return await self._authorized_request('POST', '/api/v2/payments/', payment_data, kind='create')
     
-    def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
+    async def get_payment_status(self, payment_id: str) -> Dict[str, Any]:
         """Получить статус платежа"""
-        if not self.access_token:
-            if not self.authenticate(payment_id=payment_id):
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('GET', f'/api/v1/payments/{payment_id}')
+        return await self._authorized_request('GET', f'/api/v1/payments/{payment_id}', kind='status', payment_id=payment_id)
     
-    def charge_payment(self, payment_id: str, charge_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def charge_payment(self, payment_id: str, charge_data: Dict[str, Any]) -> Dict[str, Any]:
         """Подтвердить платеж (двухэтапная оплата)"""
-        if not self.access_token:
-            if not self.authenticate(payment_id=payment_id):
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('PUT', '/api/v1/payments/charge', charge_data)
+        return await self._authorized_request('PUT', '/api/v1/payments/charge', charge_data, kind='charge', payment_id=payment_id)
     
-    def refund_payment(self, payment_id: str, refund_data: Dict[str, Any]) -> Dict[str, Any]:
+    async def refund_payment(self, payment_id: str, refund_data: Dict[str, Any]) -> Dict[str, Any]:
         """Возврат платежа"""
-        if not self.access_token:
-            if not self.authenticate(payment_id=payment_id):
-                return {'success': False, 'error': 'Authentication failed'}
-        return self._make_request('DELETE', '/api/v1/payments/return', refund_data)
+        return await self._authorized_request('DELETE', '/api/v1/payments/return', refund_data, kind='refund', payment_id=payment_id)
 
 
 class PaymentService:
     """Сервис для обработки платежей через AirbaPay"""
     
-    def __init__(self, client: AirbaPayClient, db, webhook_url: str = None):
+    # Итоговые статусы AirbaPay: после них платеж больше не меняется
+    FINAL_STATUSES = ('success', 'failed')
+    
+    def __init__(self, client: AirbaPayClient, db, webhook_url: str = None,
+                 webhook_secret: str = AIRBA_PAY_WEBHOOK_SECRET):
         self.client = client
         self.db = db
         self.webhook_url = webhook_url or ""
+        self.webhook_secret = webhook_secret
+    
+    def _callback_url(self, kind: str) -> str:
+        """Адрес уведомления AirbaPay с секретом, по которому обработчик отличает его от подделки"""
+        if not self.webhook_url:
+            return ""
+        url = f"{self.webhook_url}/webhook/payment/{kind}"
+        if self.webhook_secret:
+            url += f"?token={quote(self.webhook_secret, safe='')}"
+        return url
     
     async def create_payment(self, user_id: int, subscription_id: int, amount: float, 
                            currency: str = "KZT", description: str = "", 
-                           language: str = "ru", phone: str = "", email: str = "") -> Dict[str, Any]:
+                           language: str = "ru", phone: str = "", email: str = "",
+                           idempotency_key: str = None) -> Dict[str, Any]:
         """
         Создать платеж для абонемента
+        
+        Повторы с тем же idempotency_key (по умолчанию — абонемент и сумма)
+        не создают новый платеж: одновременные ждут первый запрос, более
+        поздние получают незавершённый платеж из базы с той же ссылкой на оплату.
         """
+        key = idempotency_key or f"subscription:{subscription_id}:{float(amount)}"
+        
+        future = _inflight_payments.get(key)
+        if future is not None:
+            return await asyncio.shield(future)
+        
+        future = asyncio.get_running_loop().create_future()
+        _inflight_payments[key] = future
+        try:
+            result = await self._create_payment(
+                key, user_id, subscription_id, amount, currency, description, language, phone, email
+            )
+            future.set_result(result)
+            return result
+        except BaseException as e:
+            future.set_exception(e)
+            future.exception()
+            raise
+        finally:
+            _inflight_payments.pop(key, None)
+    
+    async def _create_payment(self, key: str, user_id: int, subscription_id: int, amount: float,
+                              currency: str, description: str, language: str, phone: str, email: str) -> Dict[str, Any]:
+        existing = await self.db.get_pending_payment_by_key(key)
+        if existing and existing.get('redirect_url'):
+            return {
+                'success': True,
+                'payment_id': existing['payment_id'],
+                'redirect_url': existing['redirect_url'],
+                'invoice_id': existing['invoice_id'],
+                'duplicate': True
+            }
+        
         invoice_id = f"BOT_{uuid.uuid4().hex[:8].upper()}"
         
         payment_data = {
@@ -192,8 +452,8 @@ class PaymentService:
             'language': language.upper(),
             'success_back_url': f"{self.webhook_url}/payment/success" if self.webhook_url else "",
             'failure_back_url': f"{self.webhook_url}/payment/failure" if self.webhook_url else "",
-            'success_callback': f"{self.webhook_url}/webhook/payment/success" if self.webhook_url else "",
-            'failure_callback': f"{self.webhook_url}/webhook/payment/failure" if self.webhook_url else "",
+            'success_callback': self._callback_url("success"),
+            'failure_callback': self._callback_url("failure"),
             'settlement': {
                 'payments': [
                     {
@@ -204,14 +464,7 @@ class PaymentService:
             }
         }
         
-        # Выполняем синхронный запрос в отдельном потоке
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        response = await loop.run_in_executor(None, self.client.create_payment, payment_data)
+        response = await self.client.create_payment(payment_data)
         
         if not response['success']:
             return response
@@ -227,7 +480,8 @@ class PaymentService:
             invoice_id=invoice_id,
             airba_payment_id=airba_response.get('id', ''),
             redirect_url=airba_response.get('redirect_url', ''),
-            status='pending'
+            status='pending',
+            idempotency_key=key
         )
         
         return {
@@ -244,32 +498,38 @@ class PaymentService:
         if not payment:
             return {'success': False, 'error': 'Payment not found'}
         
+        return await self.sync_payment_status(payment)
+    
+    async def sync_payment_status(self, payment: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Запрашивает статус платежа у AirbaPay и сохраняет итоговый статус
+        
+        В ответе finalized=True только у вызова, который перевёл платеж
+        в итоговый статус: он и должен активировать абонемент.
+        """
         if not payment.get('airba_payment_id'):
             return {'success': False, 'error': 'Airba payment ID not found'}
         
-        # Выполняем синхронный запрос в отдельном потоке
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        response = await loop.run_in_executor(None, self.client.get_payment_status, payment['airba_payment_id'])
+        response = await self.client.get_payment_status(payment['airba_payment_id'])
         
         if response['success']:
             airba_data = response['data']
             status = airba_data.get('status', 'pending')
             
-            # Обновляем статус в базе данных
-            await self.db.update_payment_status(
-                payment_id=payment_id,
-                status=status,
-                transaction_id=airba_data.get('transaction_id', '')
-            )
+            # Промежуточные статусы не сохраняем: платеж остаётся pending до итогового
+            finalized = False
+            if status in self.FINAL_STATUSES:
+                finalized = await self.db.finalize_payment(
+                    payment_id=payment['payment_id'],
+                    status=status,
+                    transaction_id=airba_data.get('transaction_id', ''),
+                    error_message=airba_data.get('error_message') if status != 'success' else None
+                )
             
             return {
                 'success': True,
                 'status': status,
+                'finalized': finalized,
                 'payment': payment,
                 'airba_data': airba_data
             }
@@ -302,14 +562,7 @@ class PaymentService:
             }
         }
         
-        # Выполняем синхронный запрос в отдельном потоке
-        try:
-            loop = asyncio.get_running_loop()
-        except RuntimeError:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-        
-        response = await loop.run_in_executor(None, self.client.refund_payment, payment['airba_payment_id'], refund_data)
+        response = await self.client.refund_payment(payment['airba_payment_id'], refund_data)
         
         if response['success']:
             await self.db.create_payment_refund(
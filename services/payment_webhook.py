@@ -0,0 +1,164 @@
+"""
+Приём уведомлений AirbaPay (success_callback / failure_callback)
+
+Уведомление принимается, только если в адресе тот же секрет
+(AIRBA_PAY_WEBHOOK_SECRET), что бот передал в success_callback / failure_callback.
+Телу уведомления не доверяем: по invoice_id / id находим платеж и
+перепроверяем статус запросом к AirbaPay. Повторные уведомления
+отсекает Database.finalize_payment — абонемент активируется один раз.
+Ответ не зависит от того, найден ли платеж и чем закончился, — по нему
+нельзя подобрать существующие invoice_id.
+"""
+import hmac
+import json
+import logging
+from typing import Any, Dict, Optional
+from urllib.parse import urlparse
+
+from aiohttp import web
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from config import AIRBA_PAY_WEBHOOK_SECRET
+from database import Database
+from services.payment import PaymentService
+from services.subscriptions import activate_paid_subscription, notify_payment_failed
+
+logger = logging.getLogger(__name__)
+
+
+def webhook_path_prefix(webhook_url: str) -> str:
+    """Путь из AIRBA_PAY_WEBHOOK_URL, под которым AirbaPay шлёт уведомления"""
+    return urlparse(webhook_url or "").path.rstrip("/")
+
+
+class PaymentWebhookHandler:
+    """Обработчик POST {prefix}/webhook/payment/success|failure"""
+
+    def __init__(self, bot: Bot, db: Database, payment_service: PaymentService,
+                 secret: str = AIRBA_PAY_WEBHOOK_SECRET):
+        self.bot = bot
+        self.db = db
+        self.payment_service = payment_service
+        self.secret = secret
+        self.metrics = {
+            "received": 0,
+            "forbidden": 0,
+            "activated": 0,
+            "failed": 0,
+            "duplicates": 0,
+            "pending": 0,
+            "unknown": 0,
+            "errors": 0,
+        }
+
+    @staticmethod
+    async def _read_body(request: web.Request) -> Optional[Dict[str, Any]]:
+        try:
+            if request.content_type == "application/x-www-form-urlencoded":
+                return dict(await request.post())
+            body = await request.read()
+            data = json.loads(body) if body else {}
+            return data if isinstance(data, dict) else None
+        except ValueError:
+            return None
+
+    async def _find_payment(self, data: Dict[str, Any]) -> Optional[Dict[str, Any]]:
+        invoice_id = data.get("invoice_id")
+        if invoice_id:
+            payment = await self.db.get_payment_by_invoice(invoice_id=str(invoice_id))
+            if payment:
+                return payment
+        airba_payment_id = data.get("id") or data.get("payment_id")
+        if airba_payment_id:
+            return await self.db.get_payment_by_invoice(airba_payment_id=str(airba_payment_id))
+        return None
+
+    def _authorized(self, request: web.Request) -> bool:
+        if not self.secret:
+            return True
+        return hmac.compare_digest(request.query.get("token", "").encode(), self.secret.encode())
+
+    @staticmethod
+    def _accepted() -> web.Response:
+        return web.json_response({"status": "accepted"})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.metrics["received"] += 1
+        if not self._authorized(request):
+            self.metrics["forbidden"] += 1
+            return web.json_response({"error": "forbidden"}, status=403)
+
+        data = await self._read_body(request)
+        if data is None:
+            return web.json_response({"error": "invalid body"}, status=400)
+
+        payment = await self._find_payment(data)
+        if not payment:
+            self.metrics["unknown"] += 1
+            logger.warning(f"Уведомление AirbaPay для неизвестного платежа: {data.get('invoice_id') or data.get('id')}")
+            return self._accepted()
+
+        # Статус берём у AirbaPay, а не из тела запроса
+        result = await self.payment_service.sync_payment_status(payment)
+        if not result.get("success"):
+            self.metrics["errors"] += 1
+            # 5xx — AirbaPay повторит уведомление позже
+            return web.json_response({"error": "status check failed"}, status=502)
+
+        status = result["status"]
+        if not result.get("finalized"):
+            key = "duplicates" if status in PaymentService.FINAL_STATUSES else "pending"
+            self.metrics[key] += 1
+            return self._accepted()
+
+        if status == "success":
+            try:
+                await activate_paid_subscription(self.bot, self.db, payment)
+                self.metrics["activated"] += 1
+            except Exception as e:
+                # Платеж уже success, повтор уведомления его не активирует — активацию повторит сверка
+                self.metrics["errors"] += 1
+                logger.error(f"Не удалось активировать абонемент по платежу {payment['payment_id']}: {e}", exc_info=True)
+        else:
+            try:
+                await notify_payment_failed(self.bot, payment)
+            except TelegramAPIError as e:
+                logger.error(f"Не удалось уведомить пользователя о платеже {payment['payment_id']}: {e}")
+            self.metrics["failed"] += 1
+
+        return self._accepted()
+
+
+def create_payment_webhook_app(bot: Bot, db: Database, payment_service: PaymentService,
+                               prefix: str = "") -> web.Application:
+    """aiohttp-приложение с маршрутами уведомлений AirbaPay"""
+    handler = PaymentWebhookHandler(bot, db, payment_service)
+    if not handler.secret:
+        logger.warning("AIRBA_PAY_WEBHOOK_SECRET не задан: уведомления AirbaPay принимаются без проверки")
+    app = web.Application()
+    app["payment_webhook"] = handler
+    app.router.add_post(f"{prefix}/webhook/payment/success", handler.handle)
+    app.router.add_post(f"{prefix}/webhook/payment/failure", handler.handle)
+    return app
+
+
+class PaymentWebhookServer:
+    """HTTP-сервер уведомлений, работает в том же цикле событий, что и бот"""
+
+    def __init__(self, app: web.Application, host: str, port: int):
+        self.app = app
+        self.host = host
+        self.port = port
+        self._runner: Optional[web.AppRunner] = None
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Приём уведомлений AirbaPay на {self.host}:{self.port}")
+
+    async def stop(self):
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -0,0 +1,162 @@
+"""
+Фоновая сверка незавершённых платежей с AirbaPay
+
+Раз в interval секунд берёт ограниченную пачку самых старых pending-платежей,
+параллельно (не больше concurrency запросов) запрашивает их статус,
+применяет результаты одной транзакцией и отменяет брошенные платежи
+вместе с временными абонементами — только если AirbaPay ответил, что
+платеж не завершён. Там же повторяется активация абонементов по успешным
+платежам, если она не удалась после коммита.
+"""
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+
+from config import (
+    PAYMENT_RECONCILE_INTERVAL, PAYMENT_RECONCILE_STALE_AFTER, PAYMENT_RECONCILE_BATCH,
+    PAYMENT_RECONCILE_CONCURRENCY, PAYMENT_EXPIRE_AFTER
+)
+from database import Database
+from services.payment import AirbaPayClient, PaymentService
+from services.subscriptions import activate_paid_subscription, notify_payment_failed
+
+logger = logging.getLogger(__name__)
+
+
+class PaymentReconciler:
+    """Периодическая сверка pending-платежей"""
+
+    # Повторы запроса статуса: число попыток и первая пауза (удваивается)
+    ATTEMPTS = 3
+    BACKOFF = 0.5
+
+    def __init__(self, bot: Bot, db: Database, client: AirbaPayClient,
+                 interval: float = PAYMENT_RECONCILE_INTERVAL,
+                 stale_after: float = PAYMENT_RECONCILE_STALE_AFTER,
+                 expire_after: float = PAYMENT_EXPIRE_AFTER,
+                 batch_size: int = PAYMENT_RECONCILE_BATCH,
+                 concurrency: int = PAYMENT_RECONCILE_CONCURRENCY):
+        self.bot = bot
+        self.db = db
+        self.client = client
+        self.interval = interval
+        self.stale_after = stale_after
+        self.expire_after = expire_after
+        self.batch_size = batch_size
+        self.concurrency = max(1, concurrency)
+        self._task: Optional[asyncio.Task] = None
+
+    async def _fetch_status(self, payment: Dict[str, Any], semaphore: asyncio.Semaphore) -> Optional[Dict[str, Any]]:
+        """Данные платежа из AirbaPay или None, если запрос так и не удался"""
+        if not payment.get("airba_payment_id"):
+            return None
+
+        delay = self.BACKOFF
+        for attempt in range(self.ATTEMPTS):
+            async with semaphore:
+                response = await self.client.get_payment_status(payment["airba_payment_id"])
+            if response.get("success"):
+                return response["data"]
+            # 4xx кроме 429 не исправится повтором
+            status_code = response.get("status_code", 500)
+            if 400 <= status_code < 500 and status_code != 429:
+                return None
+            if attempt + 1 < self.ATTEMPTS:
+                await asyncio.sleep(delay)
+                delay *= 2
+        return None
+
+    async def run_once(self) -> Dict[str, int]:
+        """Одна итерация сверки; возвращает счётчики для логов"""
+        payments = await self.db.get_stale_pending_payments(self.stale_after, self.batch_size)
+        stats = {"checked": len(payments), "success": 0, "failed": 0, "expired": 0, "pending": 0,
+                 "unknown": 0, "activated": 0}
+        await self._activate_unactivated(stats)
+        if not payments:
+            return stats
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        results = await asyncio.gather(*(self._fetch_status(p, semaphore) for p in payments))
+
+        finalized, expired = [], []
+        for payment, data in zip(payments, results):
+            status = (data or {}).get("status")
+            if status in PaymentService.FINAL_STATUSES:
+                finalized.append((
+                    payment["payment_id"], status, data.get("transaction_id", ""),
+                    data.get("error_message") if status != "success" else None
+                ))
+            elif payment["age"] < self.expire_after:
+                stats["pending"] += 1
+            elif data is not None or not payment.get("airba_payment_id"):
+                # AirbaPay подтвердил незавершённый статус, или платеж до него не дошёл
+                expired.append(payment["payment_id"])
+            else:
+                # Статус неизвестен (сеть, 5xx, авторизация): платеж мог пройти,
+                # а уведомление потеряться — проверим на следующей сверке
+                stats["unknown"] += 1
+                logger.warning(f"Статус брошенного платежа {payment['payment_id']} не получен, отмена отложена")
+
+        done, expired_done = await self.db.apply_payment_results(finalized, expired)
+        stats["expired"] = len(expired_done)
+
+        # Сообщения отправляем после коммита и только по платежам, завершённым этой сверкой
+        by_id = {p["payment_id"]: p for p in payments}
+        statuses = {payment_id: status for payment_id, status, _, _ in finalized}
+        for payment_id in done:
+            payment = by_id[payment_id]
+            if statuses[payment_id] == "success":
+                stats["success"] += 1
+                try:
+                    await activate_paid_subscription(self.bot, self.db, payment)
+                except Exception as e:
+                    # Платеж уже success: активацию повторит следующая сверка
+                    logger.error(f"Не удалось активировать абонемент по платежу {payment_id}: {e}", exc_info=True)
+            else:
+                stats["failed"] += 1
+                try:
+                    await notify_payment_failed(self.bot, payment)
+                except TelegramAPIError as e:
+                    logger.error(f"Не удалось уведомить пользователя о платеже {payment_id}: {e}")
+        return stats
+
+    async def _activate_unactivated(self, stats: Dict[str, int]):
+        """Повторная активация абонементов по успешным, но не активированным платежам"""
+        payments = await self.db.get_unactivated_paid_payments(self.stale_after, self.batch_size)
+        for payment in payments:
+            try:
+                await activate_paid_subscription(self.bot, self.db, payment)
+                stats["activated"] += 1
+            except Exception as e:
+                logger.error(
+                    f"Повторная активация абонемента по платежу {payment['payment_id']} не удалась: {e}",
+                    exc_info=True
+                )
+
+    async def _loop(self):
+        while True:
+            try:
+                stats = await self.run_once()
+                if stats["checked"] or stats["activated"]:
+                    logger.info(f"Сверка платежей: {stats}")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Ошибка сверки платежей: {e}", exc_info=True)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
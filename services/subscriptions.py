@@ -0,0 +1,94 @@
+"""
+Активация оплаченных абонементов
+
+Общий код для уведомлений AirbaPay и ручной проверки платежа:
+выдаёт постоянный QR-код и отправляет его владельцу платежа.
+"""
+import logging
+from typing import Any, Dict
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramAPIError
+from aiogram.types import BufferedInputFile
+
+from database import Database
+from middleware.outbound import Priority, send_priority
+from services.analytics import invalidate_center_analytics
+from utils.qr_generator import render_subscription_qr, forget_subscription_qr
+from utils.qr_assets import remember_qr_file_id
+
+logger = logging.getLogger(__name__)
+
+
+async def activate_paid_subscription(bot: Bot, db: Database, payment: Dict[str, Any]) -> bool:
+    """
+    Выдаёт QR-код абонементу оплаченного платежа и отправляет его пользователю
+    
+    Вызывается тем, кто перевёл платеж в success (Database.finalize_payment), и сверкой
+    платежей, если активация после коммита платежа не удалась. Ошибки рендеринга
+    QR и базы пробрасываются; ошибки отправки сообщений только логируются.
+    """
+    with send_priority(Priority.TRANSACTIONAL):
+        return await _activate_paid_subscription(bot, db, payment)
+
+
+async def _activate_paid_subscription(bot: Bot, db: Database, payment: Dict[str, Any]) -> bool:
+    subscription_id = payment.get("subscription_id")
+    user_id = payment["user_id"]
+    subscription = await db.get_subscription(subscription_id) if subscription_id else None
+    
+    if not subscription:
+        logger.error(f"Платеж {payment['payment_id']} оплачен, но абонемент {subscription_id} не найден")
+        await _notify(bot, user_id, "✅ Платеж успешно выполнен!")
+        return False
+    
+    qr_id, qr_image = await render_subscription_qr(
+        subscription["user_id"], subscription_id, subscription.get("child_id")
+    )
+    await db.activate_subscription(subscription_id, qr_id)
+    invalidate_center_analytics(db, subscription["center_id"])
+    if subscription.get("activated_at") and subscription.get("qr_code"):
+        # Повторная активация выдала новый QR — прежний больше не действует
+        forget_subscription_qr(
+            subscription["qr_code"], subscription["user_id"], subscription_id, subscription.get("child_id")
+        )
+    
+    # Абонемент уже активирован: недоставленное сообщение не отменяет активацию
+    await _notify(
+        bot, user_id,
+        "✅ Платеж успешно выполнен!\n\n"
+        "🎉 Абонемент активирован!\n\n"
+        "Вот твой QR-код для посещений 👇"
+    )
+    
+    try:
+        sent = await bot.send_photo(
+            user_id,
+            photo=BufferedInputFile(qr_image.getvalue(), filename="qr_code.png"),
+            caption="Твой QR-код для посещений"
+        )
+        await remember_qr_file_id(db, subscription_id, qr_id, sent)
+    except Exception:
+        await _notify(
+            bot, user_id,
+            f"QR-код создан!\nКод: {qr_id}\n\n"
+            f"Установите Pillow для отображения QR-кода как изображения."
+        )
+    return True
+
+
+async def _notify(bot: Bot, user_id: int, text: str):
+    try:
+        await bot.send_message(user_id, text)
+    except TelegramAPIError as e:
+        logger.error(f"Не удалось отправить сообщение пользователю {user_id}: {e}")
+
+
+async def notify_payment_failed(bot: Bot, payment: Dict[str, Any]):
+    """Сообщает пользователю, что платеж не прошёл"""
+    with send_priority(Priority.TRANSACTIONAL):
+        await bot.send_message(
+            payment["user_id"],
+            "❌ Платеж не прошел.\n\n"
+            "Попробуйте оплатить снова или обратитесь в поддержку."
+        )
@@ -0,0 +1,84 @@
+"""
+Параллельные списания занятий и покупки: без двойного списания и дубликатов
+
+Кроме общего пула бот может работать несколькими процессами (polling и
+webhook платежей), поэтому часть вызовов идёт через отдельные пулы —
+свои соединения-писатели, которые конкурируют за BEGIN IMMEDIATE.
+"""
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from database import ConnectionPool, Database
+
+# Пулов-«процессов» и параллельных вызовов
+POOLS = 4
+CALLS = 400
+
+
+class ConcurrencyTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "concurrency.db")
+        self.db = Database(self.path)
+        await self.db.init_db()
+        async with self.db.pool.writer() as db:
+            await db.execute("INSERT INTO centers (center_id, partner_id, name) VALUES (1, 1, 'Центр')")
+            await db.execute(
+                "INSERT INTO courses (course_id, center_id, name, price_4, price_8) VALUES (1, 1, 'Шахматы', 10000, 18000)"
+            )
+
+        self.databases = [self.db]
+        for _ in range(POOLS - 1):
+            other = Database(self.path)
+            other.pool = ConnectionPool(self.path)
+            await other.pool.open()
+            self.databases.append(other)
+
+    async def asyncTearDown(self):
+        for db in reversed(self.databases):
+            await db.close()
+        self.tmp.cleanup()
+
+    def query(self, sql: str, params: tuple = ()) -> tuple:
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute(sql, params).fetchone()
+        finally:
+            conn.close()
+
+    async def test_parallel_scans_do_not_double_spend(self):
+        subscription_id = await self.db.create_subscription(1, 1, "8", "qr-stress")
+        lessons_total = self.query(
+            "SELECT lessons_total FROM subscriptions WHERE subscription_id = ?", (subscription_id,)
+        )[0]
+
+        results = await asyncio.gather(*(
+            self.databases[i % POOLS].record_visit(subscription_id, 1) for i in range(CALLS)
+        ))
+        visits = [result for result in results if result]
+
+        self.assertEqual(len(visits), lessons_total)
+        # Каждое списание видит свой остаток: lessons_total - 1, ..., 0
+        self.assertEqual(sorted(v["lessons_remaining"] for v in visits), list(range(lessons_total)))
+        self.assertEqual(
+            self.query("SELECT COUNT(*) FROM visits WHERE subscription_id = ?", (subscription_id,))[0],
+            lessons_total
+        )
+        self.assertEqual(
+            self.query("SELECT lessons_remaining, status FROM subscriptions WHERE subscription_id = ?",
+                       (subscription_id,)),
+            (0, "expired")
+        )
+        self.assertEqual(self.query("SELECT SUM(visits) FROM center_daily_stats")[0], lessons_total)
+
+    async def test_parallel_purchases_are_deduplicated(self):
+        results = await asyncio.gather(*(
+            self.databases[i % POOLS].create_subscription(1, 1, "4", f"qr-{i}") for i in range(CALLS)
+        ))
+
+        self.assertEqual(len(set(results)), 1)
+        self.assertIsNotNone(results[0])
+        self.assertEqual(self.query("SELECT COUNT(*) FROM subscriptions")[0], 1)
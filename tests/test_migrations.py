@@ -0,0 +1,139 @@
+"""
+Миграции на базе старой схемы: таблицы созданы до AirbaPay и истории цен
+
+CREATE TABLE IF NOT EXISTS такие таблицы не обновляет, поэтому недостающие
+колонки должны добавить сами миграции.
+"""
+import os
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import database
+from database import Database, MIGRATIONS
+
+# Таблицы из database.db, созданного первой версией бота
+LEGACY_SCHEMA = """
+CREATE TABLE courses (
+    course_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    center_id INTEGER,
+    name TEXT NOT NULL,
+    description TEXT,
+    category TEXT,
+    age_min INTEGER,
+    age_max INTEGER,
+    requirements TEXT,
+    schedule TEXT,
+    rating REAL DEFAULT 0,
+    price_4 INTEGER,
+    price_8 INTEGER,
+    price_unlimited INTEGER,
+    photo TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE subscriptions (
+    subscription_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER,
+    child_id INTEGER,
+    course_id INTEGER,
+    center_id INTEGER,
+    tariff TEXT,
+    lessons_total INTEGER,
+    lessons_remaining INTEGER,
+    qr_code TEXT UNIQUE,
+    status TEXT DEFAULT 'active',
+    purchased_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    expires_at TIMESTAMP
+);
+CREATE TABLE payments (
+    payment_id INTEGER PRIMARY KEY AUTOINCREMENT,
+    subscription_id INTEGER,
+    user_id INTEGER,
+    amount INTEGER,
+    method TEXT,
+    status TEXT,
+    transaction_id TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+"""
+
+
+class LegacySchemaMigrationTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "legacy.db")
+        conn = sqlite3.connect(self.path)
+        conn.executescript(LEGACY_SCHEMA)
+        conn.close()
+        self.db = Database(self.path)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.tmp.cleanup()
+
+    def columns(self, table: str) -> set:
+        conn = sqlite3.connect(self.path)
+        try:
+            return {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        finally:
+            conn.close()
+
+    async def test_init_db_migrates_legacy_payments(self):
+        await self.db.init_db()
+
+        self.assertEqual(await self.db.get_schema_version(), max(version for version, _, _ in MIGRATIONS))
+        self.assertLessEqual(
+            {"currency", "invoice_id", "airba_payment_id", "redirect_url", "error_message",
+             "processed_at", "idempotency_key"},
+            self.columns("payments")
+        )
+
+        payment_id = await self.db.create_payment(1, 1, 5000, invoice_id="inv-1")
+        payment = await self.db.get_payment_by_invoice(invoice_id="inv-1")
+        self.assertEqual(payment["payment_id"], payment_id)
+
+    async def test_init_db_is_repeatable(self):
+        await self.db.init_db()
+        await self.db.close()
+
+        self.db = Database(self.path)
+        await self.db.init_db()
+        self.assertEqual(await self.db.get_schema_version(), max(version for version, _, _ in MIGRATIONS))
+
+    async def test_price_backfill_reads_legacy_payments(self):
+        conn = sqlite3.connect(self.path)
+        conn.executescript("""
+            INSERT INTO courses (course_id, center_id, name, price_4, price_8, price_unlimited)
+            VALUES (1, 1, 'Робототехника', 10000, 18000, 30000);
+            INSERT INTO subscriptions (subscription_id, user_id, course_id, center_id, tariff,
+                                       lessons_total, lessons_remaining, purchased_at)
+            VALUES (1, 1, 1, 1, '8', 8, 8, '2024-03-01 10:00:00'),
+                   (2, 2, 1, 1, '4', 4, 4, '2024-03-02 10:00:00');
+            -- Оплачен со скидкой: цена покупки — сумма платежа, а не цена курса
+            INSERT INTO payments (subscription_id, user_id, amount, status) VALUES (1, 1, 15000, 'success');
+        """)
+        conn.close()
+
+        await self.db.init_db()
+
+        paid = await self.db.get_subscription(1)
+        self.assertEqual((paid["price_paid"], paid["currency"]), (15000, "KZT"))
+        # Выдан без платежа — по цене тарифа
+        self.assertEqual((await self.db.get_subscription(2))["price_paid"], 10000)
+
+        conn = sqlite3.connect(self.path)
+        try:
+            revenue = conn.execute("SELECT SUM(revenue), SUM(sales) FROM center_daily_stats").fetchone()
+        finally:
+            conn.close()
+        self.assertEqual(revenue, (25000, 2))
+
+    async def test_failed_init_closes_pool(self):
+        broken = MIGRATIONS + [(1000, "Ошибка миграции", ["CREATE INDEX idx_broken ON payments(no_such_column)"])]
+        with mock.patch.object(database, "MIGRATIONS", broken):
+            with self.assertRaises(sqlite3.OperationalError):
+                await self.db.init_db()
+        # Иначе потоки соединений не дадут процессу завершиться
+        self.assertFalse(self.db.pool.is_open)
+        self.assertEqual(self.db.pool._connections, [])
@@ -0,0 +1,62 @@
+"""
+Уведомления AirbaPay: проверка секрета и одинаковый ответ для любых invoice_id
+"""
+import os
+import tempfile
+import unittest
+
+from aiohttp.test_utils import TestClient, TestServer
+
+from database import Database
+from services.payment_webhook import create_payment_webhook_app
+
+SECRET = "s3cret"
+
+
+class FakePaymentService:
+    """Сверка статуса без запросов к AirbaPay: платеж всё ещё не оплачен"""
+
+    def __init__(self):
+        self.synced = []
+
+    async def sync_payment_status(self, payment: dict) -> dict:
+        self.synced.append(payment["payment_id"])
+        return {"success": True, "status": "new", "finalized": False}
+
+
+class PaymentWebhookTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = Database(os.path.join(self.tmp.name, "webhook.db"))
+        await self.db.init_db()
+        await self.db.create_payment(1, 1, 18000, invoice_id="BOT_KNOWN")
+
+        self.service = FakePaymentService()
+        app = create_payment_webhook_app(None, self.db, self.service)
+        app["payment_webhook"].secret = SECRET
+        self.client = TestClient(TestServer(app))
+        await self.client.start_server()
+
+    async def asyncTearDown(self):
+        await self.client.close()
+        await self.db.close()
+        self.tmp.cleanup()
+
+    async def notify(self, invoice_id: str, token: str = SECRET) -> tuple:
+        response = await self.client.post(
+            "/webhook/payment/success", params={"token": token}, json={"invoice_id": invoice_id}
+        )
+        return response.status, await response.json()
+
+    async def test_rejects_missing_or_wrong_secret(self):
+        self.assertEqual((await self.notify("BOT_KNOWN", token="guess"))[0], 403)
+        response = await self.client.post("/webhook/payment/success", json={"invoice_id": "BOT_KNOWN"})
+        self.assertEqual(response.status, 403)
+        self.assertEqual(self.service.synced, [])
+
+    async def test_unknown_and_pending_look_the_same(self):
+        known = await self.notify("BOT_KNOWN")
+        unknown = await self.notify("BOT_MISSING")
+        self.assertEqual(known, unknown)
+        self.assertEqual(known[0], 200)
+        self.assertEqual(len(self.service.synced), 1)
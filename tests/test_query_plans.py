@@ -0,0 +1,118 @@
+"""
+Планы горячих запросов: каждый запрос должен идти по индексу (SEARCH), а не полным проходом таблицы (SCAN)
+
+Запросы перехватываются через trace callback соединений пула, поэтому
+проверяется ровно тот SQL, который выполняют методы Database.
+"""
+import os
+import re
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+
+from aiogram.fsm.storage.base import StorageKey
+
+from database import Database
+from utils.fsm_storage import SQLiteStorage
+
+# Разрешённые полные проходы: служебные узлы плана, а не таблицы
+ALLOWED_SCANS = ("CONSTANT ROW",)
+SCAN_INDEX = re.compile(r"USING (?:COVERING )?INDEX (\w+)")
+
+
+class QueryPlanTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "plans.db")
+        self.db = Database(self.path)
+        await self.db.init_db()
+        self.statements = []
+        for conn in self.db.pool._connections:
+            await conn.set_trace_callback(self.statements.append)
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.tmp.cleanup()
+
+    async def call_hot_queries(self):
+        db = self.db
+        now = datetime.utcnow()
+        start, end = now - timedelta(days=30), now + timedelta(days=1)
+        await db.get_user(1)
+        await db.get_children(1)
+        await db.get_child(1)
+        await db.get_centers(city="Алматы", status="approved")
+        await db.get_center(1)
+        await db.get_courses_page({"city": "Алматы", "category": "IT"})
+        # Фильтры каталога (idx_courses_catalog / idx_courses_category_price), с курсором и без
+        filters = {"city": "Алматы", "category": "IT", "age": 10, "price_min": 10000, "price_max": 30000,
+                   "min_rating": 4}
+        await db.count_courses(filters)
+        await db.get_courses_page(filters)
+        await db.get_courses_page(filters, cursor=("next", 4.5, 10))
+        await db.count_courses({"category": "IT", "price_min": 10000, "price_max": 30000, "min_rating": 4})
+        await db.get_courses_page({"category": "IT", "age": 10, "price_max": 30000})
+        await db.get_course(1)
+        await db.get_user_subscriptions(1)
+        await db.get_user_subscriptions(1, child_id=1)
+        await db.get_subscription(1, user_id=1)
+        await db.get_subscription_by_qr("qr")
+        await db.record_visit(1, 1)
+        await db.get_visit_stats(1)
+        await db.get_partner_center(1)
+        await db.get_center_students(1)
+        await db.get_center_analytics(1, start, end)
+        await db.get_center_sales(1, start, end)
+        await db.get_center_series(1, start, end, "week")
+        await db.get_course_breakdown(1, start, end)
+        await db.get_retention_metrics(1, start, end, now - timedelta(days=14))
+        await db.get_pending_centers()
+        await db.get_payment(1, user_id=1)
+        await db.get_payment_by_invoice(invoice_id="inv")
+        await db.get_stale_pending_payments(60)
+        await db.get_unactivated_paid_payments(60)
+        await db.get_user_payments(1)
+
+        # Хранилище FSM: чтение, запись с очисткой просроченных, слияние данных
+        storage = SQLiteStorage(db, purge_interval=0)
+        key = StorageKey(bot_id=1, chat_id=1, user_id=1)
+        await storage.set_state(key, "CatalogStates:browsing")
+        await storage.update_data(key, {"city": "Алматы"})
+        await storage.get_state(key)
+        await storage.get_data(key)
+        await storage.set_data(key, {})
+        await storage.set_state(key, None)
+
+    def plan(self, conn, statement: str) -> list:
+        return [row[3] for row in conn.execute(f"EXPLAIN QUERY PLAN {statement}")]
+
+    async def test_hot_queries_use_indexes(self):
+        await self.call_hot_queries()
+        queries = [
+            s for s in self.statements
+            if re.match(r"\s*(SELECT|UPDATE|DELETE|WITH)\b", s, re.IGNORECASE)
+            and "schema_version" not in s
+        ]
+        self.assertTrue(queries)
+
+        conn = sqlite3.connect(self.path)
+        try:
+            # Проход по частичному индексу ограничен его условием (например, pending-платежи)
+            partial = {
+                name for name, sql in conn.execute("SELECT name, sql FROM sqlite_master WHERE type = 'index'")
+                if sql and " WHERE " in sql.upper()
+            }
+            for statement in queries:
+                for step in self.plan(conn, statement):
+                    if not step.startswith("SCAN ") or step.endswith(ALLOWED_SCANS):
+                        continue
+                    index = SCAN_INDEX.search(step)
+                    if not index or index.group(1) not in partial:
+                        self.fail(f"{step}\n{statement}")
+        finally:
+            conn.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
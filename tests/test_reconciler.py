@@ -0,0 +1,77 @@
+"""
+Сверка платежей: брошенный платеж отменяется только по ответу AirbaPay
+"""
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from database import Database
+from services.reconciler import PaymentReconciler
+
+
+class FakeAirbaPay:
+    """Клиент AirbaPay с заранее заданным ответом на запрос статуса"""
+
+    def __init__(self, response: dict):
+        self.response = response
+        self.calls = 0
+
+    async def get_payment_status(self, airba_payment_id: str) -> dict:
+        self.calls += 1
+        return self.response
+
+
+class ReconcilerExpiryTest(unittest.IsolatedAsyncioTestCase):
+    async def asyncSetUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmp.name, "reconcile.db")
+        self.db = Database(self.path)
+        await self.db.init_db()
+        async with self.db.pool.writer() as db:
+            await db.execute("INSERT INTO centers (center_id, partner_id, name) VALUES (1, 1, 'Центр')")
+            await db.execute(
+                "INSERT INTO courses (course_id, center_id, name, price_8) VALUES (1, 1, 'Шахматы', 18000)"
+            )
+        self.subscription_id = await self.db.create_subscription(1, 1, "8", "qr-pending")
+        self.payment_id = await self.db.create_payment(
+            1, self.subscription_id, 18000, invoice_id="inv-1", airba_payment_id="airba-1"
+        )
+        # Платеж старше срока отмены
+        async with self.db.pool.writer() as db:
+            await db.execute(
+                "UPDATE payments SET created_at = datetime('now', '-2 days') WHERE payment_id = ?",
+                (self.payment_id,)
+            )
+
+    async def asyncTearDown(self):
+        await self.db.close()
+        self.tmp.cleanup()
+
+    def reconciler(self, response: dict) -> PaymentReconciler:
+        reconciler = PaymentReconciler(None, self.db, FakeAirbaPay(response), expire_after=3600)
+        reconciler.BACKOFF = 0
+        return reconciler
+
+    def statuses(self) -> tuple:
+        conn = sqlite3.connect(self.path)
+        try:
+            return conn.execute("""
+                SELECT p.status, s.status FROM payments p
+                JOIN subscriptions s ON s.subscription_id = p.subscription_id
+                WHERE p.payment_id = ?
+            """, (self.payment_id,)).fetchone()
+        finally:
+            conn.close()
+
+    async def test_gateway_failure_does_not_expire(self):
+        for response in ({"success": False, "status_code": 503, "error": "Service Unavailable"},
+                         {"success": False, "status_code": 401, "error": "Authentication failed"}):
+            stats = await self.reconciler(response).run_once()
+            self.assertEqual((stats["expired"], stats["unknown"]), (0, 1))
+            self.assertEqual(self.statuses(), ("pending", "active"))
+
+    async def test_confirmed_unfinished_payment_expires(self):
+        stats = await self.reconciler({"success": True, "status_code": 200, "data": {"status": "new"}}).run_once()
+        self.assertEqual(stats["expired"], 1)
+        self.assertEqual(self.statuses(), ("expired", "cancelled"))
@@ -0,0 +1,60 @@
+"""
+Каталог курсов одним сообщением: карточки страницы и общая клавиатура
+"""
+from aiogram.types import CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
+from aiogram.exceptions import TelegramBadRequest
+
+from utils.pagination import paginate_courses, format_course
+
+# Максимальная длина названия курса на кнопке
+BUTTON_NAME_LIMIT = 28
+
+
+def render_catalog_page(courses: list, pagination: InlineKeyboardMarkup, total: int,
+                        first_number: int = 1) -> tuple[str, InlineKeyboardMarkup]:
+    """
+    Собирает страницу каталога в одно сообщение
+    
+    Returns:
+        Tuple (text, keyboard) — карточки курсов и кнопки всех курсов страницы с пагинацией
+    """
+    text = f"Найдено курсов: {total}\n\n"
+    keyboard = []
+    
+    for number, course in enumerate(courses, start=first_number):
+        text += f"{number}. {format_course(course)}\n"
+        
+        name = course["name"]
+        if len(name) > BUTTON_NAME_LIMIT:
+            name = name[:BUTTON_NAME_LIMIT - 1] + "…"
+        keyboard.append([
+            InlineKeyboardButton(text=f"📖 {number}. {name}", callback_data=f"course_detail_{course['course_id']}"),
+            InlineKeyboardButton(text="🛒", callback_data=f"buy_course_{course['course_id']}")
+        ])
+    
+    keyboard.extend(pagination.inline_keyboard)
+    return text, InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+async def show_catalog_page(callback: CallbackQuery, db, filters: dict, cursor: str = None,
+                            per_page: int = 5) -> bool:
+    """
+    Показывает страницу каталога, редактируя сообщение с кнопкой
+    
+    Returns:
+        False, если курсов по фильтрам нет
+    """
+    courses, pagination, total, page = await paginate_courses(db, filters, cursor, per_page)
+    
+    if not courses:
+        return False
+    
+    text, keyboard = render_catalog_page(courses, pagination, total, page * per_page + 1)
+    
+    try:
+        await callback.message.edit_text(text, reply_markup=keyboard)
+    except TelegramBadRequest as e:
+        # Повторное нажатие на ту же страницу
+        if "message is not modified" not in str(e):
+            raise
+    return True
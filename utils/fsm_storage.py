@@ -0,0 +1,125 @@
+"""
+Постоянное хранилище состояний FSM
+
+SQLiteStorage хранит состояния в таблице fsm_storage основной базы: они
+переживают перезапуск и видны всем процессам бота, работающим с этим файлом.
+Для нескольких серверов можно выбрать Redis (FSM_STORAGE=redis).
+"""
+import json
+import time
+from typing import Any, Dict, Mapping, Optional
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, KeyBuilder, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import FSM_STORAGE, FSM_REDIS_URL, FSM_STATE_TTL
+from database import Database
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    Хранилище FSM в SQLite через пул соединений Database
+
+    Запись живёт ttl секунд с последнего изменения. Просроченные записи
+    не читаются и удаляются при записи не чаще раза в purge_interval секунд.
+    """
+
+    def __init__(self, db: Database, ttl: int = FSM_STATE_TTL,
+                 key_builder: Optional[KeyBuilder] = None, purge_interval: float = 600):
+        self.db = db
+        self.ttl = ttl
+        self.key_builder = key_builder or DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self.purge_interval = purge_interval
+        self._purged_at = 0.0
+
+    def _key(self, key: StorageKey) -> str:
+        return self.key_builder.build(key)
+
+    @staticmethod
+    def _state_name(state: StateType) -> Optional[str]:
+        return state.state if isinstance(state, State) else state
+
+    async def _read(self, key: StorageKey) -> Optional[tuple]:
+        async with self.db.pool.reader() as conn:
+            async with conn.execute(
+                "SELECT state, data FROM fsm_storage WHERE key = ? AND expires_at > ?",
+                (self._key(key), int(time.time()))
+            ) as cursor:
+                return await cursor.fetchone()
+
+    async def _write(self, conn, storage_key: str, state: Optional[str], data: Optional[Dict[str, Any]]):
+        now = int(time.time())
+        if state is None and not data:
+            await conn.execute("DELETE FROM fsm_storage WHERE key = ?", (storage_key,))
+        else:
+            await conn.execute("""
+                INSERT INTO fsm_storage (key, state, data, expires_at) VALUES (?, ?, ?, ?)
+                ON CONFLICT(key) DO UPDATE SET
+                    state = excluded.state, data = excluded.data, expires_at = excluded.expires_at
+            """, (storage_key, state, json.dumps(data, ensure_ascii=False) if data else None, now + self.ttl))
+
+        if now - self._purged_at >= self.purge_interval:
+            self._purged_at = now
+            await conn.execute("DELETE FROM fsm_storage WHERE expires_at <= ?", (now,))
+
+    async def _update(self, key: StorageKey, state=..., data=..., merge: bool = False) -> Dict[str, Any]:
+        """Меняет состояние и/или данные одной транзакцией (безопасно для нескольких процессов)"""
+        storage_key = self._key(key)
+        async with self.db.pool.transaction() as conn:
+            async with conn.execute(
+                "SELECT state, data FROM fsm_storage WHERE key = ? AND expires_at > ?",
+                (storage_key, int(time.time()))
+            ) as cursor:
+                row = await cursor.fetchone()
+
+            current_state = row["state"] if row else None
+            current_data = json.loads(row["data"]) if row and row["data"] else {}
+
+            new_state = current_state if state is ... else state
+            if data is ...:
+                new_data = current_data
+            elif merge:
+                new_data = {**current_data, **data}
+            else:
+                new_data = dict(data)
+            await self._write(conn, storage_key, new_state, new_data)
+            return new_data
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        await self._update(key, state=self._state_name(state))
+
+    async def get_state(self, key: StorageKey) -> Optional[str]:
+        row = await self._read(key)
+        return row["state"] if row else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._update(key, data=data)
+
+    async def get_data(self, key: StorageKey) -> Dict[str, Any]:
+        row = await self._read(key)
+        return json.loads(row["data"]) if row and row["data"] else {}
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> Dict[str, Any]:
+        new_data = await self._update(key, data=data, merge=True)
+        return new_data.copy()
+
+    async def close(self) -> None:
+        # Соединениями владеет Database, они закрываются в db.close()
+        pass
+
+
+def create_fsm_storage(db: Database, backend: str = FSM_STORAGE) -> BaseStorage:
+    """Хранилище FSM по настройке FSM_STORAGE"""
+    if backend == "sqlite":
+        return SQLiteStorage(db)
+    if backend == "redis":
+        # Требует пакет redis; подойдёт любой сервер с протоколом Redis
+        from aiogram.fsm.storage.redis import RedisStorage
+        return RedisStorage.from_url(
+            FSM_REDIS_URL,
+            key_builder=DefaultKeyBuilder(with_bot_id=True, with_destiny=True),
+            state_ttl=FSM_STATE_TTL,
+            data_ttl=FSM_STATE_TTL
+        )
+    return MemoryStorage()
@@ -1,5 +1,5 @@
 from aiogram.types import ReplyKeyboardMarkup, KeyboardButton, InlineKeyboardMarkup, InlineKeyboardButton
-from config import CITIES, CATEGORIES
+from config import CITIES, CATEGORIES, PRICE_RANGES, AGE_FILTERS, RATING_FILTERS, ANALYTICS_PERIODS, EXPORT_KINDS
 
 
 # Главное меню для обычного пользователя
@@ -53,6 +53,7 @@ def get_partner_menu():
             [KeyboardButton(text="🎓 Курсы")],
             [KeyboardButton(text="👩‍🏫 Преподаватели")],
             [KeyboardButton(text="📊 Аналитика")],
+            [KeyboardButton(text="📤 Выгрузка")],
             [KeyboardButton(text="⚙ Настройки")]
         ],
         resize_keyboard=True
@@ -127,6 +128,46 @@ def get_categories_keyboard():
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
+# Клавиатура выбора диапазона цен
+def get_price_ranges_keyboard():
+    keyboard = []
+    for price_min, price_max in PRICE_RANGES:
+        if price_min is None:
+            text = f"до {price_max:,}₸"
+        elif price_max is None:
+            text = f"от {price_min:,}₸"
+        else:
+            text = f"{price_min:,}–{price_max:,}₸"
+        keyboard.append([InlineKeyboardButton(
+            text=text,
+            callback_data=f"filter_price_{price_min or ''}_{price_max or ''}"
+        )])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_search")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# Клавиатура выбора возраста
+def get_age_filter_keyboard():
+    keyboard = []
+    for i in range(0, len(AGE_FILTERS), 4):
+        keyboard.append([
+            InlineKeyboardButton(text=f"{age} лет", callback_data=f"filter_age_{age}")
+            for age in AGE_FILTERS[i:i + 4]
+        ])
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_search")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+# Клавиатура выбора минимального рейтинга
+def get_rating_filter_keyboard():
+    keyboard = [[
+        InlineKeyboardButton(text=f"⭐ от {rating}", callback_data=f"filter_rating_{rating}")
+        for rating in RATING_FILTERS
+    ]]
+    keyboard.append([InlineKeyboardButton(text="🔙 Назад", callback_data="back_to_search")])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
 # Клавиатура для карточки курса
 def get_course_keyboard(course_id: int):
     return InlineKeyboardMarkup(
@@ -222,3 +263,23 @@ def get_back_keyboard():
         ]
     )
 
+
+# Выбор периода аналитики партнёра
+def get_analytics_period_keyboard(selected: str = None):
+    row = []
+    for period, (title, _, _) in ANALYTICS_PERIODS.items():
+        text = f"• {title}" if period == selected else title
+        row.append(InlineKeyboardButton(text=text, callback_data=f"analytics_{period}"))
+    return InlineKeyboardMarkup(inline_keyboard=[row[:2], row[2:]])
+
+
+def get_export_keyboard(prefix: str, kinds=None):
+    """Кнопки выгрузки: по строке на вид данных, CSV и XLSX (callback_data: {prefix}_{вид}_{формат})"""
+    keyboard = []
+    for kind in kinds or EXPORT_KINDS:
+        title = EXPORT_KINDS[kind]
+        keyboard.append([
+            InlineKeyboardButton(text=f"{title} · CSV", callback_data=f"{prefix}_{kind}_csv"),
+            InlineKeyboardButton(text=f"{title} · XLSX", callback_data=f"{prefix}_{kind}_xlsx")
+        ])
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
@@ -1,8 +1,10 @@
 """
 Утилиты для пагинации
 """
+import base64
+
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from typing import List, Any, Callable
+from typing import List, Any, Callable, Optional
 
 
 def create_pagination_keyboard(
@@ -73,32 +75,132 @@ def create_pagination_keyboard(
     return items_on_page, InlineKeyboardMarkup(inline_keyboard=keyboard)
 
 
-def paginate_courses(courses: List[dict], page: int = 0, per_page: int = 5):
+def encode_cursor(direction: str, rating: float, course_id: int, page: int) -> str:
+    """Упаковывает позицию в каталоге в короткую строку для callback data"""
+    raw = f"{direction[0]}|{rating}|{course_id}|{page}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(token: str) -> Optional[tuple[tuple, int]]:
     """
-    Пагинация курсов с форматированием
+    Распаковывает курсор из callback data
+    Returns: ((direction, rating, course_id), page) или None, если курсор повреждён
     """
-    def format_course(course: dict) -> str:
-        center_name = course.get("center_name", "Не указано")
-        price_8 = course.get("price_8", 0)
-        rating = course.get("rating", 0)
-        address = course.get("address", "")
-        city = course.get("city", "")
-        
-        text = f"📘 Курс: {course['name']}\n"
-        text += f"🏫 {center_name}\n"
-        text += f"💰 Абонемент: 8 занятий — {price_8:,}₸\n"
-        text += f"⭐️ Рейтинг: {rating}\n"
-        text += f"📍 {city}, {address}\n"
-        return text
-    
-    items, keyboard = create_pagination_keyboard(
-        items=courses,
+    try:
+        raw = base64.urlsafe_b64decode(token + "=" * (-len(token) % 4)).decode()
+        direction, rating, course_id, page = raw.split("|")
+        direction = "prev" if direction == "p" else "next"
+        return (direction, float(rating), int(course_id)), int(page)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def create_cursor_pagination_keyboard(
+    page: int,
+    total_pages: int,
+    callback_prefix: str,
+    prev_cursor: Optional[str] = None,
+    next_cursor: Optional[str] = None,
+    additional_buttons: List[List[InlineKeyboardButton]] = None
+) -> InlineKeyboardMarkup:
+    """
+    Создаёт клавиатуру пагинации по курсорам (callback data: "{prefix}_page_{cursor}")
+    """
+    keyboard = []
+    pagination_buttons = []
+    
+    if prev_cursor:
+        pagination_buttons.append(
+            InlineKeyboardButton(
+                text="⬅️ Назад",
+                callback_data=f"{callback_prefix}_page_{prev_cursor}"
+            )
+        )
+    
+    if total_pages > 1:
+        pagination_buttons.append(
+            InlineKeyboardButton(
+                text=f"📄 {page + 1}/{total_pages}",
+                callback_data="page_info"
+            )
+        )
+    
+    if next_cursor:
+        pagination_buttons.append(
+            InlineKeyboardButton(
+                text="Вперёд ➡️",
+                callback_data=f"{callback_prefix}_page_{next_cursor}"
+            )
+        )
+    
+    if pagination_buttons:
+        keyboard.append(pagination_buttons)
+    
+    if additional_buttons:
+        keyboard.extend(additional_buttons)
+    
+    return InlineKeyboardMarkup(inline_keyboard=keyboard)
+
+
+def format_course(course: dict) -> str:
+    """Карточка курса для каталога"""
+    center_name = course.get("center_name", "Не указано")
+    price_8 = course.get("price_8") or 0
+    rating = course.get("rating", 0)
+    address = course.get("address", "")
+    city = course.get("city", "")
+    
+    text = f"📘 Курс: {course['name']}\n"
+    text += f"🏫 {center_name}\n"
+    text += f"💰 Абонемент: 8 занятий — {price_8:,}₸\n"
+    text += f"⭐️ Рейтинг: {rating}\n"
+    text += f"📍 {city}, {address}\n"
+    return text
+
+
+async def paginate_courses(db, filters: dict, cursor: str = None, per_page: int = 5):
+    """
+    Страница каталога курсов с keyset-пагинацией
+    
+    Args:
+        db: Экземпляр Database
+        filters: Фильтры каталога
+        cursor: Курсор из callback data (None — первая страница)
+        per_page: Количество курсов на странице
+    
+    Returns:
+        Tuple (courses, keyboard, total, page)
+    """
+    position, page = None, 0
+    if cursor:
+        decoded = decode_cursor(cursor)
+        if decoded:
+            position, page = decoded
+    
+    total = await db.count_courses(filters)
+    courses, has_more = await db.get_courses_page(filters, position, per_page)
+    
+    if position and position[0] == "prev":
+        has_prev, has_next = has_more, True
+    else:
+        has_prev, has_next = page > 0, has_more
+    
+    prev_cursor = next_cursor = None
+    if courses and has_prev:
+        first = courses[0]
+        prev_cursor = encode_cursor("prev", first["rating"], first["course_id"], page - 1)
+    if courses and has_next:
+        last = courses[-1]
+        next_cursor = encode_cursor("next", last["rating"], last["course_id"], page + 1)
+    
+    total_pages = max(1, (total + per_page - 1) // per_page)
+    page = min(page, total_pages - 1)
+    keyboard = create_cursor_pagination_keyboard(
         page=page,
-        items_per_page=per_page,
+        total_pages=total_pages,
         callback_prefix="courses",
-        item_formatter=format_course
+        prev_cursor=prev_cursor,
+        next_cursor=next_cursor
     )
     
-    return items, keyboard
-
-
+    return courses, keyboard, total, page
@@ -0,0 +1,68 @@
+"""
+Кэш изображений QR-кодов на стороне Telegram
+
+После первой отправки file_id фото сохраняется в subscriptions.qr_file_id,
+повторные показы отправляют фото по file_id без рендеринга и загрузки.
+"""
+import logging
+from typing import Optional
+
+from aiogram import Bot
+from aiogram.types import Message, BufferedInputFile
+from aiogram.exceptions import TelegramBadRequest
+
+from database import Database
+from middleware.outbound import Priority, send_priority
+from utils.qr_generator import render_qr_code, subscription_qr_text
+
+logger = logging.getLogger(__name__)
+
+
+def _photo_file_id(sent: Optional[Message]) -> Optional[str]:
+    if sent and sent.photo:
+        return sent.photo[-1].file_id
+    return None
+
+
+async def remember_qr_file_id(db: Database, subscription_id: int, qr_code: str, sent: Optional[Message]):
+    """Сохраняет file_id только что отправленного QR-кода"""
+    file_id = _photo_file_id(sent)
+    if file_id:
+        await db.set_subscription_qr_file_id(subscription_id, qr_code, file_id)
+
+
+async def send_subscription_qr(bot: Bot, chat_id: int, db: Database, subscription: dict, caption: str) -> Message:
+    """
+    Отправляет QR-код абонемента
+    
+    Если изображение уже загружалось в Telegram, отправляется по file_id.
+    Иначе QR рендерится, отправляется файлом и его file_id сохраняется.
+    """
+    # QR-код нужен на входе в центр — отправляем раньше массовых сообщений
+    with send_priority(Priority.TRANSACTIONAL):
+        return await _send_subscription_qr(bot, chat_id, db, subscription, caption)
+
+
+async def _send_subscription_qr(bot: Bot, chat_id: int, db: Database, subscription: dict, caption: str) -> Message:
+    subscription_id = subscription["subscription_id"]
+    qr_code = subscription["qr_code"]
+    
+    file_id = subscription.get("qr_file_id")
+    if file_id:
+        try:
+            return await bot.send_photo(chat_id, photo=file_id, caption=caption)
+        except TelegramBadRequest as e:
+            # file_id мог стать недействительным (например, сменился токен бота)
+            logger.warning(f"QR абонемента {subscription_id} не отправлен по file_id: {e}")
+            await db.set_subscription_qr_file_id(subscription_id, qr_code, None)
+    
+    qr_image = await render_qr_code(subscription_qr_text(
+        qr_code, subscription["user_id"], subscription_id, subscription.get("child_id")
+    ))
+    sent = await bot.send_photo(
+        chat_id,
+        photo=BufferedInputFile(qr_image.getvalue(), filename="qr_code.png"),
+        caption=caption
+    )
+    await remember_qr_file_id(db, subscription_id, qr_code, sent)
+    return sent
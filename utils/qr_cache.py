@@ -0,0 +1,190 @@
+"""
+Дисковый кэш PNG QR-кодов с адресацией по содержимому
+
+Файл называется по sha256 текста QR-кода, поэтому одинаковый текст
+всегда даёт один и тот же файл. Запись атомарная (временный файл +
+os.replace), общий размер ограничен, вытесняются давно не читанные файлы.
+Кэш выключен по умолчанию: PNG содержит текст QR-кода абонемента, по
+которому проходят в центр, поэтому файлы удаляются при смене QR и
+окончании абонемента.
+"""
+import hashlib
+import logging
+import mmap
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+from typing import Dict, Optional
+
+from config import QR_CACHE_DIR, QR_CACHE_MAX_BYTES, QR_CACHE_MMAP
+
+logger = logging.getLogger(__name__)
+
+
+class QRDiskCache:
+    """
+    Кэш PNG на диске с бюджетом max_bytes и вытеснением LRU.
+
+    Индекс (ключ -> размер) строится по файлам каталога при первом обращении,
+    порядок LRU восстанавливается по mtime. Методы потокобезопасны: кэш
+    используется из пула рендеринга QR.
+    """
+
+    SUFFIX = ".png"
+
+    def __init__(self, directory: str, max_bytes: int = 64 * 1024 * 1024, use_mmap: bool = False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.use_mmap = use_mmap
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._index: Optional["OrderedDict[str, int]"] = None
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # Подкаталоги по первым символам хэша, чтобы не держать тысячи файлов в одном
+        return os.path.join(self.directory, key[:2], key + self.SUFFIX)
+
+    def _load_index(self):
+        if self._index is not None:
+            return
+
+        entries = []
+        if os.path.isdir(self.directory):
+            for root, _, files in os.walk(self.directory):
+                for name in files:
+                    if not name.endswith(self.SUFFIX):
+                        continue
+                    try:
+                        st = os.stat(os.path.join(root, name))
+                    except OSError:
+                        continue
+                    entries.append((st.st_mtime, name[:-len(self.SUFFIX)], st.st_size))
+
+        entries.sort()
+        self._index = OrderedDict((key, size) for _, key, size in entries)
+        self._size = sum(size for _, _, size in entries)
+        self._evict()
+
+    def _evict(self):
+        while self._size > self.max_bytes and self._index:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            self.evictions += 1
+            try:
+                os.remove(self._path(key))
+            except OSError:
+                pass
+
+    def _read(self, path: str) -> bytes:
+        with open(path, "rb") as f:
+            if self.use_mmap:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    return mm[:]
+            return f.read()
+
+    def get(self, text: str) -> Optional[bytes]:
+        """PNG для текста QR-кода или None"""
+        key = self.key(text)
+        with self._lock:
+            self._load_index()
+            if key not in self._index:
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+
+        path = self._path(key)
+        try:
+            data = self._read(path)
+            # mtime хранит порядок LRU между перезапусками
+            os.utime(path)
+        except (OSError, ValueError):
+            # Файл удалён извне или пустой
+            with self._lock:
+                size = self._index.pop(key, None)
+                if size is not None:
+                    self._size -= size
+                self.misses += 1
+            return None
+
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def put(self, text: str, data: bytes):
+        """Атомарно сохраняет PNG для текста QR-кода"""
+        if len(data) > self.max_bytes:
+            return
+
+        key = self.key(text)
+        path = self._path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить QR в кэш {path}: {e}")
+            return
+
+        with self._lock:
+            self._load_index()
+            old_size = self._index.pop(key, None)
+            if old_size is not None:
+                self._size -= old_size
+            self._index[key] = len(data)
+            self._size += len(data)
+            self._evict()
+
+    def discard(self, text: str):
+        """Удаляет PNG текста QR-кода (QR сменился или абонемент закончился)"""
+        key = self.key(text)
+        with self._lock:
+            self._load_index()
+            size = self._index.pop(key, None)
+            if size is None:
+                return
+            self._size -= size
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            self._load_index()
+            return {
+                "files": len(self._index),
+                "bytes": self._size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_disk_cache: Optional[QRDiskCache] = None
+_disk_cache_lock = threading.Lock()
+
+
+def get_qr_disk_cache() -> Optional[QRDiskCache]:
+    """Общий дисковый кэш QR-кодов или None, если он отключён"""
+    global _disk_cache
+    if not QR_CACHE_DIR or QR_CACHE_MAX_BYTES <= 0:
+        return None
+    if _disk_cache is None:
+        with _disk_cache_lock:
+            if _disk_cache is None:
+                _disk_cache = QRDiskCache(QR_CACHE_DIR, QR_CACHE_MAX_BYTES, QR_CACHE_MMAP)
+    return _disk_cache
@@ -1,5 +1,11 @@
+import asyncio
 import io
 import uuid
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional
+
+from config import QR_RENDER_EXECUTOR, QR_RENDER_WORKERS
+from utils.qr_cache import get_qr_disk_cache
 
 try:
     import qrcode
@@ -9,12 +15,23 @@ except ImportError:
     QR_AVAILABLE = False
 
 
+# Пул для рендеринга QR-кодов, создаётся при первом использовании
+_executor: Optional[Executor] = None
+
+
 def generate_qr_code(text: str) -> io.BytesIO:
     """Генерирует QR-код и возвращает его как BytesIO объект"""
     if not QR_AVAILABLE:
         # Возвращаем пустой BytesIO если Pillow не установлен
         return io.BytesIO(b'QR code generation requires Pillow library')
     
+    # Одинаковый текст даёт одинаковый PNG — берём готовый с диска
+    disk_cache = get_qr_disk_cache()
+    if disk_cache:
+        cached = disk_cache.get(text)
+        if cached:
+            return io.BytesIO(cached)
+    
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
@@ -28,17 +45,73 @@ def generate_qr_code(text: str) -> io.BytesIO:
     img_bytes = io.BytesIO()
     img.save(img_bytes, format='PNG')
     img_bytes.seek(0)
+    
+    if disk_cache:
+        disk_cache.put(text, img_bytes.getvalue())
     return img_bytes
 
 
+def subscription_qr_text(qr_id: str, user_id: int, subscription_id: int, child_id: int = None) -> str:
+    """Текст QR-кода абонемента (его разбирает partner.qr_scanned)"""
+    qr_text = f"SUBSCRIPTION:{qr_id}:{user_id}:{subscription_id}"
+    if child_id:
+        qr_text += f":{child_id}"
+    return qr_text
+
+
+def forget_subscription_qr(qr_id: str, user_id: int, subscription_id: int, child_id: int = None):
+    """Удаляет PNG прежнего QR-кода абонемента из дискового кэша"""
+    disk_cache = get_qr_disk_cache()
+    if disk_cache:
+        disk_cache.discard(subscription_qr_text(qr_id, user_id, subscription_id, child_id))
+
+
 def generate_subscription_qr(user_id: int, subscription_id: int, child_id: int = None) -> tuple[str, io.BytesIO]:
     """Генерирует уникальный QR-код для абонемента"""
     # Создаём уникальный идентификатор
     qr_id = str(uuid.uuid4())
-    qr_text = f"SUBSCRIPTION:{qr_id}:{user_id}:{subscription_id}"
-    if child_id:
-        qr_text += f":{child_id}"
+    qr_text = subscription_qr_text(qr_id, user_id, subscription_id, child_id)
     
     qr_image = generate_qr_code(qr_text)
     return qr_id, qr_image
 
+
+def _render_png(text: str) -> bytes:
+    # Функция верхнего уровня, чтобы её можно было передать в ProcessPoolExecutor
+    return generate_qr_code(text).getvalue()
+
+
+def get_qr_executor() -> Executor:
+    """Ограниченный пул потоков или процессов для рендеринга QR-кодов"""
+    global _executor
+    if _executor is None:
+        workers = max(1, QR_RENDER_WORKERS)
+        if QR_RENDER_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=workers)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="qr-render")
+    return _executor
+
+
+def shutdown_qr_executor():
+    """Останавливает пул рендеринга (при завершении работы бота)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=True, cancel_futures=True)
+        _executor = None
+
+
+async def render_qr_code(text: str) -> io.BytesIO:
+    """Асинхронная версия generate_qr_code: рендеринг выполняется в пуле, не блокируя цикл событий"""
+    loop = asyncio.get_running_loop()
+    png = await loop.run_in_executor(get_qr_executor(), _render_png, text)
+    return io.BytesIO(png)
+
+
+async def render_subscription_qr(user_id: int, subscription_id: int, child_id: int = None) -> tuple[str, io.BytesIO]:
+    """Асинхронная версия generate_subscription_qr"""
+    qr_id = str(uuid.uuid4())
+    qr_text = subscription_qr_text(qr_id, user_id, subscription_id, child_id)
+    
+    qr_image = await render_qr_code(qr_text)
+    return qr_id, qr_image